@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+memory per listing entry: dict-based ClFile vs slotted ClFile vs FileTable
+
+usage: python3 benchmarks/bench_clfile_memory.py [entries]
+"""
+__author__ = "Michael Montuori [michael.montuori@gmail.com]"
+__copyright__ = "Copyright 2017 Michael Montuori. All rights reserved."
+__credits__ = ["Warren Crigger"]
+__license__ = "GPLv3"
+__version__ = "1.2"
+__revision__ = "0"
+
+import gc
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from libsprinkle import clfile
+
+
+class DictClFile(object):
+    """ClFile as it was before __slots__: class defaults plus a per-instance __dict__."""
+
+    remote = None
+    path = None
+    remote_path = None
+    name = None
+    size = None
+    mime_type = None
+    mod_time = None
+    is_dir = None
+    id = None
+    md5 = None
+
+
+def fill(files, factory, count):
+    """Build entries the way ``ClSync._ls`` does: 8 remotes, 100 files per directory."""
+    for index in range(count):
+        directory = '/Movies/' + str(index // 2600) + '/' + chr(ord('a') + index // 100 % 26)
+        name = 'movie-' + str(index) + '.mkv'
+        tmp_file = factory()
+        # json.loads and the string concatenation create new strings for every row.
+        tmp_file.remote = 'dst10' + str(index % 8) + ':'
+        tmp_file.path = directory + '/' + name
+        tmp_file.name = name
+        tmp_file.size = 700000000 + index
+        tmp_file.mime_type = '/'.join(('video', 'x-matroska'))
+        tmp_file.mod_time = '2024-01-01T00:00:%02dZ' % (index % 60)
+        tmp_file.is_dir = False
+        tmp_file.id = '1' + format(index, '032x')
+        files[directory + '/' + name] = tmp_file
+    return files
+
+
+def measure(make_files, factory, count):
+    gc.collect()
+    tracemalloc.start()
+    files = fill(make_files(), factory, count)
+    gc.collect()
+    size, _peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del files
+    return size
+
+
+def main(argv):
+    count = int(argv[0]) if argv else 200000
+    print('entries: ' + str(count))
+    for label, make_files, factory in (
+            ('dict of ClFile with __dict__', dict, DictClFile),
+            ('dict of slotted ClFile', dict, clfile.ClFile),
+            ('FileTable', clfile.FileTable, clfile.ClFile)):
+        size = measure(make_files, factory, count)
+        print('%-30s %7.1f bytes/entry' % (label, float(size) / count))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+compare_clfiles_for_remote_root on synthetic trees: per-file realpath/relpath lookups vs merge join
+
+usage: python3 benchmarks/bench_compare.py [entries]
+"""
+__author__ = "Michael Montuori [michael.montuori@gmail.com]"
+__copyright__ = "Copyright 2017 Michael Montuori. All rights reserved."
+__credits__ = ["Warren Crigger"]
+__license__ = "GPLv3"
+__version__ = "1.2"
+__revision__ = "0"
+
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from libsprinkle import clfile
+from libsprinkle import clsync
+from libsprinkle import common
+from libsprinkle import operation
+
+
+def synthetic_trees(local_dir, remote_root, count):
+    """Local and remote indexes of ``count`` files: 1% new, 1% changed, 1% deleted, 1000 per directory."""
+    local_clfiles = {}
+    remote_clfiles = clfile.FileTable()
+    for index in range(count):
+        rel_dir = 'disk' + str(index // 100000) + '/dir' + str(index // 1000)
+        name = 'file' + str(index) + '.mkv'
+        if index % 100 != 1:
+            local_file = clfile.ClFile()
+            local_file.path = local_dir + '/' + rel_dir
+            local_file.name = name
+            local_file.size = 1000 + index
+            local_file.is_dir = False
+            local_clfiles[local_file.path + '/' + name] = local_file
+        if index % 100 != 0:
+            remote_file = clfile.ClFile()
+            remote_file.remote = 'dst10' + str(index % 8) + ':'
+            remote_file.path = remote_root + '/' + rel_dir + '/' + name
+            remote_file.name = name
+            remote_file.size = 1000 + index + (1 if index % 100 == 2 else 0)
+            remote_file.is_dir = False
+            remote_clfiles[remote_file.path] = remote_file
+    return local_clfiles, remote_clfiles
+
+
+def legacy_compare(sync, local_dir, local_clfiles, remote_clfiles, remote_root):
+    """The comparator before the merge join: two key lookups per file and a re-sort for deletions."""
+    local_remote_keys = {}
+    for local_path in local_clfiles:
+        local_clfile = local_clfiles[local_path]
+        full_path = local_clfile.path + '/' + local_clfile.name
+        local_remote_keys[sync.remote_key_for_local_path(local_dir, full_path, remote_root)] = local_clfile
+    operations = []
+    for local_path in local_clfiles:
+        local_clfile = local_clfiles[local_path]
+        remote_name = sync.remote_key_for_local_path(
+            local_dir, local_clfile.path + '/' + local_clfile.name, remote_root)
+        if remote_name not in remote_clfiles:
+            operations.append(operation.Operation(operation.Operation.ADD, local_clfile, None))
+        elif local_clfile.size != remote_clfiles[remote_name].size:
+            operations.append(operation.Operation(operation.Operation.UPDATE, local_clfile, None))
+    for remote_path in common.sort_dict_keys(remote_clfiles, True):
+        if remote_path not in local_remote_keys:
+            operations.append(operation.Operation(operation.Operation.REMOVE, remote_clfiles[remote_path], None))
+    return operations
+
+
+def main(argv):
+    count = int(argv[0]) if argv else 1000000
+    logging.disable(logging.INFO)
+    sync = clsync.ClSync.__new__(clsync.ClSync)
+    sync._compare_method = 'size'
+    with tempfile.TemporaryDirectory() as local_dir:
+        remote_root = '/backup'
+        local_clfiles, remote_clfiles = synthetic_trees(local_dir, remote_root, count)
+        print('local entries: ' + str(len(local_clfiles)) + ', remote entries: ' + str(len(remote_clfiles)))
+        for label, compare in (
+                ('per-file realpath/relpath', lambda: legacy_compare(
+                    sync, local_dir, local_clfiles, remote_clfiles, remote_root)),
+                ('sorted merge join', lambda: sync.compare_clfiles_for_remote_root(
+                    local_dir, local_clfiles, remote_clfiles, True, remote_root))):
+            start = time.perf_counter()
+            operations = compare()
+            elapsed = time.perf_counter() - start
+            print('%-28s %7.2fs  %d operations' % (label, elapsed, len(operations)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+synthetic rclone for benchmarks: answers listremotes, lsjson, md5sum and about for a generated cluster
+
+Point rclone_exe (--rclone-exe) at this file. The cluster is described by
+environment variables:
+
+    FAKE_RCLONE_REMOTES        remotes when --config has no sections (default:4)
+    FAKE_RCLONE_FILES          files across the whole cluster (default:10000)
+    FAKE_RCLONE_FILES_PER_DIR  files per directory (default:100)
+    FAKE_RCLONE_FREE           free bytes reported per remote (default:15 GiB)
+    FAKE_RCLONE_LATENCY        seconds every invocation sleeps before answering (default:0)
+    FAKE_RCLONE_LOG            file that gets one line per invocation
+
+File ``n`` is ``dirNNNNN/fileNNNNNNN.mkv`` of ``1000 + n`` bytes and lives on
+remote ``n % remotes``; a remote's number is the number at the end of its
+name. Any listed path shows the whole tree unless its last component is one
+of the ``dirNNNNN`` directories. Transfers and deletions succeed without
+doing anything.
+"""
+__author__ = "Michael Montuori [michael.montuori@gmail.com]"
+__copyright__ = "Copyright 2017 Michael Montuori. All rights reserved."
+__credits__ = ["Warren Crigger"]
+__license__ = "GPLv3"
+__version__ = "1.2"
+__revision__ = "0"
+
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+
+MOD_TIME = "2017-11-24T20:12:03.000000000Z"
+MIME_TYPE = "video/x-matroska"
+
+_OPTIONS_WITH_VALUE = (
+    '--config', '--retries', '--files-from', '--files-from-raw', '--min-age', '--max-age', '--max-depth')
+
+
+def setting(name, default):
+    value = os.environ.get('FAKE_RCLONE_' + name)
+    return default if value in (None, '') else type(default)(value)
+
+
+def parse(argv):
+    """Split ``argv`` into the command, its flags and its positional arguments."""
+    flags = {}
+    positional = []
+    index = 0
+    while index < len(argv):
+        arg = argv[index]
+        if arg in _OPTIONS_WITH_VALUE:
+            flags[arg] = argv[index + 1]
+            index += 2
+            continue
+        if arg.startswith('-'):
+            flags[arg] = True
+        else:
+            positional.append(arg)
+        index += 1
+    command = positional.pop(0) if positional else None
+    return command, flags, positional
+
+
+def config_remotes(config_file):
+    if config_file is None or not os.path.isfile(config_file):
+        return None
+    with open(config_file) as fp:
+        remotes = [line.strip()[1:-1] for line in fp if re.match(r'\s*\[[^\]]+\]\s*$', line)]
+    return remotes or None
+
+
+def cluster_size(flags):
+    remotes = config_remotes(flags.get('--config'))
+    if remotes is not None:
+        return len(remotes)
+    return setting('REMOTES', 4)
+
+
+def remote_index(remote, remotes):
+    match = re.search(r'(\d+)$', remote)
+    return (int(match.group(1)) if match else 0) % remotes
+
+
+def remote_files(remote, remotes, directory=None):
+    """Yield ``(number, dir_name, file_name)`` of the files on ``remote``, optionally in one directory."""
+    files = setting('FILES', 10000)
+    per_dir = setting('FILES_PER_DIR', 100)
+    index = remote_index(remote, remotes)
+    if directory is None:
+        numbers = range(index, files, remotes)
+    else:
+        start = directory * per_dir
+        first = start + (index - start) % remotes
+        numbers = range(first, min(files, start + per_dir), remotes)
+    for number in numbers:
+        yield number, 'dir%05d' % (number // per_dir), 'file%07d.mkv' % number
+
+
+def split_target(target):
+    """Return ``(remote, directory number or None)`` for ``remote:path``; False for a missing directory."""
+    remote, _, path = target.partition(':')
+    last = path.rstrip('/').rsplit('/', 1)[-1]
+    match = re.match(r'dir(\d+)$', last)
+    if match is None:
+        return remote, None
+    directory = int(match.group(1))
+    files = setting('FILES', 10000)
+    if directory * setting('FILES_PER_DIR', 100) >= files:
+        return remote, False
+    return remote, directory
+
+
+def lsjson(flags, positional):
+    remote, directory = split_target(positional[0])
+    if directory is False:
+        return fail('directory not found')
+    recursive = flags.get('--recursive') or flags.get('-R')
+    remotes = cluster_size(flags)
+    out = sys.stdout
+    out.write('[\n')
+    first = True
+    seen_dirs = set()
+    for number, dir_name, file_name in remote_files(remote, remotes, directory):
+        rows = []
+        if directory is None and dir_name not in seen_dirs:
+            seen_dirs.add(dir_name)
+            rows.append({"Path": dir_name, "Name": dir_name, "Size": -1, "MimeType": "inode/directory",
+                         "ModTime": MOD_TIME, "IsDir": True, "ID": "d" + dir_name})
+        if directory is not None or recursive:
+            path = file_name if directory is not None else dir_name + '/' + file_name
+            rows.append({"Path": path, "Name": file_name, "Size": 1000 + number, "MimeType": MIME_TYPE,
+                         "ModTime": MOD_TIME, "IsDir": False, "ID": "f%07d" % number})
+        for row in rows:
+            out.write(('' if first else ',\n') + json.dumps(row))
+            first = False
+    out.write('\n]\n')
+    return 0
+
+
+def md5sum(flags, positional):
+    remote, directory = split_target(positional[0])
+    if directory is False:
+        return fail('directory not found')
+    for number, dir_name, file_name in remote_files(remote, cluster_size(flags), directory):
+        path = file_name if directory is not None else dir_name + '/' + file_name
+        sys.stdout.write(hashlib.md5(str(number).encode()).hexdigest() + '  ' + path + '\n')
+    return 0
+
+
+def about(flags, positional):
+    remote = positional[0].partition(':')[0]
+    remotes = cluster_size(flags)
+    used = sum(1000 + number for number, _dir, _name in remote_files(remote, remotes))
+    free = setting('FREE', 15 * 1024 * 1024 * 1024)
+    sys.stdout.write(json.dumps({"total": used + free, "used": used, "free": free, "trashed": 0,
+                                 "other": 0, "objects": len(range(remote_index(remote, remotes),
+                                                                  setting('FILES', 10000), remotes))}) + '\n')
+    return 0
+
+
+def listremotes(flags, _positional):
+    remotes = config_remotes(flags.get('--config'))
+    if remotes is None:
+        remotes = ['dst%d' % (101 + index) for index in range(setting('REMOTES', 4))]
+    sys.stdout.write(''.join(remote + ':\n' for remote in remotes))
+    return 0
+
+
+def version(_flags, _positional):
+    sys.stdout.write('rclone v1.66.0-fake\n')
+    return 0
+
+
+def transfer(flags, _positional):
+    """Log every ``--files-from-raw`` entry as copied, as rclone -v does."""
+    return log_manifest(flags, 'Copied (new)')
+
+
+def delete(flags, _positional):
+    """Log every ``--files-from-raw`` entry as deleted, as rclone -v does."""
+    return log_manifest(flags, 'Deleted')
+
+
+def log_manifest(flags, message):
+    manifest = flags.get('--files-from-raw')
+    if manifest is None or '-v' not in flags:
+        return 0
+    with open(manifest) as fp:
+        names = fp.read().split('\n')
+    sys.stderr.write(''.join('INFO  : ' + name + ': ' + message + '\n' for name in names if name))
+    return 0
+
+
+def fail(message):
+    sys.stderr.write('ERROR : ' + message + '\n')
+    return 3
+
+
+COMMANDS = {
+    'listremotes': listremotes,
+    'lsjson': lsjson,
+    'md5sum': md5sum,
+    'about': about,
+    'version': version,
+    'copy': transfer,
+    'move': transfer,
+    'delete': delete,
+}
+
+
+def main(argv):
+    command, flags, positional = parse(argv)
+    log = os.environ.get('FAKE_RCLONE_LOG')
+    if log:
+        # One short O_APPEND write per call keeps concurrent invocations on separate lines.
+        fd = os.open(log, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            os.write(fd, (str(command) + '\n').encode())
+        finally:
+            os.close(fd)
+    latency = setting('LATENCY', 0.0)
+    if latency > 0:
+        time.sleep(latency)
+    handler = COMMANDS.get(command)
+    if handler is None:
+        # moveto, deletefile, rmdir, rmdirs, mkdir and touch.
+        return 0
+    return handler(flags, positional)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -9,15 +9,72 @@ __license__ = "GPLv3"
 __version__ = "1.2"
 __revision__ = "0"
 
+import sys
+from collections.abc import MutableMapping
+
+FIELDS = ('remote', 'path', 'remote_path', 'name', 'size', 'mime_type', 'mod_time', 'is_dir', 'id', 'md5')
+
 class ClFile(object):
 
-    remote = None
-    path = None
-    remote_path = None
-    name = None
-    size = None
-    mime_type = None
-    mod_time = None
-    is_dir = None
-    id = None
-    md5 = None
+    __slots__ = FIELDS
+
+    def __init__(self):
+        self.remote = None
+        self.path = None
+        self.remote_path = None
+        self.name = None
+        self.size = None
+        self.mime_type = None
+        self.mod_time = None
+        self.is_dir = None
+        self.id = None
+        self.md5 = None
+
+
+class FileTable(MutableMapping):
+    """Mapping of keys to ClFiles that shares repeated strings between entries.
+
+    Listings keep hundreds of thousands of entries alive (and the daemon
+    keeps them between runs). Repeated strings (remote names, MIME types,
+    parent paths) are interned when an entry is stored, so every entry
+    shares one copy, and a ``path`` equal to its key, as in ``ClSync.ls``
+    results, shares the key's string. ``table[key]`` is the stored ClFile
+    itself: changes made through it are kept.
+    """
+
+    _interned = ('remote', 'path', 'remote_path', 'mime_type')
+
+    def __init__(self, clfiles=None):
+        self._files = {}
+        if clfiles is not None:
+            self.update(clfiles)
+
+    def __getitem__(self, key):
+        return self._files[key]
+
+    def __setitem__(self, key, tmp_clfile):
+        for field in self._interned:
+            value = getattr(tmp_clfile, field)
+            if field == 'path' and value == key:
+                value = key
+            elif isinstance(value, str):
+                value = sys.intern(value)
+            else:
+                continue
+            setattr(tmp_clfile, field, value)
+        self._files[key] = tmp_clfile
+
+    def __delitem__(self, key):
+        del self._files[key]
+
+    def __iter__(self):
+        return iter(self._files)
+
+    def __len__(self):
+        return len(self._files)
+
+    def __contains__(self, key):
+        return key in self._files
+
+    def __repr__(self):
+        return 'FileTable(' + str(len(self)) + ' files)'
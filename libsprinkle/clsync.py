@@ -11,23 +11,62 @@ __revision__ = "0"
 
 import logging
 from libsprinkle import rclone
+from libsprinkle import rclone_rc
 from libsprinkle import common
 from libsprinkle import clfile
 from libsprinkle import exceptions
+from libsprinkle import journal
+from libsprinkle import local_index
+from libsprinkle import placement
 from libsprinkle import operation
+from libsprinkle import search
 from libsprinkle import service_accounts
+from libsprinkle import workers
 try:
     from progress.bar import Bar
 except:
     print("Progress library not found. run command 'pip3 install progress'")
     quit()
+import contextlib
+import datetime
+import functools
 import json
+import mimetypes
 import os
 import re
+import threading
+import time
 
 DEFAULT_LARGE_FILE_THRESHOLD_BYTES = 1024 * 1024 * 1024
 DEFAULT_LARGE_FILE_MIN_FREE_BYTES = 512 * 1024 * 1024
 DEFAULT_LARGE_FILE_MIN_FREE_PERCENT = 5
+DEFAULT_TRANSFER_WORKERS = 1
+DEFAULT_TRANSFER_WORKERS_PER_REMOTE = 2
+DEFAULT_LS_WORKERS = 4
+DEFAULT_HASH_WORKERS = 1
+DEFAULT_LS_CACHE_TTL_MINUTES = 720
+DEFAULT_LS_FULL_REFRESH_HOURS = 168
+# A delta listing also asks for files this much older than the last listing,
+# which covers the time that listing took and clock skew.
+LS_DELTA_OVERLAP_SECONDS = 3600
+# Marks a registry quota row that still has to be read.
+_LOOKUP = object()
+_MOD_TIME = re.compile(r'(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.\d+)?(Z|[+-]\d\d:\d\d)?$')
+
+
+def _epoch_seconds(mod_time):
+    """Seconds since the epoch of an rclone ModTime string, or None when it cannot be read."""
+    match = _MOD_TIME.match(mod_time)
+    if match is None:
+        return None
+    stamp = datetime.datetime.strptime(match.group(1), '%Y-%m-%dT%H:%M:%S')
+    seconds = (stamp - datetime.datetime(1970, 1, 1)).total_seconds()
+    offset = match.group(2)
+    if offset not in (None, 'Z'):
+        minutes = int(offset[1:3]) * 60 + int(offset[4:6])
+        seconds -= minutes * 60 if offset[0] == '+' else -minutes * 60
+    return seconds
+
 
 class ClSync:
 
@@ -71,6 +110,7 @@ class ClSync:
                 config.get('sa_db'),
                 config.get('sa_store'),
                 config.get('sa_cache_ttl_hours', service_accounts.DEFAULT_CACHE_TTL_HOURS),
+                config.get('ls_search_index', False) is True,
             )
         if 'compare_method' in config:
             self._compare_method = config['compare_method']
@@ -97,12 +137,25 @@ class ClSync:
             self.__exclude_regex = None
 
         self._cache = {}
-        self._cache_counter = {}
-        self._cache_invalidation_max = 1440 / (config['daemon_interval'] * 2)
-        if self._cache_invalidation_max < 1:
-            self._cache_invalidation_max = 1
-
-        if 'rclone_exe' not in self._config:
+        self._cache_lock = threading.Lock()
+        # (remote, path) of files a listing returned more than once (Drive duplicates).
+        self._duplicate_paths = set()
+        self._ls_cache_ttl_seconds = int(config.get('ls_cache_ttl_minutes', DEFAULT_LS_CACHE_TTL_MINUTES)) * 60
+        self._remote_state = {}
+        self._ls_delta = config.get('ls_delta', False) is True
+        self._ls_full_refresh_hours = int(config.get('ls_full_refresh_hours', DEFAULT_LS_FULL_REFRESH_HOURS))
+        self._journal_db = config.get('journal_db') or journal.default_db_path(config.get('sa_db'))
+        self._journal = None
+
+        if self._config.get('rclone_backend', 'subprocess') == 'rcd':
+            self._rclone = rclone_rc.connect(
+                rclone_config,
+                self._config.get('rclone_exe', 'rclone'),
+                self._rclone_retries,
+                self._config.get('rclone_rc_url'),
+                int(self._config.get('rclone_rc_timeout_seconds', rclone_rc.DEFAULT_REQUEST_TIMEOUT_SECONDS)),
+            )
+        elif 'rclone_exe' not in self._config:
             self._rclone = rclone.RClone(rclone_config)
         else:
             self._rclone = rclone.RClone(
@@ -114,6 +167,34 @@ class ClSync:
         else:
             self._rclone_move = False
 
+        self._batch_transfers = config.get('batch_transfers', False) is True
+        self._transfer_workers = max(1, int(config.get('transfer_workers', DEFAULT_TRANSFER_WORKERS)))
+        self._transfer_workers_per_remote = max(1, int(config.get(
+            'transfer_workers_per_remote',
+            DEFAULT_TRANSFER_WORKERS_PER_REMOTE,
+        )))
+        self._ls_workers = max(1, int(config.get('ls_workers', DEFAULT_LS_WORKERS)))
+        self._placement_strategy = config.get('placement_strategy', placement.DEFAULT_STRATEGY)
+        if self._placement_strategy not in placement.STRATEGIES:
+            raise Exception('unsupported placement strategy ' + str(self._placement_strategy))
+        # Set only while a concurrent backup runs.
+        self._reservations = None
+        self._remote_slots = None
+        self._hash_workers = max(1, int(config.get('hash_workers', DEFAULT_HASH_WORKERS)))
+        self._hash_fadvise = config.get('hash_fadvise', True) is True
+        self._hash_cache = None
+        if self._compare_method == 'md5' and config.get('hash_cache', True) is True:
+            self._hash_cache = local_index.HashCache(config.get('local_index_db') or local_index.DEFAULT_DB_PATH)
+        self._local_snapshot = None
+        self._local_snapshot_full_scan_hours = int(config.get(
+            'local_snapshot_full_scan_hours',
+            local_index.DEFAULT_FULL_SCAN_HOURS,
+        ))
+        if config.get('local_snapshot', False) is True:
+            self._local_snapshot = local_index.LocalSnapshot(
+                config.get('local_index_db') or local_index.DEFAULT_DB_PATH
+            )
+
     def get_remotes(self):
         logging.debug('getting rclone remotes')
         if self._config.get('cluster_remotes') not in (None, ''):
@@ -169,142 +250,149 @@ class ClSync:
             file = '/' + file
         if remotes is None:
             remotes = self.get_remotes()
-        memory_cache_key = (file, with_dups, regex, stop_after_first, recursive, tuple(remotes), normalize_path)
-        if self._config['no_cache'] is False and memory_cache_key in self._cache:
-            logging.debug('serving cached version of file list...')
-            self._cache_counter[memory_cache_key] += 1
-            if self._cache_counter[memory_cache_key] <= self._cache_invalidation_max:
-                return self._cache[memory_cache_key]
-            else:
-                self._cache_counter[memory_cache_key] = 0
         if regex is not None:
             regexp = re.compile(regex)
         else:
             regexp = None
-        files = {}
+        files = clfile.FileTable()
         md5s = None
         if self._compare_method == 'md5':
             md5s = self.lsmd5(file, stop_after_first, remotes, normalize_path)
-        for remote in remotes:
-            common.print_line('retrieving file list from: ' + remote + file + '...')
-            logging.debug('getting lsjson from ' + remote + file)
-            json_out = self._cached_lsjson(remote, file, recursive)
-            logging.debug('loading json')
-            tmp_json = json.loads(json_out)
-            logging.debug('json size: ' + str(len(tmp_json)))
-            logging.debug('json loaded')
-            for tmp_json_file in tmp_json:
-                tmp_file = clfile.ClFile()
-                tmp_file.remote = remote
-                tmp_file.path = file + '/' + tmp_json_file['Path']
-                tmp_file.name = tmp_json_file['Name']
-                tmp_file.size = tmp_json_file['Size']
-                tmp_file.mime_type = tmp_json_file['MimeType']
-                tmp_file.mod_time = tmp_json_file['ModTime']
-                tmp_file.is_dir = tmp_json_file['IsDir']
-                tmp_file.id = tmp_json_file.get('ID')
-                key = file + '/' + tmp_json_file['Path']
-                if regexp is not None and regexp.search(key) is None:
-                    logging.debug('skipping ' + key + '...')
-                    continue
-                if self._compare_method == 'md5' and not tmp_file.is_dir:
-                    tmp_file.md5 = md5s[key]
-                if with_dups and tmp_file.is_dir is False and key in files:
-                    key = key + ClSync.duplicate_suffix
-                files[key] = tmp_file
-                if stop_after_first and len(files) > 0:
-                    self._store_memory_ls_cache(memory_cache_key, files)
+        ls_workers = self._ls_workers
+        if stop_after_first and self._stop_after_first_success():
+            # Every remote sees the same drive folder; only the first is listed.
+            ls_workers = 1
+        listings = workers.ordered_map(
+            functools.partial(self._list_remote, file, recursive),
+            remotes,
+            ls_workers,
+        )
+        try:
+            for _remote, remote_files in listings:
+                if self._merge_listing(files, remote_files, with_dups, regexp, md5s, stop_after_first):
                     return files
-            if stop_after_first and self._stop_after_first_success():
-                self._store_memory_ls_cache(memory_cache_key, files)
-                return files
-            logging.debug('end of clsync.ls()')
-        self._store_memory_ls_cache(memory_cache_key, files)
+                if stop_after_first and self._stop_after_first_success():
+                    return files
+                logging.debug('end of clsync.ls()')
+        finally:
+            listings.close()
         return files
 
-    def _cached_lsjson(self, remote, path, recursive=True):
-        if self._config['no_cache'] is False and self._sa_registry is not None:
-            cached = self._sa_registry.ls_cache_by_remote(remote, path)
-            if cached is not None and not self._sa_registry.should_refresh_ls_cache(cached, self._sa_refresh):
-                logging.debug('serving cached lsjson for ' + remote + path)
-                return self._json_for_listing_depth(cached["json_text"], recursive)
-            if cached is not None and self._sa_refresh == 'none':
+    def _list_remote(self, file, recursive, remote):
+        """Return the listing of ``remote`` + ``file`` as a FileTable, from memory while fresh."""
+        cache_key = (remote, file, recursive)
+        use_memory = self._config['no_cache'] is False
+        if use_memory:
+            cached = self._cache.get(cache_key)
+            if cached is not None and time.monotonic() - cached[0] < self._ls_cache_ttl_seconds:
+                logging.debug('serving cached version of file list for ' + remote + file)
+                return cached[1]
+        common.print_line('retrieving file list from: ' + remote + file + '...')
+        logging.debug('getting lsjson from ' + remote + file)
+        rows = self._cached_listing(remote, file, recursive)
+        logging.debug('listing size: ' + str(len(rows)))
+        remote_files = clfile.FileTable()
+        for tmp_json_file in rows:
+            tmp_file = clfile.ClFile()
+            tmp_file.remote = remote
+            tmp_file.path = file + '/' + tmp_json_file['Path']
+            tmp_file.name = tmp_json_file['Name']
+            tmp_file.size = tmp_json_file['Size']
+            tmp_file.mime_type = tmp_json_file['MimeType']
+            tmp_file.mod_time = tmp_json_file['ModTime']
+            tmp_file.is_dir = tmp_json_file['IsDir']
+            tmp_file.id = tmp_json_file.get('ID')
+            key = tmp_file.path
+            if key in remote_files:
+                # Drive allows the same name twice in one folder.
+                with self._cache_lock:
+                    self._duplicate_paths.add((remote, key))
+                key = key + ClSync.duplicate_suffix
+            remote_files[key] = tmp_file
+        if use_memory:
+            self._cache[cache_key] = (time.monotonic(), remote_files)
+        return remote_files
+
+    def _merge_listing(self, files, remote_files, with_dups, regexp, md5s, stop_after_first):
+        """Add one remote's listing to ``files``; True when the first hit ends the listing."""
+        for remote_key in remote_files:
+            key = remote_key
+            if key.endswith(ClSync.duplicate_suffix):
+                key = key[:-len(ClSync.duplicate_suffix)]
+            if regexp is not None and regexp.search(key) is None:
+                logging.debug('skipping ' + key + '...')
+                continue
+            tmp_file = remote_files[remote_key]
+            if self._compare_method == 'md5' and not tmp_file.is_dir:
+                # A cached listing can hold files that md5sum no longer returns.
+                tmp_file.md5 = md5s.get(key)
+            if with_dups and tmp_file.is_dir is False and key in files:
+                key = key + ClSync.duplicate_suffix
+            files[key] = tmp_file
+            if stop_after_first and len(files) > 0:
+                return True
+        return False
+
+    def _cached_listing(self, remote, path, recursive=True):
+        """Return the lsjson rows of ``remote`` + ``path``, from the registry file index when fresh."""
+        use_registry = self._config['no_cache'] is False and self._sa_registry is not None
+        if use_registry:
+            rows = self._sa_registry.cached_listing_for_remote(remote, path, recursive, self._sa_refresh)
+            if rows is not None:
                 logging.debug('serving cached lsjson for ' + remote + path)
-                return self._json_for_listing_depth(cached["json_text"], recursive)
-            parent_json = self._json_from_cached_parent(remote, path, recursive)
-            if parent_json is not None:
-                logging.debug('serving parent cached lsjson for ' + remote + path)
-                return parent_json
+                return rows
+            if recursive and self._ls_delta:
+                rows = self._delta_listing(remote, path)
+                if rows is not None:
+                    return rows
         extra_args = ['--fast-list']
         if recursive:
             extra_args.insert(0, '--recursive')
         try:
-            json_out = self._rclone.lsjson(remote, path, extra_args, True)
+            rows = list(self._lsjson_rows(remote, path, extra_args))
         except exceptions.FileNotFoundException as e:
-            json_out = '[]'
+            rows = []
         except Exception as e:
-            if self._config['no_cache'] is False and self._sa_registry is not None:
+            if use_registry:
                 self._sa_registry.update_ls_cache_for_remote(remote, path, None, str(e))
             raise
-        if recursive and self._config['no_cache'] is False and self._sa_registry is not None:
-            self._sa_registry.update_ls_cache_for_remote(remote, path, json_out, None)
-        return json_out
-
-    def _json_from_cached_parent(self, remote, path, recursive=True):
-        if path == '/':
+        if recursive and use_registry:
+            self._sa_registry.update_ls_cache_for_remote(remote, path, rows, None)
+        return rows
+
+    def _delta_listing(self, remote, path):
+        """Refresh the registry listing of ``remote`` + ``path`` with the files modified since it was taken.
+
+        Returns the merged rows, or None when a full listing is due: there is
+        no listing of ``path`` itself, the last full one is older than
+        ``ls_full_refresh_hours``, the remote's used bytes changed since, or
+        the delta listing failed. Deleted files, and files uploaded by other
+        tools with an older modification time, only show up at the next full
+        listing.
+        """
+        age = self._sa_registry.ls_delta_age_for_remote(remote, path, self._ls_full_refresh_hours)
+        if age is None:
             return None
-        root_cache = self._sa_registry.ls_cache_by_remote(remote, '/')
-        if root_cache is None:
-            return None
-        if self._sa_registry.should_refresh_ls_cache(root_cache, self._sa_refresh):
-            return None
-        prefix = path.strip('/')
+        max_age = str(int(age) + LS_DELTA_OVERLAP_SECONDS) + 's'
         try:
-            rows = json.loads(root_cache["json_text"])
-        except Exception:
+            rows = list(self._lsjson_rows(remote, path, ['--recursive', '--fast-list', '--max-age', max_age]))
+        except Exception as e:
+            logging.warning('delta listing of ' + remote + path + ' failed, listing it fully: ' + str(e))
             return None
-        filtered = []
-        for row in rows:
-            if not isinstance(row, dict):
-                continue
-            row_path = row.get("Path", "")
-            if row_path == prefix:
-                continue
-            if not row_path.startswith(prefix + '/'):
-                continue
-            copied = dict(row)
-            copied["Path"] = row_path[len(prefix) + 1:]
-            if not recursive and '/' in copied["Path"]:
-                continue
-            filtered.append(copied)
-        return json.dumps(filtered)
+        logging.debug('delta listing of ' + remote + path + ' returned ' + str(len(rows)) + ' entries')
+        self._sa_registry.merge_ls_cache_for_remote(remote, path, rows)
+        return self._sa_registry.cached_listing_for_remote(remote, path, True, 'none')
 
-    def _json_for_listing_depth(self, json_text, recursive=True):
-        if recursive:
-            return json_text
-        try:
-            rows = json.loads(json_text)
-        except Exception:
-            return json_text
-        if not isinstance(rows, list):
-            return json_text
-        filtered = []
-        for row in rows:
-            if not isinstance(row, dict):
-                continue
-            if '/' in row.get("Path", ""):
-                continue
-            filtered.append(row)
-        return json.dumps(filtered)
+    def _lsjson_rows(self, remote, path, extra_args):
+        lsjson_rows = getattr(self._rclone, 'lsjson_rows', None)
+        if lsjson_rows is None:
+            # Backends that only return lsjson text.
+            return json.loads(self._rclone.lsjson(remote, path, extra_args, True))
+        return lsjson_rows(remote, path, extra_args, True)
 
     def _stop_after_first_success(self):
         return self._config.get('drive_id') not in (None, '')
 
-    def _store_memory_ls_cache(self, cache_key, files):
-        if self._config['no_cache'] is False:
-            self._cache[cache_key] = files
-            self._cache_counter[cache_key] = 0
-
     def lsmd5(self, file, stop_after_first=False, remotes=None, normalize_path=True):
         logging.debug('lsjson of file: ' + file)
         if normalize_path and not file.startswith('/'):
@@ -312,32 +400,42 @@ class ClSync:
         files = {}
         if remotes is None:
             remotes = self.get_remotes()
-        for remote in remotes:
-            common.print_line('retrieving file list from: ' + remote + file + '...')
-            logging.debug('getting lsjson from ' + remote + file)
-            try:
-                out = self._rclone.md5sum(remote, file, ['--fast-list'], True)
-            except exceptions.FileNotFoundException as e:
-                out = ''
-            #logging.debug('out: ' + str(out.split('\n')))
-            md5s = out.split('\n')
-            for line in md5s:
-                if line == '':
-                    continue
-                md5 = line.split('  ')[0]
-                filename = line.split('  ')[1]
-                files[file + '/' + filename] = md5
-            if stop_after_first and len(files) > 0:
-                break
+        listings = workers.ordered_map(
+            functools.partial(self._md5sum_remote, file),
+            remotes,
+            self._ls_workers,
+        )
+        try:
+            for remote, out in listings:
+                #logging.debug('out: ' + str(out.split('\n')))
+                md5s = out.split('\n')
+                for line in md5s:
+                    if line == '':
+                        continue
+                    md5 = line.split('  ')[0]
+                    filename = line.split('  ')[1]
+                    files[file + '/' + filename] = md5
+                if stop_after_first and len(files) > 0:
+                    break
+        finally:
+            listings.close()
         return files
 
+    def _md5sum_remote(self, file, remote):
+        common.print_line('retrieving file list from: ' + remote + file + '...')
+        logging.debug('getting lsjson from ' + remote + file)
+        try:
+            return self._rclone.md5sum(remote, file, ['--fast-list'], True)
+        except exceptions.FileNotFoundException as e:
+            return ''
+
     def get_sizes(self):
         logging.debug('getting sizes')
         if self._sizes is None:
             self._sizes = {}
+            quotas = self._get_remote_quotas(self.get_remotes())
             for remote in self.get_remotes():
-                quota = self._get_remote_quota(remote)
-                size = self._quota_value(quota, 'total')
+                size = self._quota_value(quotas[remote], 'total')
                 logging.debug('size of ' + remote + ' is ' + str(size))
                 self._sizes[remote] = size
         return self._sizes
@@ -345,10 +443,10 @@ class ClSync:
     def get_size(self):
         logging.debug('getting sizes')
         total_size = 0
+        quotas = self._get_remote_quotas(self.get_remotes()) if self._sizes is None else None
         for remote in self.get_remotes():
             if self._sizes is None:
-                quota = self._get_remote_quota(remote)
-                size = self._quota_value(quota, 'total')
+                size = self._quota_value(quotas[remote], 'total')
             else:
                 size = self._sizes[remote]
             logging.debug('size of ' + remote + ' is ' + str(size))
@@ -360,9 +458,9 @@ class ClSync:
         logging.debug('getting free sizes')
         if self._frees is None:
             self._frees = {}
+            quotas = self._get_remote_quotas(self.get_remotes())
             for remote in self.get_remotes():
-                quota = self._get_remote_quota(remote)
-                size = self._quota_value(quota, 'free')
+                size = self._quota_value(quotas[remote], 'free')
                 logging.debug('free of ' + remote + ' is ' + str(size))
                 self._frees[remote] = size
         return self._frees
@@ -370,10 +468,10 @@ class ClSync:
     def get_free(self):
         logging.debug('getting total free size')
         total_size = 0
+        quotas = self._get_remote_quotas(self.get_remotes()) if self._frees is None else None
         for remote in self.get_remotes():
             if self._frees is None:
-                quota = self._get_remote_quota(remote)
-                size = self._quota_value(quota, 'free')
+                size = self._quota_value(quotas[remote], 'free')
             else:
                 size = self._frees[remote]
             logging.debug('free of ' + remote + ' is ' + str(size))
@@ -384,9 +482,9 @@ class ClSync:
     def get_max_file_size(self):
         logging.debug('getting total maximum file size')
         total_size = 0
+        quotas = self._get_remote_quotas(self.get_remotes())
         for remote in self.get_remotes():
-            quota = self._get_remote_quota(remote)
-            size = self._quota_value(quota, 'free')
+            size = self._quota_value(quotas[remote], 'free')
             logging.debug('free of ' + remote + ' is ' + str(size))
             if size is not None and size > total_size:
                 total_size = size
@@ -437,7 +535,88 @@ class ClSync:
             # Unknown quota must be checked again for later files, not cached as capacity.
             if free_size is not None:
                 self._cached_free[remote] = free_size
-        return self._cached_free.get(remote)
+        free_size = self._cached_free.get(remote)
+        if free_size is not None and self._reservations is not None:
+            free_size -= self._reservations.reserved(remote)
+        return free_size
+
+    def refresh_remote_state(self):
+        """Re-read every remote's quota and drop the cached listings of remotes that changed.
+
+        Meant to run between daemon intervals: a remote whose used bytes are
+        unchanged keeps its listing, any other remote is listed again on the
+        next ``ls``. Every quota is read with a live ``about``: a registry
+        row can be hours old and would hide uploads from other hosts.
+        Returns the remotes whose listings were dropped.
+        """
+        changed = []
+        remotes = self.get_remotes()
+        quotas = dict(workers.ordered_map(
+            functools.partial(self._get_remote_quota, live=True),
+            remotes,
+            self._ls_workers,
+        ))
+        for remote in self.get_remotes():
+            quota = quotas[remote]
+            used = self._quota_value(quota, 'used')
+            free = self._quota_value(quota, 'free')
+            if self._distribution_type == 'mas':
+                if free is not None:
+                    self._cached_free[remote] = free
+                else:
+                    self._cached_free.pop(remote, None)
+            previous = self._remote_state.get(remote)
+            if used is None or previous != used:
+                if previous is not None or used is None:
+                    changed.append(remote)
+                    self._clear_memory_ls_cache(remote)
+                    if self._sa_registry is not None and self._ls_delta:
+                        # A delta only sees recently modified files, and the change may be an
+                        # upload with an old modification time: list the remote fully next.
+                        self._sa_registry.expire_ls_cache_for_remote(remote)
+                    elif self._sa_registry is not None:
+                        self._sa_registry.invalidate_ls_cache_for_remote(remote)
+            self._remote_state[remote] = used
+        if changed:
+            logging.info('remotes changed since the last run: ' + ', '.join(changed))
+        return changed
+
+    def _reserve_remote_space(self, remote, requested_size):
+        """Hold headroom on ``remote`` for an upload that is about to start.
+
+        Without concurrent transfers there is nothing to reserve and the call
+        always succeeds; the post-upload ``mark_remote_used`` keeps the books.
+        """
+        if self._reservations is None:
+            return True
+        required_size = self._required_free_for_upload(requested_size)
+        # Fetch an unknown quota outside the lock; the check below is cached.
+        self._known_free_for_remote(remote)
+        with self._reservations.lock:
+            free_size = self._known_free_for_remote(remote)
+            if free_size is None or free_size < required_size:
+                return False
+            self._reservations.add(remote, requested_size)
+        return True
+
+    def _release_remote_space(self, remote, reserved_size, used_size=0):
+        if self._reservations is None:
+            if used_size:
+                self.mark_remote_used(remote, used_size)
+            return
+        with self._reservations.lock:
+            if reserved_size:
+                self._reservations.release(remote, reserved_size)
+            if used_size:
+                self.mark_remote_used(remote, used_size)
+
+    @contextlib.contextmanager
+    def _remote_slot(self, remote):
+        if self._remote_slots is None:
+            yield
+            return
+        with self._remote_slots.slot(remote):
+            yield
 
     def _required_free_for_upload(self, requested_size):
         requested_size = int(requested_size)
@@ -455,8 +634,9 @@ class ClSync:
                 self._frees[remote] = max(0, self._frees[remote] - int(size))
         if self._sa_registry is not None:
             self._sa_registry.adjust_quota_for_remote(remote, int(size))
-            self._sa_registry.invalidate_ls_cache_for_remote(remote)
-        self._clear_memory_ls_cache()
+        if self._remote_state and self._remote_state.get(remote) is not None:
+            # The listings already carry this change; do not take it for an outside one.
+            self._remote_state[remote] += int(size)
 
     def mark_remote_quota_exhausted(self, remote):
         """Exclude a remote after Google confirms that its quota is exhausted."""
@@ -473,13 +653,23 @@ class ClSync:
             'drive storage quota has been exceeded' in text
         )
 
-    def _get_remote_quota(self, remote):
-        cached = None
+    def _get_remote_quotas(self, remotes):
+        """Return ``{remote: quota}``, reading the registry rows of all remotes in one query."""
+        cached = {}
         if self._sa_registry is not None:
-            cached = self._sa_registry.quota_by_remote(remote)
-            if cached is not None and not self._sa_registry.should_refresh(cached, self._sa_refresh):
+            cached = self._sa_registry.quotas_by_remote(remotes)
+        return dict((remote, self._get_remote_quota(remote, cached.get(remote))) for remote in remotes)
+
+    def _get_remote_quota(self, remote, cached=_LOOKUP, live=False):
+        """Return the quota of ``remote``; ``live`` skips a fresh registry row and always asks rclone."""
+        if self._sa_registry is None:
+            cached = None
+        else:
+            if cached is _LOOKUP:
+                cached = self._sa_registry.quota_by_remote(remote)
+            if not live and cached is not None and not self._sa_registry.should_refresh(cached, self._sa_refresh):
                 return self._quota_from_row(cached)
-            if cached is not None and self._sa_refresh == 'none':
+            if not live and cached is not None and self._sa_refresh == 'none':
                 return self._quota_from_row(cached)
         try:
             quota = self._rclone.get_about_json(remote, True)
@@ -510,59 +700,154 @@ class ClSync:
 
     def index_local_dir(self, local_dir, exclusion_list=None):
         common.print_line('indexing local directory: ' + local_dir + '...')
+        entries = local_index.scan(local_dir).entries
+        clfiles = self._local_clfiles(local_dir, entries, entries, self._local_path_filter(exclusion_list))
+        logging.debug('retrieved ' + str(len(clfiles)) + ' files')
+        return clfiles
+
+    def _local_path_filter(self, exclusion_list):
         if self.__exclude_regex is not None:
             regexp = re.compile(self.__exclude_regex)
         else:
             regexp = None
+
+        def include(full_path):
+            if exclusion_list is not None:
+                for exclusion in exclusion_list:
+                    if exclusion in full_path:
+                        logging.debug('exclusion ' + exclusion + ' applies for ' + full_path)
+                        return False
+            if regexp is not None and regexp.search(full_path) is not None:
+                logging.debug('regexp match for path: ' + full_path)
+                return False
+            return True
+
+        return include
+
+    def _local_clfiles(self, local_dir, entries, paths, include):
+        """Build ClFiles for ``paths`` of a ``local_index.scan`` result, hashing files when needed."""
+        included = [full_path for full_path in paths if full_path != local_dir and include(full_path)]
+        if self._compare_method == 'md5':
+            self._hash_local_files(local_dir, entries, [
+                full_path for full_path in included
+                if not entries[full_path].is_dir and entries[full_path].md5 is None
+            ])
         clfiles = {}
-        for root, dirs, files in os.walk(local_dir):
-            for name in dirs:
-                full_path = os.path.join(root, name).replace('\\', '/')
-                logging.debug('adding ' + full_path + ' to list')
-                if exclusion_list is not None:
-                    exclusion_found = False
-                    for exclusion in exclusion_list:
-                        if exclusion in full_path:
-                            exclusion_found = True
-                    if exclusion_found is True:
-                        logging.debug('exclusion ' + exclusion + ' applied for path ' + full_path)
-                        continue
-                if self.__exclude_regex is not None and regexp.search(full_path) is not None:
-                    logging.debug('regexp match for path: ' + full_path)
-                    continue
-                tmp_clfile = clfile.ClFile()
-                tmp_clfile.is_dir = True
-                tmp_clfile.path = os.path.dirname(full_path)
-                tmp_clfile.name = name
+        for full_path in included:
+            entry = entries[full_path]
+            logging.debug('adding ' + full_path + ' to list')
+            tmp_clfile = clfile.ClFile()
+            tmp_clfile.is_dir = entry.is_dir
+            tmp_clfile.path = os.path.dirname(full_path)
+            tmp_clfile.name = os.path.basename(full_path)
+            if entry.is_dir:
+                tmp_clfile.path = common.normalize_path(tmp_clfile.path)
                 tmp_clfile.size = "-1"
-                tmp_clfile.mod_time = os.stat(full_path).st_mtime
-                clfiles[common.normalize_path(tmp_clfile.path+'/'+tmp_clfile.name)] = tmp_clfile
-            for name in files:
-                full_path = os.path.join(root, name)
-                logging.debug('adding ' + full_path + ' to list')
-                if exclusion_list is not None:
-                    exclusion_found = False
-                    for exclusion in exclusion_list:
-                        if exclusion in full_path:
-                            exclusion_found = True
-                    if exclusion_found is True:
-                        logging.debug('exclusion ' + exclusion + ' applies for ' + full_path)
-                        continue
-                if self.__exclude_regex is not None and regexp.search(full_path) is not None:
-                    logging.debug('regexp match for path: ' + full_path)
-                    continue
-                tmp_clfile = clfile.ClFile()
-                tmp_clfile.is_dir = False
-                tmp_clfile.path = os.path.dirname(full_path)
-                tmp_clfile.name = name
-                tmp_clfile.size = os.stat(full_path).st_size
-                tmp_clfile.mod_time = os.stat(full_path).st_mtime
-                if self._compare_method == 'md5':
-                    tmp_clfile.md5 = common.get_md5(full_path)
-                clfiles[common.normalize_path(tmp_clfile.path+'/'+tmp_clfile.name)] = tmp_clfile
-        logging.debug('retrieved ' + str(len(clfiles)) + ' files')
+            else:
+                tmp_clfile.size = entry.size
+                tmp_clfile.md5 = entry.md5
+            tmp_clfile.mod_time = entry.mtime_ns / 1e9
+            clfiles[common.normalize_path(full_path)] = tmp_clfile
         return clfiles
 
+    def _hash_local_files(self, local_dir, entries, paths):
+        if self._hash_cache is None:
+            for full_path, md5 in self._md5_files(paths):
+                entries[full_path] = entries[full_path]._replace(md5=md5)
+            return
+        self._hash_cache.fill(entries, paths, self._md5_files)
+        self._hash_cache.evict(local_dir, entries)
+
+    def _md5_files(self, paths):
+        # hashlib releases the GIL while hashing, so threads use several cores and disks.
+        return workers.ordered_map(self._md5_file, paths, self._hash_workers)
+
+    def _md5_file(self, path):
+        return common.get_md5(path, fadvise=self._hash_fadvise)
+
+    def _scan_local_snapshot(self, local_dir, target):
+        root = os.path.abspath(local_dir) + '\n' + local_dir + '\n' + str(target or '')
+        previous, last_full_scan_at = self._local_snapshot.load(root)
+        full_scan = self._local_snapshot.full_scan_due(last_full_scan_at, self._local_snapshot_full_scan_hours)
+        if full_scan:
+            common.print_line('indexing local directory: ' + local_dir + ' (full scan)...')
+            scan = local_index.scan(local_dir)
+        else:
+            common.print_line('indexing local directory: ' + local_dir + ' (incremental)...')
+            scan = local_index.scan(local_dir, previous)
+            logging.debug('local snapshot: ' + str(len(scan.changed)) + ' changed, ' +
+                          str(len(scan.deleted)) + ' deleted')
+        return local_index.SnapshotRun(root, previous, scan, full_scan)
+
+    def _incremental_operations(
+            self,
+            local_dir,
+            snapshot_run,
+            local_clfiles,
+            remote_root,
+            target_remotes,
+            normalize_remote_path,
+            delete_files):
+        """Compare only the entries a snapshot reported as changed or deleted."""
+        remote_clfiles = self.ls_matching_local_files(
+            local_dir,
+            local_clfiles,
+            remote_root,
+            target_remotes,
+            normalize_remote_path,
+        )
+        ops = self.compare_clfiles_for_remote_root(local_dir, local_clfiles, remote_clfiles, False, remote_root)
+        if delete_files is not True:
+            return ops
+        include = self._local_path_filter(self.__exclusion_list)
+        to_remote_key = self._source_key_function(local_dir, remote_root)
+        wanted_by_parent = {}
+        for path in snapshot_run.scan.deleted:
+            # Never remove a remote copy of something that is still present locally.
+            if path == local_dir or os.path.lexists(path) or not include(path):
+                continue
+            remote_key = to_remote_key(path)
+            remote_parent = os.path.dirname(remote_key)
+            wanted_by_parent.setdefault(remote_parent, set()).add(remote_key)
+        removals = {}
+        for remote_parent in sorted(wanted_by_parent):
+            parent_files = self.ls_shallow(remote_parent, remotes=target_remotes, normalize_path=normalize_remote_path)
+            for remote_key in wanted_by_parent[remote_parent]:
+                if remote_key in parent_files:
+                    removals[remote_key] = parent_files[remote_key]
+        for remote_key in common.sort_dict_keys(removals, True):
+            remote_clfile = removals[remote_key]
+            logging.debug('file ' + remote_key + ' has been deleted')
+            remote_clfile.remote_path = os.path.dirname(remote_key).replace('\\', '/')
+            ops.append(operation.Operation(operation.Operation.REMOVE, remote_clfile, None))
+        common.print_line('found ' + str(len(removals)) + ' deletions')
+        return ops
+
+    def _commit_local_snapshot(self, snapshot_run, failed_ops):
+        """Persist the scan, leaving out files whose operation failed so they are retried."""
+        entries = snapshot_run.scan.entries
+        deleted = snapshot_run.scan.deleted
+        pending = []
+        for op in failed_ops:
+            if op.operation == operation.Operation.REMOVE:
+                # Keep the deleted paths so the next run tries the removal again.
+                deleted = []
+            else:
+                pending.append(op.src.path + '/' + op.src.name)
+        min_mtime_ns = int((time.time() - local_index.MIN_AGE_SECONDS) * 1e9)
+        pending.extend(path for path, entry in entries.items()
+                       if not entry.is_dir and entry.mtime_ns > min_mtime_ns)
+        for path in pending:
+            entries.pop(path, None)
+            parent = os.path.dirname(path)
+            if parent in entries:
+                entries[parent] = entries[parent]._replace(mtime_ns=-1)
+        if snapshot_run.full_scan:
+            paths = list(entries)
+        else:
+            paths = [path for path, entry in entries.items() if snapshot_run.previous.get(path) != entry]
+        self._local_snapshot.save(snapshot_run.root, entries, paths, deleted, snapshot_run.full_scan)
+
     def index_remote_dir(self, remote, remote_path, exclusion_list=None):
         source = remote + remote_path
         common.print_line('indexing rclone remote: ' + source + '...')
@@ -571,11 +856,7 @@ class ClSync:
         else:
             regexp = None
         clfiles = {}
-        try:
-            json_out = self._rclone.lsjson(remote, remote_path, ['--recursive', '--fast-list'], True)
-        except exceptions.FileNotFoundException:
-            json_out = '[]'
-        rows = json.loads(json_out)
+        rows = self._lsjson_rows(remote, remote_path, ['--recursive', '--fast-list'])
         for row in rows:
             if not isinstance(row, dict):
                 continue
@@ -632,6 +913,11 @@ class ClSync:
             delete_file=True,
             remote_root=None,
             source_is_remote=False):
+        """Diff a source index against a remote listing in one merge pass over sorted remote keys.
+
+        ADD and UPDATE operations come out in remote key order, followed by
+        REMOVE operations in reverse key order (files before their directories).
+        """
         common.print_line('calculating differences...')
         logging.debug('comparing clfiles')
         logging.debug('local directory: ' + local_dir)
@@ -639,77 +925,78 @@ class ClSync:
         logging.debug('remote clfiles size: ' + str(len(remote_clfiles)))
         if remote_root is None:
             remote_root = self.get_backup_remote_root(local_dir)
-        local_remote_keys = {}
-        for local_path in local_clfiles:
-            local_clfile = local_clfiles[local_path]
-            full_path = local_clfile.path + '/' + local_clfile.name
-            remote_key = self.remote_key_for_source_path(local_dir, full_path, remote_root, source_is_remote)
-            local_remote_keys[remote_key] = local_clfile
+        if self._compare_method not in ('size', 'md5'):
+            logging.error('compare_method: ' + self._compare_method + ' not valid!')
+            raise Exception('compare_method: ' + self._compare_method + ' not valid!')
+        to_remote_key = self._source_key_function(local_dir, remote_root, source_is_remote)
+        local_side = sorted(
+            (to_remote_key(local_clfile.path + '/' + local_clfile.name), local_path)
+            for local_path, local_clfile in local_clfiles.items()
+        )
+        remote_keys = sorted(remote_clfiles)
         operations = []
-        for local_path in local_clfiles:
+        removals = []
+        remote_index = 0
+        remote_count = len(remote_keys)
+        matched = None
+        for remote_name, local_path in local_side:
+            while remote_index < remote_count and remote_keys[remote_index] < remote_name:
+                removals.append(remote_keys[remote_index])
+                remote_index += 1
+            if remote_index < remote_count and remote_keys[remote_index] == remote_name:
+                matched = remote_name
+                remote_index += 1
+            exists = matched == remote_name
             local_clfile = local_clfiles[local_path]
             if local_clfile.is_dir:
                 continue
-            remote_name = self.remote_key_for_source_path(
-                local_dir,
-                local_clfile.path + '/' + local_clfile.name,
-                remote_root,
-                source_is_remote,
-            )
-            remote_path = os.path.dirname(remote_name).replace('\\', '/')
-            if remote_name not in remote_clfiles:
+            remote_path = os.path.dirname(remote_name)
+            if not exists:
                 logging.debug('compare file local=%s remote=%s result=add', local_path, remote_name)
                 local_clfile.remote_path = remote_path
-                op = operation.Operation(operation.Operation.ADD,
-                                         local_clfile, None)
-                operations.append(op)
+                operations.append(operation.Operation(operation.Operation.ADD, local_clfile, None))
+                continue
+            logging.debug('compare file local=%s remote=%s result=existing', local_path, remote_name)
+            remote_clfile = remote_clfiles[remote_name]
+            if self._compare_method == 'size':
+                changed = local_clfile.size != remote_clfile.size
             else:
-                logging.debug('compare file local=%s remote=%s result=existing', local_path, remote_name)
-                remote_clfile = remote_clfiles[remote_name]
-                if self._compare_method == 'size':
-                    size_local = local_clfile.size
-                    size_remote = remote_clfile.size
-                    current_remote = remote_clfiles[remote_name].remote
-                    logging.debug('local_file.size:' + str(local_clfile.size) +
-                                  ', remote_clfile.size:' + str(remote_clfile.size))
-                    if size_local != size_remote:
-                        logging.debug('file has changed')
-                        local_clfile.remote_path = remote_path
-                        local_clfile.remote = current_remote
-                        op = operation.Operation(operation.Operation.UPDATE,
-                                                 local_clfile, None)
-                        operations.append(op)
-                elif self._compare_method == 'md5':
-                    local_md5 = local_clfile.md5
-                    remote_md5 = remote_clfile.md5
-                    current_remote = remote_clfiles[remote_name].remote
-                    logging.debug('local_file.md5:' + str(local_md5) +
-                                  ', remote_clfile.md5:' + str(remote_md5))
-                    if local_md5 != remote_md5:
-                        logging.debug('file has changed')
-                        local_clfile.remote_path = remote_path
-                        local_clfile.remote = current_remote
-                        op = operation.Operation(operation.Operation.UPDATE,
-                                                 local_clfile, None)
-                        operations.append(op)
-                else:
-                    logging.error('compare_method: ' + self._compare_method + ' not valid!')
-                    raise Exception('compare_method: ' + self._compare_method + ' not valid!')
+                changed = local_clfile.md5 != remote_clfile.md5
+            if changed:
+                logging.debug('file has changed')
+                local_clfile.remote_path = remote_path
+                local_clfile.remote = remote_clfile.remote
+                operations.append(operation.Operation(operation.Operation.UPDATE, local_clfile, None))
+        removals.extend(remote_keys[remote_index:])
 
         if delete_file is True:
-            reverse_keys = common.sort_dict_keys(remote_clfiles, True)
-            for remote_path in reverse_keys:
+            for remote_path in reversed(removals):
+                logging.debug('file ' + remote_path + ' has been deleted')
                 remote_clfile = remote_clfiles[remote_path]
-                logging.debug('checking file ' + remote_path + ' for deletion')
-                if remote_path not in local_remote_keys:
-                    logging.debug('file ' + remote_path + ' has been deleted')
-                    remote_clfile.remote_path = os.path.dirname(remote_path).replace('\\', '/')
-                    op = operation.Operation(operation.Operation.REMOVE,
-                                             remote_clfile, None)
-                    operations.append(op)
+                remote_clfile.remote_path = os.path.dirname(remote_path).replace('\\', '/')
+                operations.append(operation.Operation(operation.Operation.REMOVE, remote_clfile, None))
         common.print_line('found ' + str(len(operations)) + ' differences')
         return operations
 
+    def _source_key_function(self, source_root, remote_root, source_is_remote=False):
+        """Return ``path -> remote key`` for paths below ``source_root``.
+
+        The root is normalized once and the relative part is sliced off, so
+        indexing does not pay ``realpath``/``relpath`` for every file. Paths
+        that do not start with the root use ``remote_key_for_source_path``.
+        """
+        root = source_root.replace('\\', '/').rstrip('/')
+        prefix = root + '/'
+        remote_prefix = remote_root.rstrip('/') + '/'
+
+        def to_remote_key(path):
+            path = path.replace('\\', '/')
+            if path.startswith(prefix) and '/./' not in path and '/../' not in path:
+                return remote_prefix + path[len(prefix):]
+            return self.remote_key_for_source_path(source_root, path, remote_root, source_is_remote)
+
+        return to_remote_key
+
     def ls_matching_local_files(
             self,
             local_dir,
@@ -720,18 +1007,14 @@ class ClSync:
             source_is_remote=False):
         if remote_root is None:
             remote_root = self.get_backup_remote_root(local_dir)
+        to_remote_key = self._source_key_function(local_dir, remote_root, source_is_remote)
         wanted_by_parent = {}
         for local_path in local_clfiles:
             local_clfile = local_clfiles[local_path]
             if local_clfile.is_dir:
                 continue
-            remote_key = self.remote_key_for_source_path(
-                local_dir,
-                local_clfile.path + '/' + local_clfile.name,
-                remote_root,
-                source_is_remote,
-            )
-            remote_parent = os.path.dirname(remote_key).replace('\\', '/')
+            remote_key = to_remote_key(local_clfile.path + '/' + local_clfile.name)
+            remote_parent = os.path.dirname(remote_key)
             wanted_by_parent.setdefault(remote_parent, set()).add(remote_key)
 
         remote_clfiles = {}
@@ -742,7 +1025,7 @@ class ClSync:
                     remote_clfiles[remote_key] = parent_files[remote_key]
         return remote_clfiles
 
-    def backup(self, local_dir, delete_files=True, dry_run=False, target=None):
+    def backup(self, local_dir, delete_files=True, dry_run=False, target=None, resume=False):
         logging.debug('backing up directory ' + local_dir)
         source_remote, source_path = self.parse_backup_target(local_dir)
         source_is_remote = source_remote is not None
@@ -760,38 +1043,36 @@ class ClSync:
         else:
             remote_root = target_path
         logging.debug('backup remote root: ' + remote_root)
-        if source_is_remote:
-            local_clfiles = self.index_remote_dir(source_remote, source_path, self.__exclusion_list)
-            source_root = source_remote + source_path
-        else:
-            local_clfiles = self.index_local_dir(local_dir, self.__exclusion_list)
-            source_root = local_dir
-        target_remotes = [target_remote] if target_remote is not None else None
-        normalize_remote_path = target_remote is None
-        if delete_files is True or self._compare_method == 'md5':
-            remote_clfiles = self.ls(remote_root, remotes=target_remotes, normalize_path=normalize_remote_path)
+        if self._hash_cache is not None:
+            self._hash_cache.reset_stats()
+        backup_journal = None
+        resumed = None
+        if dry_run is False:
+            backup_journal = self._backup_journal()
+        if backup_journal is not None:
+            run_key = local_dir if source_is_remote else os.path.abspath(local_dir)
+            run_key += '\n' + str(target or '')
+            if resume:
+                resumed = backup_journal.resume(run_key)
+                if resumed is None:
+                    common.print_line('no unfinished backup of ' + local_dir + ' in the journal, starting over')
+        if resumed is not None:
+            snapshot_run = None
+            ops = [op for _seq, op in resumed.ops]
+            common.print_line('resuming backup of ' + local_dir + ': ' + str(len(ops)) + ' of ' +
+                              str(resumed.total) + ' operations left')
         else:
-            remote_clfiles = self.ls_matching_local_files(
-                source_root,
-                local_clfiles,
-                remote_root,
-                target_remotes,
-                normalize_remote_path,
-                source_is_remote,
-            )
-        ops = self.compare_clfiles_for_remote_root(
-            source_root,
-            local_clfiles,
-            remote_clfiles,
-            delete_files,
-            remote_root,
-            source_is_remote,
-        )
+            ops, snapshot_run = self._backup_operations(
+                local_dir, source_remote, source_path, target, target_remote, remote_root, delete_files)
         if self._show_progress:
             bar = Bar('Progress', max=len(ops), suffix='%(index)d/%(max)d %(percent)d%% [%(elapsed_td)s/%(eta_td)s]')
+        else:
+            bar = None
         if dry_run is True:
             common.print_line('performing a dry run. no changes are committed')
         failures = []
+        failed_ops = []
+        failed_ids = set()
 
         def record_failure(op, error, remotes=None):
             error_text = re.sub(
@@ -805,90 +1086,568 @@ class ClSync:
                 detail += ' [' + ', '.join(remotes) + ']'
             detail += ': ' + error_text
             failures.append(detail)
+            failed_ops.append(op)
+            failed_ids.add(id(op))
             logging.error('backup operation failed: ' + detail)
 
-        for op in ops:
+        if resumed is None and self._placement_strategy == 'pack' and target_remote is None:
+            self._plan_placement(ops)
+        run_id = None
+        journal_seqs = {}
+        if backup_journal is not None:
+            if resumed is None:
+                run_id = backup_journal.begin(run_key, remote_root, ops, self._journal_accounts())
+                journal_seqs = dict((id(op), seq) for seq, op in enumerate(ops))
+            else:
+                run_id = resumed.run_id
+                journal_seqs = dict((id(op), seq) for seq, op in resumed.ops)
+                ops = self._resume_remotes(ops, resumed.accounts, record_failure)
+
+        def complete(done_ops):
+            if backup_journal is not None:
+                backup_journal.complete(run_id, [journal_seqs[id(op)] for op in done_ops if id(op) not in failed_ids])
+
+        bar_lock = threading.Lock()
+
+        def run_operation(op):
             logging.debug('operation: ' + op.operation + ", path: " + op.src.path)
-            if self._show_progress:
+            if bar is not None:
                 bar_title = op.src.name.ljust(25, '.')
                 if len(bar_title) > 25:
                     bar_title = bar_title[0:25]
-                bar.message = 'file:' + bar_title
-            if op.src.is_dir and op.operation != operation.Operation.REMOVE:
-                logging.debug('skipping directory ' + op.src.path)
+                with bar_lock:
+                    bar.message = 'file:' + bar_title
+            self._backup_operation(op, delete_files, dry_run, target_remote, record_failure)
+            complete([op])
+            if bar is not None:
+                with bar_lock:
+                    bar.next()
+
+        concurrent = self._transfer_workers > 1 and dry_run is False
+        if concurrent:
+            self._reservations = workers.CapacityReservations()
+            self._remote_slots = workers.RemoteSlots(self._transfer_workers_per_remote)
+        try:
+            if self._batch_transfers and dry_run is False:
+                batch_ops = ops
+                ops = self._backup_batches(ops, target_remote, record_failure, bar)
+                if delete_files is True:
+                    ops = self._backup_deletes(ops, bar)
+                remaining = set(id(op) for op in ops)
+                complete([op for op in batch_ops if id(op) not in remaining])
+            if concurrent:
+                # Directories are removed once the files below them are gone.
+                dir_ops = [op for op in ops if op.src.is_dir and op.operation == operation.Operation.REMOVE]
+                file_ops = [op for op in ops if not (op.src.is_dir and op.operation == operation.Operation.REMOVE)]
+                workers.run_jobs(
+                    [functools.partial(run_operation, op) for op in file_ops],
+                    self._transfer_workers,
+                )
+                for op in dir_ops:
+                    run_operation(op)
             else:
-                if op.operation == operation.Operation.ADD:
-                    candidates = None
-                    try:
-                        if target_remote is None:
-                            candidates = self.get_eligible_remotes(int(op.src.size))
-                        else:
-                            candidates = [target_remote]
-                        if not candidates:
-                            raise Exception('no remote has enough known free space')
-                        if dry_run is True:
-                            candidates = candidates[:1]
-                        copied = False
-                        errors = []
-                        for remote in candidates:
-                            logging.debug('trying remote: ' + remote)
-                            if not self._show_progress:
-                                common.print_line('backing up file ' + op.src.path + '/' + op.src.name +
-                                                  ' -> ' + remote + op.src.remote_path)
-                            if dry_run is True:
-                                copied = True
-                                break
-                            try:
-                                self.copy(op.src.path + '/' + op.src.name, op.src.remote_path, remote)
-                                if target_remote is None:
-                                    self.mark_remote_used(remote, int(op.src.size))
-                                copied = True
-                                break
-                            except Exception as e:
-                                errors.append(e)
-                                if self._is_storage_quota_exceeded(e):
-                                    self.mark_remote_quota_exhausted(remote)
-                                    logging.warning('copy to ' + remote + ' failed: storage quota exceeded; marking remote full')
-                                else:
-                                    logging.warning('copy to ' + remote + ' failed: ' + str(e))
-                        if not copied:
-                            raise Exception('; '.join(str(error) for error in errors))
-                    except Exception as e:
-                        record_failure(op, e, candidates)
-                elif op.operation == operation.Operation.UPDATE:
-                    try:
-                        if target_remote is None:
-                            self.ensure_remote_has_enough_space(op.src.remote, int(op.src.size))
-                        if not self._show_progress:
-                            common.print_line('backing up file ' + op.src.path + '/' + op.src.name +
-                                              ' -> ' + op.src.remote + ':' + op.src.remote_path)
-                        if dry_run is False:
-                            self.copy(op.src.path + '/' + op.src.name, op.src.remote_path, op.src.remote)
-                    except Exception as e:
-                        if self._is_storage_quota_exceeded(e):
-                            self.mark_remote_quota_exhausted(op.src.remote)
-                        record_failure(op, e, [op.src.remote])
-                elif op.operation == operation.Operation.REMOVE and delete_files is True:
-                    try:
-                        if not self._show_progress:
-                            common.print_line('removing ' + op.src.remote + op.src.path)
-                        if dry_run is False:
-                            if op.src.is_dir:
-                                self.rmdir(op.src.path, op.src.remote)
-                            else:
-                                self.delete_file(op.src.path, op.src.remote)
-                    except Exception as e:
-                        record_failure(op, e, [op.src.remote])
-            if self._show_progress:
-                bar.next()
-        if self._show_progress:
+                for op in ops:
+                    run_operation(op)
+        finally:
+            self._reservations = None
+            self._remote_slots = None
+        if bar is not None:
             bar.finish()
+        if snapshot_run is not None and dry_run is False:
+            self._commit_local_snapshot(snapshot_run, failed_ops)
+        if backup_journal is not None:
+            pending = backup_journal.finish(run_id)
+            if pending:
+                common.print_line(str(pending) + ' operation(s) left in the backup journal; '
+                                  'run backup --resume to retry them')
+        if self._hash_cache is not None and not source_is_remote:
+            common.print_line('md5 cache: ' + str(self._hash_cache.hits) + ' hits, ' +
+                              str(self._hash_cache.misses) + ' misses')
         if failures:
             raise Exception(
                 'backup completed with ' + str(len(failures)) + ' failed operation(s): ' +
                 ' | '.join(failures)
             )
 
+    def _backup_journal(self):
+        if self._journal_db is None:
+            return None
+        if self._journal is None:
+            self._journal = journal.BackupJournal(self._journal_db)
+        return self._journal
+
+    def _journal_accounts(self):
+        """Account ids of the cluster remotes; remote names can change between runs."""
+        if self._sa_registry is None:
+            return {}
+        return dict((remote, self._sa_registry.account_id_for_remote(remote)) for remote in self.get_remotes())
+
+    def _resume_remotes(self, ops, accounts, record_failure):
+        """Rename the remotes of journaled ``ops`` to the current names of the same accounts.
+
+        A planned remote whose account left the cluster is dropped so the
+        file is placed again; updates and removals on such a remote fail.
+        """
+        if not any(account_id is not None for account_id in accounts.values()):
+            return ops
+        current = dict((account_id, remote) for remote, account_id in self._journal_accounts().items())
+
+        def translate(remote):
+            if accounts.get(remote) is None:
+                return remote
+            return current.get(accounts[remote])
+
+        resumed = []
+        for op in ops:
+            if op.operation == operation.Operation.ADD:
+                if op.dst not in (None, placement.UNPLACED):
+                    op.dst = translate(op.dst)
+            elif op.src.remote is not None:
+                remote = translate(op.src.remote)
+                if remote is None:
+                    record_failure(op, Exception('remote ' + op.src.remote + ' of the journaled run is not '
+                                                 'part of the cluster anymore'), [op.src.remote])
+                    continue
+                op.src.remote = remote
+            resumed.append(op)
+        return resumed
+
+    def _backup_operations(
+            self, local_dir, source_remote, source_path, target, target_remote, remote_root, delete_files):
+        """Index the source, list the remote side and return ``(ops, snapshot_run)``."""
+        source_is_remote = source_remote is not None
+        snapshot_run = None
+        if source_is_remote:
+            local_clfiles = self.index_remote_dir(source_remote, source_path, self.__exclusion_list)
+            source_root = source_remote + source_path
+        elif self._local_snapshot is not None:
+            snapshot_run = self._scan_local_snapshot(local_dir, target)
+            entries = snapshot_run.scan.entries
+            local_clfiles = self._local_clfiles(
+                local_dir,
+                entries,
+                entries if snapshot_run.full_scan else snapshot_run.scan.changed,
+                self._local_path_filter(self.__exclusion_list),
+            )
+            source_root = local_dir
+        else:
+            local_clfiles = self.index_local_dir(local_dir, self.__exclusion_list)
+            source_root = local_dir
+        target_remotes = [target_remote] if target_remote is not None else None
+        normalize_remote_path = target_remote is None
+        if snapshot_run is not None and not snapshot_run.full_scan:
+            ops = self._incremental_operations(
+                source_root,
+                snapshot_run,
+                local_clfiles,
+                remote_root,
+                target_remotes,
+                normalize_remote_path,
+                delete_files,
+            )
+        else:
+            if delete_files is True or self._compare_method == 'md5':
+                remote_clfiles = self.ls(remote_root, remotes=target_remotes, normalize_path=normalize_remote_path)
+            else:
+                remote_clfiles = self.ls_matching_local_files(
+                    source_root,
+                    local_clfiles,
+                    remote_root,
+                    target_remotes,
+                    normalize_remote_path,
+                    source_is_remote,
+                )
+            ops = self.compare_clfiles_for_remote_root(
+                source_root,
+                local_clfiles,
+                remote_clfiles,
+                delete_files,
+                remote_root,
+                source_is_remote,
+            )
+        return ops, snapshot_run
+
+    def _backup_operation(self, op, delete_files, dry_run, target_remote, record_failure):
+        if op.src.is_dir and op.operation != operation.Operation.REMOVE:
+            logging.debug('skipping directory ' + op.src.path)
+        elif op.operation == operation.Operation.ADD:
+            self._backup_add(op, dry_run, target_remote, record_failure)
+        elif op.operation == operation.Operation.UPDATE:
+            self._backup_update(op, dry_run, target_remote, record_failure)
+        elif op.operation == operation.Operation.REMOVE and delete_files is True:
+            self._backup_remove(op, dry_run, record_failure)
+
+    def _backup_add(self, op, dry_run, target_remote, record_failure):
+        candidates = None
+        try:
+            if target_remote is None and op.dst == placement.UNPLACED:
+                raise Exception('no remote has enough known free space in the placement plan')
+            if target_remote is None:
+                candidates = self.get_eligible_remotes(int(op.src.size))
+                if op.dst is not None:
+                    # The planned remote first; the others remain fallbacks after a failed copy.
+                    candidates = [op.dst] + [remote for remote in candidates if remote != op.dst]
+            else:
+                candidates = [target_remote]
+            if not candidates:
+                raise Exception('no remote has enough known free space')
+            if dry_run is True:
+                candidates = candidates[:1]
+            size = int(op.src.size)
+            copied = False
+            errors = []
+            for remote in candidates:
+                logging.debug('trying remote: ' + remote)
+                if not self._show_progress:
+                    common.print_line('backing up file ' + op.src.path + '/' + op.src.name +
+                                      ' -> ' + remote + op.src.remote_path)
+                if dry_run is True:
+                    copied = True
+                    break
+                reserved = 0
+                if target_remote is None:
+                    if not self._reserve_remote_space(remote, size):
+                        errors.append(Exception('remote ' + remote + ' has no unreserved free space left'))
+                        continue
+                    reserved = size
+                try:
+                    with self._remote_slot(remote):
+                        self.copy(op.src.path + '/' + op.src.name, op.src.remote_path, remote)
+                except Exception as e:
+                    self._release_remote_space(remote, reserved)
+                    errors.append(e)
+                    if self._is_storage_quota_exceeded(e):
+                        self.mark_remote_quota_exhausted(remote)
+                        logging.warning('copy to ' + remote + ' failed: storage quota exceeded; marking remote full')
+                    else:
+                        logging.warning('copy to ' + remote + ' failed: ' + str(e))
+                    continue
+                if target_remote is None:
+                    self._release_remote_space(remote, reserved, size)
+                if not self._modified_recently(op.src):
+                    self._patch_ls_caches(remote, added=[self._uploaded_entry(op.src, op.src.remote_path)])
+                copied = True
+                break
+            if not copied:
+                raise Exception('; '.join(str(error) for error in errors))
+        except Exception as e:
+            record_failure(op, e, candidates)
+
+    def _backup_update(self, op, dry_run, target_remote, record_failure):
+        try:
+            size = int(op.src.size)
+            if target_remote is None:
+                self.ensure_remote_has_enough_space(op.src.remote, size)
+            if not self._show_progress:
+                common.print_line('backing up file ' + op.src.path + '/' + op.src.name +
+                                  ' -> ' + op.src.remote + ':' + op.src.remote_path)
+            if dry_run is False:
+                reserved = 0
+                if target_remote is None:
+                    if not self._reserve_remote_space(op.src.remote, size):
+                        raise Exception('remote ' + op.src.remote + ' has no unreserved free space left')
+                    reserved = size
+                try:
+                    with self._remote_slot(op.src.remote):
+                        self.copy(op.src.path + '/' + op.src.name, op.src.remote_path, op.src.remote)
+                finally:
+                    self._release_remote_space(op.src.remote, reserved)
+                if not self._modified_recently(op.src):
+                    self._patch_ls_caches(op.src.remote, added=[self._uploaded_entry(op.src, op.src.remote_path)])
+        except Exception as e:
+            if self._is_storage_quota_exceeded(e):
+                self.mark_remote_quota_exhausted(op.src.remote)
+            record_failure(op, e, [op.src.remote])
+
+    def _backup_remove(self, op, dry_run, record_failure):
+        try:
+            if not self._show_progress:
+                common.print_line('removing ' + op.src.remote + op.src.path)
+            if dry_run is False:
+                with self._remote_slot(op.src.remote):
+                    if op.src.is_dir:
+                        self.rmdir(op.src.path, op.src.remote)
+                    else:
+                        self.delete_file(op.src.path, op.src.remote)
+        except Exception as e:
+            record_failure(op, e, [op.src.remote])
+
+    def _backup_batches(self, ops, target_remote, record_failure, bar=None):
+        """Upload ADD/UPDATE operations with one ``--files-from`` transfer per group.
+
+        Operations are grouped by target remote, source directory and remote
+        directory. Files that fail inside a batch, and groups holding a single
+        file, are returned so the caller runs them through the per-file path,
+        which retries other remotes and records failures.
+        """
+        groups = {}
+        remaining = []
+        planned = {}
+        for op in ops:
+            if op.src.is_dir or op.operation not in (operation.Operation.ADD, operation.Operation.UPDATE):
+                remaining.append(op)
+                continue
+            size = int(op.src.size)
+            if op.operation == operation.Operation.UPDATE:
+                remote = op.src.remote
+                if target_remote is None:
+                    try:
+                        self.ensure_remote_has_enough_space(remote, size)
+                    except Exception as e:
+                        record_failure(op, e, [remote])
+                        if bar is not None:
+                            bar.next()
+                        continue
+            elif target_remote is not None:
+                remote = target_remote
+            elif op.dst == placement.UNPLACED:
+                remaining.append(op)
+                continue
+            elif op.dst is not None:
+                remote = op.dst
+            else:
+                remote = self._plan_batch_remote(size, planned)
+                if remote is None:
+                    remaining.append(op)
+                    continue
+                planned[remote] = planned.get(remote, 0) + size
+            key = (remote, op.src.path, op.src.remote_path)
+            groups.setdefault(key, []).append(op)
+
+        jobs = []
+        for key in sorted(groups):
+            group = groups[key]
+            if len(group) < 2:
+                remaining.extend(group)
+                continue
+            jobs.append(functools.partial(self._run_batch, key, group, target_remote))
+        for failed_ops, group_size in workers.run_jobs(jobs, self._transfer_workers):
+            if bar is not None:
+                for _ in range(group_size - len(failed_ops)):
+                    bar.next()
+            remaining.extend(failed_ops)
+        return remaining
+
+    def _backup_deletes(self, ops, bar=None):
+        """Run REMOVE operations with one ``rclone delete --files-from-raw`` per remote.
+
+        Afterwards the removed directories are pruned with one ``rclone
+        rmdirs`` per top-most directory. Files rclone reports as failed,
+        remotes with a single file to remove, and directories that still hold
+        such a file are returned with the other operations; the per-file path
+        then removes them one by one and records each failure. So are paths a
+        listing returned more than once: rclone deletes by name, and would
+        remove every Drive duplicate of the path, including one that is kept.
+        """
+        files = {}
+        dirs = {}
+        remaining = []
+        for op in ops:
+            if op.operation != operation.Operation.REMOVE:
+                remaining.append(op)
+            elif op.src.is_dir:
+                dirs.setdefault(op.src.remote, []).append(op)
+            elif (op.src.remote, op.src.path) in self._duplicate_paths:
+                remaining.append(op)
+            else:
+                files.setdefault(op.src.remote, []).append(op)
+
+        jobs = []
+        for remote in sorted(files):
+            if len(files[remote]) < 2:
+                remaining.extend(files[remote])
+                continue
+            jobs.append(functools.partial(self._run_delete_batch, remote, files[remote]))
+        for failed_ops, group_size in workers.run_jobs(jobs, self._transfer_workers):
+            if bar is not None:
+                for _ in range(group_size - len(failed_ops)):
+                    bar.next()
+            remaining.extend(failed_ops)
+
+        # A directory above a file that is still there cannot be removed yet.
+        blocked = set()
+        for op in remaining:
+            if op.operation == operation.Operation.REMOVE and not op.src.is_dir:
+                path = self._remote_entry(op.src.path).path
+                while path != '/':
+                    path = path.rsplit('/', 1)[0] or '/'
+                    blocked.add((op.src.remote, path))
+        jobs = []
+        for remote in sorted(dirs):
+            prunable = {}
+            for op in dirs[remote]:
+                path = self._remote_entry(op.src.path).path
+                if (remote, path) in blocked:
+                    remaining.append(op)
+                else:
+                    prunable[path] = op
+            for path in sorted(prunable):
+                parent = path.rsplit('/', 1)[0] or '/'
+                if parent in prunable:
+                    continue
+                below = [op for other, op in prunable.items()
+                         if other == path or other.startswith(path + '/')]
+                jobs.append(functools.partial(self._run_rmdirs, remote, prunable[path].src.path, below))
+        for failed_ops, group_size in workers.run_jobs(jobs, self._transfer_workers):
+            if bar is not None:
+                for _ in range(group_size - len(failed_ops)):
+                    bar.next()
+            remaining.extend(failed_ops)
+        return remaining
+
+    def _run_delete_batch(self, remote, group):
+        entries = [self._remote_entry(op.src.path) for op in group]
+        root = entries[0].path.rsplit('/', 1)[0]
+        for entry in entries[1:]:
+            while root and not entry.path.startswith(root + '/'):
+                root = root.rsplit('/', 1)[0]
+        names = [entry.path[len(root) + 1:] for entry in entries]
+        if not group[0].src.path.startswith('/'):
+            # Explicit targets may be relative to the remote's home directory.
+            root = root[1:]
+        common.print_line('removing ' + str(len(group)) + ' files from ' + remote + (root or '/'))
+        try:
+            with self._remote_slot(remote):
+                failed, error = self._rclone.delete_files(remote, root, names)
+        except Exception as e:
+            failed, error = {}, str(e)
+        if error is not None:
+            logging.warning('batched delete on ' + remote + ' failed: ' + error)
+            return list(group), len(group)
+        failed_ops = []
+        removed = []
+        for op, entry, name in zip(group, entries, names):
+            if name in failed:
+                logging.warning('batched delete of ' + remote + op.src.path + ' failed: ' + failed[name])
+                failed_ops.append(op)
+            else:
+                removed.append(entry)
+        self._patch_ls_caches(remote, removed=removed)
+        return failed_ops, len(group)
+
+    def _run_rmdirs(self, remote, directory, group):
+        """Remove ``directory`` and the empty directories of ``group`` below it.
+
+        rmdirs keeps non-empty directories without an error, so only the
+        directories it logs as removed, and the root once a plain rmdir of it
+        succeeds, count as done and leave the cached listings. The others
+        are returned for the per-file path.
+        """
+        common.print_line('removing ' + str(len(group)) + ' directories below ' + remote + directory)
+        try:
+            with self._remote_slot(remote):
+                removed = set(self._rclone.rmdirs(remote, directory, True))
+        except Exception as e:
+            logging.warning('removing directories below ' + remote + directory + ' failed: ' + str(e))
+            return list(group), len(group)
+        root = self._remote_entry(directory).path
+        try:
+            with self._remote_slot(remote):
+                self._rclone.rmdir(remote, directory)
+            removed.add('')
+        except Exception as e:
+            logging.warning('directory ' + remote + directory + ' was not removed: ' + str(e))
+        failed_ops = []
+        gone = []
+        for op in group:
+            entry = self._remote_entry(op.src.path, is_dir=True)
+            if entry.path[len(root):].lstrip('/') in removed:
+                gone.append(entry)
+            else:
+                failed_ops.append(op)
+        self._patch_ls_caches(remote, removed=gone)
+        return failed_ops, len(group)
+
+    def _run_batch(self, key, group, target_remote):
+        remote, src_dir, remote_path = key
+        names = [op.src.name for op in group]
+        common.print_line('backing up ' + str(len(group)) + ' files from ' + src_dir +
+                          ' -> ' + remote + remote_path)
+        try:
+            with self._remote_slot(remote):
+                failed, error = self._rclone.copy_files(
+                    src_dir,
+                    remote + remote_path,
+                    names,
+                    move=self._rclone_move,
+                )
+        except Exception as e:
+            failed, error = {}, str(e)
+        if error is not None:
+            failed = dict((name, error) for name in names)
+        copied_bytes = 0
+        failed_ops = []
+        uploaded = []
+        for op in group:
+            message = failed.get(op.src.name)
+            if message == rclone.NOT_TRANSFERRED and self._modified_recently(op.src):
+                # Skipped by --min-age like a per-file copy; the next run tries again.
+                logging.debug('batched copy skipped ' + op.src.name + ': modified less than 6h ago')
+                continue
+            if message is None:
+                if op.operation == operation.Operation.ADD:
+                    copied_bytes += int(op.src.size)
+                if not self._modified_recently(op.src):
+                    uploaded.append(self._uploaded_entry(op.src, remote_path))
+                continue
+            if self._is_storage_quota_exceeded(message):
+                self.mark_remote_quota_exhausted(remote)
+            logging.warning('batched copy of ' + op.src.name + ' to ' + remote + ' failed: ' + message)
+            failed_ops.append(op)
+        if copied_bytes > 0 and target_remote is None:
+            self._release_remote_space(remote, 0, copied_bytes)
+        self._patch_ls_caches(remote, added=uploaded)
+        return failed_ops, len(group)
+
+    def _plan_placement(self, ops):
+        """Assign every new file of ``ops`` to a remote before any transfer starts.
+
+        The files are bin-packed into the known free space of the remotes
+        (``placement.pack``), keeping ``_required_free_for_upload`` headroom.
+        The chosen remote is stored in ``op.dst``; files that fit nowhere get
+        ``placement.UNPLACED`` and are reported here and failed when they run.
+        """
+        adds = [op for op in ops if op.operation == operation.Operation.ADD and not op.src.is_dir]
+        if not adds:
+            return None
+        free = dict((remote, self._known_free_for_remote(remote)) for remote in self.get_remotes())
+        plan = placement.pack(
+            dict((index, int(op.src.size)) for index, op in enumerate(adds)),
+            free,
+            self._required_free_for_upload,
+        )
+        for index, op in enumerate(adds):
+            op.dst = plan.assignments.get(index, placement.UNPLACED)
+        common.print_line(
+            'placement: ' + str(len(plan.assignments)) + ' new files (' + str(plan.packed_bytes) +
+            ' bytes) planned on ' + str(len(set(plan.assignments.values()))) + ' remotes'
+        )
+        if plan.unplaced:
+            unplaced_bytes = sum(int(adds[index].src.size) for index in plan.unplaced)
+            common.print_line(
+                'placement: ' + str(len(plan.unplaced)) + ' new files (' + str(unplaced_bytes) +
+                ' bytes) do not fit on any remote'
+            )
+            for index in plan.unplaced:
+                op = adds[index]
+                logging.warning('cannot place ' + op.src.path + '/' + op.src.name + ' (' + str(op.src.size) +
+                                ' bytes): no remote has enough known free space')
+        return plan
+
+    def _plan_batch_remote(self, size, planned):
+        required_size = self._required_free_for_upload(size)
+        best_remote = None
+        best_free = None
+        for remote in self.get_eligible_remotes(size):
+            free = self._known_free_for_remote(remote)
+            if free is None:
+                continue
+            free -= planned.get(remote, 0)
+            if free >= required_size and (best_free is None or free > best_free):
+                best_remote = remote
+                best_free = free
+        return best_remote
+
     def parse_backup_target(self, target):
         if target in (None, ''):
             return None, None
@@ -960,26 +1719,108 @@ class ClSync:
             self.copy_new(remote+os.path.dirname(path), local_dir)
 
 
-    def restore(self, remote_path, local_dir, dry_run=False):
+    def restore(self, remote_path, local_dir, dry_run=False, resume=False):
+        """Pull the files below ``remote_path`` from the remotes that hold them into ``local_dir``.
+
+        The cluster listing names the remote of every file, so each remote
+        holding files gets one ``rclone copy --files-from`` run with exactly
+        those files, up to ``transfer_workers`` remotes at a time. Restored
+        files are then checked against the listing by size, or by md5 with
+        ``compare_method=md5``. With ``resume``, files that are already in
+        ``local_dir`` and pass that check are not transferred again.
+        """
         logging.debug('restoring directory ' + local_dir + ' from ' + remote_path)
         if not common.is_dir(local_dir):
             #logging.error('directory ' + local_dir + ' not found')
             common.print_line('destination directory ' + local_dir + ' not found!')
             return
             #raise Exception('directory ' + local_dir + ' not found')
-        for remote in self.get_remotes():
-            common.print_line('restoring file ' + remote+remote_path + ' -> ' + local_dir)
-            logging.debug('restoring file ' + remote+remote_path + ' -> ' + local_dir)
-            if dry_run is False:
-                self.copy_new(remote+remote_path, local_dir, True)
+        root = remote_path if remote_path.startswith('/') else '/' + remote_path
+        remote_files = self.ls(root)
+        manifests = {}
+        for key in remote_files:
+            remote_file = remote_files[key]
+            if remote_file.is_dir:
+                continue
+            manifests.setdefault(remote_file.remote, []).append((key[len(root) + 1:], remote_file))
+        if resume:
+            restored = self._verify_restored(local_dir, [item for items in manifests.values() for item in items])
+            for remote in list(manifests):
+                manifests[remote] = [item for item in manifests[remote] if item[0] not in restored]
+                if not manifests[remote]:
+                    del manifests[remote]
+            common.print_line('restore: ' + str(len(restored)) + ' files already restored')
+        for remote in sorted(manifests):
+            common.print_line('restoring ' + str(len(manifests[remote])) + ' files ' + remote + root +
+                              ' -> ' + local_dir)
+        if dry_run is True:
+            common.print_line('performing a dry run. no changes are committed')
+            return
+        failures = {}
+        slots = workers.RemoteSlots(self._transfer_workers_per_remote)
+
+        def pull(remote):
+            names = [name for name, _remote_file in manifests[remote]]
+            try:
+                with slots.slot(remote):
+                    failed, error = self._rclone.copy_files(
+                        remote + root, local_dir, names, move=self._rclone_move, min_age=None)
+            except Exception as e:
+                failed, error = {}, str(e)
+            if error is not None:
+                failed = dict((name, error) for name in names)
+            # Files rclone found identical locally are left to the verification.
+            return dict((name, message) for name, message in failed.items() if message != rclone.NOT_TRANSFERRED)
+
+        for failed in workers.run_jobs([functools.partial(pull, remote) for remote in sorted(manifests)],
+                                       self._transfer_workers):
+            failures.update(failed)
+        items = [item for items in manifests.values() for item in items if item[0] not in failures]
+        verified = self._verify_restored(local_dir, items, failures)
+        common.print_line('restore: ' + str(len(verified)) + ' files restored and verified')
+        if failures:
+            details = [name + ': ' + str(failures[name])[:300] for name in sorted(failures)]
+            raise Exception(
+                'restore completed with ' + str(len(failures)) + ' failed file(s): ' + ' | '.join(details)
+            )
+
+    def _verify_restored(self, local_dir, items, failures=None):
+        """Return the names of ``(name, remote ClFile)`` items whose local copy matches the listing.
+
+        Mismatches are added to ``failures`` when it is given.
+        """
+        verified = set()
+        hashed = []
+        for name, remote_file in items:
+            path = os.path.join(local_dir, *name.split('/'))
+            try:
+                size = os.stat(path).st_size
+            except OSError:
+                if failures is not None:
+                    failures[name] = 'not found after restore'
+                continue
+            if remote_file.size is not None and size != int(remote_file.size):
+                if failures is not None:
+                    failures[name] = 'size ' + str(size) + ' does not match remote size ' + str(remote_file.size)
+                continue
+            if self._compare_method == 'md5' and remote_file.md5:
+                hashed.append((path, name, remote_file.md5))
+            else:
+                verified.add(name)
+        expected = dict((path, (name, md5)) for path, name, md5 in hashed)
+        for path, md5 in self._md5_files([path for path, _name, _md5 in hashed]):
+            name, remote_md5 = expected[path]
+            if md5 == remote_md5:
+                verified.add(name)
+            elif failures is not None:
+                failures[name] = 'md5 ' + str(md5) + ' does not match remote md5 ' + remote_md5
+        return verified
 
 
     def rmdir(self, directory, remote):
         logging.debug('removing directory ' + remote+directory)
         self._rclone.rmdir(remote, directory)
-        if self._sa_registry is not None:
-            self._sa_registry.invalidate_ls_cache_for_remote(remote)
-        self._clear_memory_ls_cache()
+        self._patch_ls_caches(remote, removed=[self._remote_entry(directory, is_dir=True)])
 
     def get_version(self):
         logging.debug('getting version')
@@ -990,16 +1831,13 @@ class ClSync:
     def delete_file(self, file, remote):
         logging.debug('deleting file ' + remote+file)
         self._rclone.delete_file(remote, file)
-        if self._sa_registry is not None:
-            self._sa_registry.invalidate_ls_cache_for_remote(remote)
-        self._clear_memory_ls_cache()
+        self._patch_ls_caches(remote, removed=[self._remote_entry(file)])
 
     def delete(self, path, remote):
         logging.debug('deleting path ' + remote+path)
         self._rclone.delete(remote, path)
-        if self._sa_registry is not None:
-            self._sa_registry.invalidate_ls_cache_for_remote(remote)
-        self._clear_memory_ls_cache()
+        # rclone delete keeps the directories, but an empty tree is listed again cheaply.
+        self._patch_ls_caches(remote, removed=[self._remote_entry(path, is_dir=True)])
 
     def copy(self, src, dst, remote):
         logging.debug('copy ' + src + ' to ' + remote + dst)
@@ -1018,9 +1856,152 @@ class ClSync:
     def move(self, src, dst):
         logging.debug('move ' + src + ' to ' + dst)
 
-    def _clear_memory_ls_cache(self):
-        self._cache = {}
-        self._cache_counter = {}
+    @staticmethod
+    def _remote_entry(path, size=-1, mod_time=None, is_dir=False):
+        """A ClFile for the full remote ``path`` as ``_patch_ls_caches`` takes it."""
+        tmp_file = clfile.ClFile()
+        tmp_file.path = '/' + '/'.join(part for part in path.split('/') if part)
+        tmp_file.name = tmp_file.path.rsplit('/', 1)[-1]
+        tmp_file.size = size
+        tmp_file.is_dir = is_dir
+        if is_dir:
+            tmp_file.mime_type = 'inode/directory'
+        else:
+            tmp_file.mime_type = mimetypes.guess_type(tmp_file.name)[0] or 'application/octet-stream'
+        if mod_time is None:
+            mod_time = time.time()
+        if isinstance(mod_time, (int, float)):
+            # Local files carry epoch seconds; listings carry rclone's ISO 8601 form.
+            mod_time = datetime.datetime.fromtimestamp(mod_time, datetime.timezone.utc).strftime(
+                '%Y-%m-%dT%H:%M:%S.%fZ')
+        tmp_file.mod_time = mod_time
+        return tmp_file
+
+    def _uploaded_entry(self, src, remote_path):
+        return self._remote_entry(remote_path + '/' + src.name, int(src.size), src.mod_time)
+
+    @staticmethod
+    def _modified_recently(src):
+        """True when ``--min-age 6h`` lets rclone skip ``src`` without an error, or its age is unknown.
+
+        Such a file is not known to be on the remote after a successful
+        copy, so it must not be patched into the cached listings.
+        """
+        mod_time = src.mod_time
+        if isinstance(mod_time, str):
+            mod_time = _epoch_seconds(mod_time)
+        if not isinstance(mod_time, (int, float)):
+            return True
+        return time.time() - mod_time < local_index.MIN_AGE_SECONDS
+
+    @staticmethod
+    def _cache_relative_path(root, path):
+        """``path`` relative to the listed ``root``, '' for the root itself, None outside of it."""
+        root = '/' + '/'.join(part for part in root.split('/') if part)
+        path = '/' + '/'.join(part for part in path.split('/') if part)
+        if path == root:
+            return ''
+        if root == '/':
+            return path[1:]
+        if path.startswith(root + '/'):
+            return path[len(root) + 1:]
+        return None
+
+    def _cached_entry(self, remote, path):
+        """The memory-cached ClFile of the full remote ``path`` on ``remote``, or None."""
+        for (cached_remote, root, _recursive), (_stamp, table) in list((self._cache or {}).items()):
+            rel = self._cache_relative_path(root, path) if cached_remote == remote else None
+            if rel and root + '/' + rel in table:
+                return table[root + '/' + rel]
+        return None
+
+    def _patch_ls_caches(self, remote, added=(), removed=()):
+        """Apply Sprinkle's own uploads and deletions to the cached listings of ``remote``.
+
+        ``added`` and ``removed`` are ClFiles from ``_remote_entry``. Every
+        memory listing that covers a path is patched in place: recursive
+        listings get the file and the directories above it, shallow ones the
+        top directory or the file itself. A removed directory takes its
+        subtree with it. The registry's persistent listings get the same
+        change, so the next ``ls`` is answered without asking rclone.
+        """
+        if not added and not removed:
+            return
+        ambiguous = False
+        with self._cache_lock:
+            stale = []
+            for cache_key, (_stamp, table) in list((self._cache or {}).items()):
+                cached_remote, root, recursive = cache_key
+                if cached_remote != remote:
+                    continue
+                for tmp_file in removed:
+                    rel = self._cache_relative_path(root, tmp_file.path)
+                    if rel is None:
+                        if tmp_file.is_dir and self._cache_relative_path(tmp_file.path, root) is not None:
+                            stale.append(cache_key)
+                        continue
+                    if rel == '':
+                        stale.append(cache_key)
+                        continue
+                    key = root + '/' + rel
+                    if key + ClSync.duplicate_suffix in table:
+                        # Which of the same-named files went away is unknown.
+                        ambiguous = True
+                        break
+                    table.pop(key, None)
+                    if tmp_file.is_dir and recursive:
+                        prefix = key + '/'
+                        for child in [child for child in table if child.startswith(prefix)]:
+                            del table[child]
+                if ambiguous:
+                    break
+                for tmp_file in added:
+                    rel = self._cache_relative_path(root, tmp_file.path)
+                    if not rel:
+                        continue
+                    parts = rel.split('/')
+                    for depth in range(1, (len(parts) if recursive else 1) + 1):
+                        key = root + '/' + '/'.join(parts[:depth])
+                        if depth == len(parts):
+                            entry = tmp_file
+                        elif key in table:
+                            continue
+                        else:
+                            entry = self._remote_entry(tmp_file.path.rsplit('/', len(parts) - depth)[0],
+                                                       mod_time=tmp_file.mod_time, is_dir=True)
+                        cached_file = clfile.ClFile()
+                        for field in clfile.FIELDS:
+                            setattr(cached_file, field, getattr(entry, field))
+                        cached_file.remote = remote
+                        cached_file.path = key
+                        table[key] = cached_file
+            if stale and not ambiguous:
+                self._cache = dict((key, value) for key, value in self._cache.items() if key not in stale)
+        if ambiguous:
+            self._clear_memory_ls_cache(remote)
+            if self._sa_registry is not None:
+                self._sa_registry.invalidate_ls_cache_for_remote(remote)
+            return
+        if self._sa_registry is not None:
+            self._sa_registry.patch_ls_cache_for_remote(
+                remote,
+                added=[{
+                    "Path": tmp_file.path,
+                    "Name": tmp_file.name,
+                    "Size": tmp_file.size,
+                    "ModTime": tmp_file.mod_time,
+                    "IsDir": tmp_file.is_dir,
+                    "MimeType": tmp_file.mime_type,
+                } for tmp_file in added],
+                removed=[tmp_file.path for tmp_file in removed],
+            )
+
+    def _clear_memory_ls_cache(self, remote=None):
+        if remote is None or self._cache is None:
+            self._cache = {}
+            return
+        # Replace rather than mutate; listing threads may be reading the dict.
+        self._cache = {key: value for key, value in list(self._cache.items()) if key[0] != remote}
 
     def sync(self, path):
         logging.debug('synchronize path ' + path)
@@ -1062,6 +2043,139 @@ class ClSync:
                 logging.debug('file to remove: ' + file_to_remove)
         return duplicates
 
+    def plan_rebalance(self, path, min_free=None, max_bytes=0):
+        """Plan server-side moves below ``path`` from remotes short of ``min_free`` free bytes.
+
+        ``min_free`` defaults to the headroom a large-file upload needs. Files
+        stored on more than one remote are left to ``removedups``, a move
+        would overwrite the other copy.
+        """
+        if min_free is None:
+            min_free = self._required_free_for_upload(self._large_file_threshold_bytes)
+        if not path.startswith('/'):
+            path = '/' + path
+        remotes = self.get_remotes()
+        frees = self.get_frees()
+        listings = workers.ordered_map(functools.partial(self._list_remote, path, True), remotes, self._ls_workers)
+        files = {}
+        seen = {}
+        try:
+            for remote, remote_files in listings:
+                files[remote] = []
+                for key in remote_files:
+                    tmp_file = remote_files[key]
+                    if tmp_file.is_dir or key.endswith(ClSync.duplicate_suffix):
+                        continue
+                    file_path = '/' + key.lstrip('/')
+                    seen[file_path] = seen.get(file_path, 0) + 1
+                    files[remote].append((file_path, int(tmp_file.size)))
+        finally:
+            listings.close()
+        for remote in files:
+            files[remote] = [entry for entry in files[remote] if seen[entry[0]] == 1]
+        return placement.rebalance(frees, files, min_free, max_bytes)
+
+    def rebalance(self, path, dry_run=False, min_free=None, max_bytes=0):
+        """Move files server-side until every remote has ``min_free`` free bytes, as far as possible.
+
+        Moves run on ``transfer_workers`` threads, at most
+        ``transfer_workers_per_remote`` per source remote, with
+        ``--drive-server-side-across-configs`` so the bytes stay on Drive.
+        """
+        moves = self.plan_rebalance(path, min_free, max_bytes)
+        planned_bytes = sum(move.size for move in moves)
+        common.print_line('rebalance: ' + str(len(moves)) + ' files (' + str(planned_bytes) + ' bytes) to move')
+        for move in moves:
+            common.print_line(move.src + move.path + ' -> ' + move.dst + ' (' + str(move.size) + ' bytes)')
+        if dry_run is True or not moves:
+            if dry_run is True:
+                common.print_line('performing a dry run. no changes are committed')
+            return moves
+        failures = []
+        lock = threading.Lock()
+        slots = workers.RemoteSlots(self._transfer_workers_per_remote)
+
+        def run_move(move):
+            try:
+                with slots.slot(move.src):
+                    self._rclone.moveto(move.src + move.path, move.dst + move.path,
+                                        ['--drive-server-side-across-configs'])
+            except Exception as e:
+                logging.error('moving ' + move.src + move.path + ' to ' + move.dst + ' failed: ' + str(e))
+                with lock:
+                    failures.append(move.src + move.path + ': ' + str(e)[:300])
+                return
+            with lock:
+                self.mark_remote_used(move.dst, move.size)
+                self.mark_remote_used(move.src, -move.size)
+                moved = self._cached_entry(move.src, move.path)
+                self._patch_ls_caches(move.src, removed=[self._remote_entry(move.path)])
+                self._patch_ls_caches(move.dst, added=[
+                    self._remote_entry(move.path, move.size, moved.mod_time if moved is not None else None)
+                ])
+
+        workers.run_jobs([functools.partial(run_move, move) for move in moves], self._transfer_workers)
+        if failures:
+            raise Exception(
+                'rebalance completed with ' + str(len(failures)) + ' failed move(s): ' + ' | '.join(failures)
+            )
+        return moves
+
     def find(self, regex):
         logging.debug('finding files with regular expression ' + regex)
+        if self._config['no_cache'] is False and self._sa_registry is not None and self._compare_method != 'md5':
+            files = self._find_indexed(regex)
+            if files is not None:
+                return files
         return self.ls('/', with_dups=False, regex=regex)
+
+    def _find_indexed(self, regex):
+        """Answer ``find`` from the registry's index of the cached root listings.
+
+        Remotes whose root listing is missing or due for a refresh are listed
+        first (delta listings included). Literal parts of ``regex`` select
+        candidate paths through the trigram index and the expression is only
+        applied to those. Returns None when a remote has no registry account.
+        """
+        remotes = self.get_remotes()
+        if self._stop_after_first_success():
+            remotes = remotes[:1]
+        if any(self._sa_registry.account_id_for_remote(remote) is None for remote in remotes):
+            return None
+        stale = [remote for remote in remotes
+                 if not self._sa_registry.ls_cache_is_fresh_for_remote(remote, '/', self._sa_refresh)]
+        listings = workers.ordered_map(
+            lambda remote: len(self._cached_listing(remote, '/', True)),
+            stale,
+            self._ls_workers,
+        )
+        try:
+            for remote, count in listings:
+                logging.debug('indexed ' + str(count) + ' entries of ' + remote)
+        finally:
+            listings.close()
+        regexp = re.compile(regex)
+        # The index holds '/Movies/...' for the key '//Movies/...'.
+        literals = [literal[1:] if literal.startswith('//') else literal
+                    for literal in search.regex_literals(regex)]
+        stop_after_first = self._config['ls_stop_first']
+        files = clfile.FileTable()
+        for remote in remotes:
+            for row in self._sa_registry.search_ls_files_for_remote(remote, literals):
+                # Keys look like those of ls('/'), which the expression was written against.
+                key = '//' + row['Path']
+                if regexp.search(key) is None:
+                    continue
+                tmp_file = clfile.ClFile()
+                tmp_file.remote = remote
+                tmp_file.path = key
+                tmp_file.name = row['Name']
+                tmp_file.size = row['Size']
+                tmp_file.mime_type = row['MimeType']
+                tmp_file.mod_time = row['ModTime']
+                tmp_file.is_dir = row['IsDir']
+                tmp_file.id = row.get('ID')
+                files[key] = tmp_file
+                if stop_after_first:
+                    return files
+        return files
@@ -9,12 +9,18 @@ __license__ = "GPLv3"
 __version__ = "1.2"
 __revision__ = "0"
 
+import io
 import subprocess
 import os.path
 import logging
+import threading
 import time
 import datetime
 
+MD5_BLOCK_SIZE = 8 * 2**20
+
+_md5_buffers = threading.local()
+
 def combine_jsons(json_str):
     return '[' + json_str.replace(']\n',',',json_str.count(']\n')-1).replace('||[\n','')
 
@@ -76,6 +82,47 @@ def execute(command_with_args, no_error=False):
         }
 
 
+def execute_lines(command_with_args, result, no_error=False):
+    """Run a command and yield its stdout lines while it is still running.
+
+    Once the output is exhausted, ``result`` holds ``code`` and ``error``
+    like the dictionary returned by ``execute``. Closing the generator
+    early kills the command.
+    """
+    logging.debug("Invoking : %s", " ".join(command_with_args))
+    child_env = os.environ.copy()
+    child_env.pop("RCLONE_CONFIG", None)
+    try:
+        proc = subprocess.Popen(
+            command_with_args,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=child_env)
+    except FileNotFoundError as not_found_e:
+        logging.error("Executable not found. %s", not_found_e)
+        result.update({"code": -20, "error": str(not_found_e)})
+        return
+    with proc:
+        # stderr is drained on its own thread so a chatty rclone cannot block stdout.
+        err_chunks = []
+        reader = threading.Thread(target=lambda: err_chunks.append(proc.stderr.read()), daemon=True)
+        reader.start()
+        finished = False
+        try:
+            for line in io.TextIOWrapper(proc.stdout, encoding='utf-8'):
+                yield line
+            finished = True
+        finally:
+            if not finished:
+                proc.kill()
+            reader.join()
+            proc.wait()
+        err = b''.join(err_chunks).decode('utf-8')
+        if err and no_error is False:
+            logging.warning(err.replace("\\n", "\n"))
+        result.update({"code": proc.returncode, "error": err})
+
+
 def print_line(line):
     logging.info(line)
 
@@ -127,16 +174,27 @@ def get_printable_datetime(iso_date):
     return get_datetime_from_iso8601(iso_date).strftime("%Y-%m-%d:%H:%M:%S")
 
 
-def get_md5(filename, block_size=2**20):
+def get_md5(filename, block_size=MD5_BLOCK_SIZE, fadvise=False):
     import hashlib
     md5 = hashlib.md5()
+    # One read buffer per thread, reused for every file hashed by that thread.
+    buffer = getattr(_md5_buffers, 'buffer', None)
+    if buffer is None or len(buffer) != block_size:
+        buffer = _md5_buffers.buffer = bytearray(block_size)
+    view = memoryview(buffer)
     try:
-        file = open(filename, 'rb')
-        while True:
-            data = file.read(block_size)
-            if not data:
-                break
-            md5.update(data)
+        with open(filename, 'rb', buffering=0) as file:
+            if fadvise and hasattr(os, 'posix_fadvise'):
+                try:
+                    os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                except OSError as e:
+                    # Only a hint: some filesystems reject it (EINVAL), the file still reads fine.
+                    logging.debug('posix_fadvise on ' + filename + ' failed: ' + str(e))
+            while True:
+                count = file.readinto(buffer)
+                if not count:
+                    break
+                md5.update(view[:count])
     except IOError:
         print('File \'' + filename + '\' not found!')
         return None
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+inotify change detection for the on-demand backup daemon
+"""
+__author__ = "Michael Montuori [michael.montuori@gmail.com]"
+__copyright__ = "Copyright 2018 Michael Montuori. All rights reserved."
+__credits__ = ["Warren Crigger"]
+__license__ = "GPLv3"
+__version__ = "1.2"
+__revision__ = "0"
+
+import collections
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import time
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+# Writes are reported once on close; IN_MODIFY would fire for every chunk.
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | \
+    IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+_EVENT = struct.Struct('iIII')
+_READ_SIZE = 64 * 1024
+
+# ``directory`` is the directory whose content changed; None on queue overflow.
+Event = collections.namedtuple("Event", "directory path mask")
+
+
+def _libc():
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    if not hasattr(libc, 'inotify_init1'):
+        raise OSError(errno.ENOSYS, 'inotify is not available on this system')
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    return libc
+
+
+class Watcher(object):
+    """Recursive inotify watch of a directory tree.
+
+    Every directory below ``root`` gets its own watch; directories created
+    or moved into the tree are watched as they appear. ``read`` returns the
+    events as ``Event`` tuples, with a single ``Event(None, None,
+    IN_Q_OVERFLOW)`` when the kernel queue overflowed and events were lost.
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self._libc = _libc()
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, 'inotify_init1 failed: ' + os.strerror(error))
+        self._watches = {}
+        self.watch_tree(self.root)
+
+    def fileno(self):
+        return self._fd
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+        self._watches = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc):
+        self.close()
+
+    def watch_count(self):
+        return len(self._watches)
+
+    def watch_tree(self, directory):
+        """Watch ``directory`` and every directory below it; symlinks are not followed."""
+        for dirpath, _dirnames, _filenames in os.walk(directory):
+            self._add_watch(dirpath)
+
+    def _add_watch(self, directory):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error in (errno.ENOENT, errno.ENOTDIR):
+                return
+            if error == errno.ENOSPC:
+                raise OSError(error, 'inotify watch limit reached at ' + directory +
+                              '; raise fs.inotify.max_user_watches')
+            raise OSError(error, 'cannot watch ' + directory + ': ' + os.strerror(error))
+        # Watching the same inode again (after a rename) returns the same descriptor.
+        self._watches[wd] = directory
+
+    def read(self, timeout=None):
+        """Wait up to ``timeout`` seconds for events and return all that are queued."""
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return []
+        events = []
+        while True:
+            try:
+                data = os.read(self._fd, _READ_SIZE)
+            except BlockingIOError:
+                break
+            events.extend(self._parse(data))
+        return events
+
+    def _parse(self, data):
+        events = []
+        offset = 0
+        while offset + _EVENT.size <= len(data):
+            wd, mask, _cookie, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                logging.warning('inotify queue overflow, changes were lost')
+                events.append(Event(None, None, mask))
+                continue
+            directory = self._watches.get(wd)
+            if mask & IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            if directory is None:
+                continue
+            if name == '':
+                # The watched directory itself was deleted or moved away.
+                events.append(Event(os.path.dirname(directory), directory, mask))
+                continue
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self.watch_tree(path)
+            events.append(Event(directory, path, mask))
+        return events
+
+
+class DirtySet(object):
+    """Directories waiting for a backup once they have been quiet for ``delay`` seconds.
+
+    Each ``add`` pushes the directory's due time back, so a burst of writes
+    results in one backup. ``pop_ready`` returns the due directories with
+    those below another due directory dropped, since a backup of a
+    directory covers its whole subtree.
+    """
+
+    def __init__(self, delay):
+        self.delay = delay
+        self._due = {}
+
+    def __len__(self):
+        return len(self._due)
+
+    def add(self, directory, now=None):
+        if now is None:
+            now = time.monotonic()
+        self._due[directory] = now + self.delay
+
+    def clear(self):
+        self._due = {}
+
+    def next_due(self):
+        if not self._due:
+            return None
+        return min(self._due.values())
+
+    def pop_ready(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        ready = sorted(path for path, due in self._due.items() if due <= now)
+        for path in ready:
+            del self._due[path]
+        return collapse(ready)
+
+
+def collapse(paths):
+    """Drop every path that lies below another path of ``paths``."""
+    result = []
+    # Component order keeps a directory next to its children ("/a/b", "/a/b/c", "/a/b-x").
+    for path in sorted(paths, key=lambda path: path.split(os.sep)):
+        if result and (path == result[-1] or path.startswith(result[-1].rstrip(os.sep) + os.sep)):
+            continue
+        result.append(path)
+    return result
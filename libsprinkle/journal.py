@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+persistent journal of backup operations for resuming interrupted runs
+"""
+__author__ = "Michael Montuori [michael.montuori@gmail.com]"
+__copyright__ = "Copyright 2017 Michael Montuori. All rights reserved."
+__credits__ = ["Warren Crigger"]
+__license__ = "GPLv3"
+__version__ = "1.2"
+__revision__ = "0"
+
+import collections
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from libsprinkle import clfile
+from libsprinkle import operation
+from libsprinkle import service_accounts
+
+DB_NAME = "backup-journal.sqlite3"
+CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=10000",
+    "PRAGMA foreign_keys=ON",
+)
+
+_SRC_FIELDS = ('remote', 'path', 'remote_path', 'name', 'size', 'mod_time', 'is_dir', 'md5')
+
+# ``ops`` are the ``(seq, Operation)`` pairs not completed yet; ``accounts``
+# maps the remotes of the run to their service-account ids.
+Run = collections.namedtuple("Run", "run_id remote_root total ops accounts")
+
+
+def default_db_path(sa_db=None):
+    """The journal lives next to the service-account registry."""
+    sa_db = os.path.abspath(os.path.expanduser(sa_db or service_accounts.DEFAULT_DB_PATH))
+    return os.path.join(os.path.dirname(sa_db), DB_NAME)
+
+
+class BackupJournal(object):
+    """Planned operations of the latest backup per source and target, with their completion.
+
+    ``begin`` stores the operation list of a run once it has been compared
+    and placed, ``complete`` marks operations done as they finish and
+    ``finish`` drops the run when nothing is left. A run that was killed
+    stays in the journal, and ``resume`` returns its open operations so the
+    next run skips indexing, listing and comparing.
+    """
+
+    def __init__(self, db_path=None):
+        self.db_path = os.path.abspath(os.path.expanduser(db_path or default_db_path()))
+        db_dir = os.path.dirname(self.db_path)
+        if db_dir and not os.path.isdir(db_dir):
+            os.makedirs(db_dir, mode=0o700, exist_ok=True)
+        # Workers mark operations from several threads; writes go through one connection.
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        for pragma in CONNECTION_PRAGMAS:
+            self._conn.execute(pragma)
+        self._init_db()
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _init_db(self):
+        with self._lock, self._conn as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS runs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    run_key TEXT NOT NULL UNIQUE,
+                    remote_root TEXT,
+                    total INTEGER NOT NULL,
+                    started_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS run_remotes (
+                    run_id INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+                    remote TEXT NOT NULL,
+                    account_id INTEGER,
+                    PRIMARY KEY(run_id, remote)
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS run_ops (
+                    run_id INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+                    seq INTEGER NOT NULL,
+                    operation TEXT NOT NULL,
+                    remote TEXT,
+                    path TEXT,
+                    remote_path TEXT,
+                    name TEXT,
+                    size INTEGER,
+                    mod_time TEXT,
+                    is_dir INTEGER,
+                    md5 TEXT,
+                    dst TEXT,
+                    done INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY(run_id, seq)
+                ) WITHOUT ROWID
+            """)
+
+    def begin(self, run_key, remote_root, ops, accounts=None):
+        """Record ``ops`` as the new run for ``run_key``, replacing an older one; returns its id.
+
+        Operation ``n`` of ``ops`` is stored with sequence number ``n``.
+        """
+        now = time.time()
+        with self._lock, self._conn as conn:
+            conn.execute("DELETE FROM runs WHERE run_key=?", (run_key,))
+            run_id = conn.execute(
+                "INSERT INTO runs (run_key, remote_root, total, started_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (run_key, remote_root, len(ops), now, now),
+            ).lastrowid
+            conn.executemany(
+                "INSERT INTO run_remotes (run_id, remote, account_id) VALUES (?, ?, ?)",
+                ((run_id, remote, account_id) for remote, account_id in (accounts or {}).items()),
+            )
+            conn.executemany("""
+                INSERT INTO run_ops (
+                    run_id, seq, operation, remote, path, remote_path, name, size, mod_time, is_dir, md5, dst
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (
+                (run_id, seq, op.operation, op.src.remote, op.src.path, op.src.remote_path, op.src.name,
+                 None if op.src.size is None else int(op.src.size), op.src.mod_time,
+                 1 if op.src.is_dir else 0, op.src.md5, op.dst)
+                for seq, op in enumerate(ops)
+            ))
+        logging.debug('journal: recorded ' + str(len(ops)) + ' operations for run ' + str(run_id))
+        return run_id
+
+    def resume(self, run_key):
+        """Return the unfinished ``Run`` for ``run_key``, or None."""
+        with self._lock:
+            conn = self._conn
+            row = conn.execute(
+                "SELECT id, remote_root, total FROM runs WHERE run_key=?", (run_key,)
+            ).fetchone()
+            if row is None:
+                return None
+            run_id, remote_root, total = row
+            accounts = dict(conn.execute(
+                "SELECT remote, account_id FROM run_remotes WHERE run_id=?", (run_id,)
+            ).fetchall())
+            ops = []
+            for values in conn.execute("""
+                    SELECT seq, operation, remote, path, remote_path, name, size, mod_time, is_dir, md5, dst
+                    FROM run_ops WHERE run_id=? AND done=0 ORDER BY seq
+                    """, (run_id,)):
+                src = clfile.ClFile()
+                for field, value in zip(_SRC_FIELDS, values[2:10]):
+                    setattr(src, field, value)
+                src.is_dir = bool(src.is_dir)
+                ops.append((values[0], operation.Operation(values[1], src, values[10])))
+        return Run(run_id, remote_root, total, ops, accounts)
+
+    def complete(self, run_id, seqs):
+        """Mark the operations ``seqs`` of ``run_id`` as done."""
+        seqs = list(seqs)
+        if not seqs:
+            return
+        with self._lock, self._conn as conn:
+            conn.executemany(
+                "UPDATE run_ops SET done=1 WHERE run_id=? AND seq=?",
+                ((run_id, seq) for seq in seqs),
+            )
+            conn.execute("UPDATE runs SET updated_at=? WHERE id=?", (time.time(), run_id))
+
+    def finish(self, run_id):
+        """Drop ``run_id`` when every operation is done; returns the number still open."""
+        with self._lock, self._conn as conn:
+            pending = conn.execute(
+                "SELECT COUNT(*) FROM run_ops WHERE run_id=? AND done=0", (run_id,)
+            ).fetchone()[0]
+            if pending == 0:
+                conn.execute("DELETE FROM runs WHERE id=?", (run_id,))
+        return pending
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+"""
+local directory scanning and persistent snapshots for incremental backups
+"""
+__author__ = "Michael Montuori [michael.montuori@gmail.com]"
+__copyright__ = "Copyright 2017 Michael Montuori. All rights reserved."
+__credits__ = ["Warren Crigger"]
+__license__ = "GPLv3"
+__version__ = "1.2"
+__revision__ = "0"
+
+import collections
+import logging
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+
+DEFAULT_DB_PATH = os.path.join("~", ".sprinkle", "local-index.sqlite3")
+DEFAULT_FULL_SCAN_HOURS = 24
+# rclone copy runs with --min-age 6h, so younger files are skipped without an error.
+MIN_AGE_SECONDS = 6 * 60 * 60
+
+Entry = collections.namedtuple("Entry", "dev inode size mtime_ns is_dir md5")
+ScanResult = collections.namedtuple("ScanResult", "entries changed deleted")
+SnapshotRun = collections.namedtuple("SnapshotRun", "root previous scan full_scan")
+
+
+def scan(local_dir, previous=None):
+    """Walk ``local_dir`` top-down with ``os.scandir`` and one stat per entry.
+
+    ``entries`` maps every path below (and including) ``local_dir`` to an
+    ``Entry``, in the order ``os.walk`` would report them with sorted names.
+    With a ``previous`` snapshot, directories whose inode and mtime did not
+    change are not read again: their children are carried over from the
+    snapshot and only their subdirectories are stat'ed. ``changed`` lists
+    the paths that are new or whose device, inode, size or mtime differ, and
+    ``deleted`` the snapshot paths that no longer exist.
+    """
+    previous = previous or {}
+    children = _children_by_parent(previous) if previous else {}
+    entries = collections.OrderedDict()
+    changed = []
+    try:
+        root_stat = os.stat(local_dir)
+    except OSError as e:
+        logging.warning('cannot stat ' + local_dir + ': ' + str(e))
+        return ScanResult(entries, changed, [])
+    entries[local_dir] = Entry(root_stat.st_dev, root_stat.st_ino, -1, root_stat.st_mtime_ns, True, None)
+    stack = [local_dir]
+    while stack:
+        directory = stack.pop()
+        subdirs = []
+        known = previous.get(directory)
+        current = entries[directory]
+        if known is not None and known.is_dir and \
+                known[:4] == current[:4] and \
+                directory in children:
+            _carry_over(children[directory], previous, entries, subdirs)
+        else:
+            _read_directory(directory, previous, entries, changed, subdirs)
+        stack.extend(reversed(subdirs))
+    deleted = [path for path in previous if path not in entries]
+    return ScanResult(entries, changed, deleted)
+
+
+def _read_directory(directory, previous, entries, changed, subdirs):
+    try:
+        with os.scandir(directory) as iterator:
+            dir_entries = sorted(iterator, key=lambda dir_entry: dir_entry.name)
+    except OSError as e:
+        logging.warning('cannot read directory ' + directory + ': ' + str(e))
+        return
+    files = []
+    for dir_entry in dir_entries:
+        try:
+            is_dir = dir_entry.is_dir()
+            st = dir_entry.stat()
+        except OSError as e:
+            logging.debug('cannot stat ' + dir_entry.path + ': ' + str(e))
+            continue
+        if is_dir:
+            entry = Entry(st.st_dev, st.st_ino, -1, st.st_mtime_ns, True, None)
+            entries[dir_entry.path] = entry
+            known = previous.get(dir_entry.path)
+            if known is None or not known.is_dir:
+                changed.append(dir_entry.path)
+            # os.walk does not descend into symlinked directories either.
+            if not dir_entry.is_symlink():
+                subdirs.append(dir_entry.path)
+        else:
+            files.append((dir_entry.path, st))
+    for path, st in files:
+        known = previous.get(path)
+        if known is not None and not known.is_dir and \
+                known[:4] == (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns):
+            entries[path] = known
+        else:
+            entries[path] = Entry(st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, False, None)
+            changed.append(path)
+
+
+def _carry_over(child_paths, previous, entries, subdirs):
+    files = []
+    for path in child_paths:
+        known = previous[path]
+        if not known.is_dir:
+            files.append(path)
+            continue
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        entries[path] = Entry(st.st_dev, st.st_ino, -1, st.st_mtime_ns, True, None)
+        if not os.path.islink(path):
+            subdirs.append(path)
+    for path in files:
+        entries[path] = previous[path]
+
+
+def _children_by_parent(previous):
+    children = {}
+    for path in previous:
+        children.setdefault(os.path.dirname(path), []).append(path)
+    for parent in children:
+        children[parent].sort()
+    # Directories without children still need an entry to be skippable.
+    for path, entry in previous.items():
+        if entry.is_dir:
+            children.setdefault(path, [])
+    return children
+
+
+class LocalSnapshot(object):
+    """Persistent per-source snapshot of a local tree, stored in SQLite."""
+
+    def __init__(self, db_path=DEFAULT_DB_PATH):
+        self.db_path = os.path.abspath(os.path.expanduser(db_path))
+        db_dir = os.path.dirname(self.db_path)
+        if db_dir and not os.path.isdir(db_dir):
+            os.makedirs(db_dir, mode=0o700, exist_ok=True)
+        self._init_db()
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _init_db(self):
+        with self._connect() as conn:
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(snapshot_files)")]
+            if columns and 'dev' not in columns:
+                # Snapshots are rebuilt by a full scan; drop the ones without device numbers.
+                conn.execute("DROP TABLE snapshot_files")
+                conn.execute("DROP TABLE IF EXISTS snapshot_roots")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS snapshot_roots (
+                    root TEXT PRIMARY KEY,
+                    last_full_scan_at REAL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS snapshot_files (
+                    root TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    dev INTEGER,
+                    inode INTEGER,
+                    size INTEGER,
+                    mtime_ns INTEGER,
+                    is_dir INTEGER NOT NULL,
+                    md5 TEXT,
+                    PRIMARY KEY(root, path)
+                )
+            """)
+
+    def load(self, root):
+        """Return ``(entries, last_full_scan_at)`` for ``root``; empty when unknown."""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT last_full_scan_at FROM snapshot_roots WHERE root=?",
+                (root,),
+            ).fetchone()
+            entries = {}
+            for path, dev, inode, size, mtime_ns, is_dir, md5 in conn.execute(
+                    "SELECT path, dev, inode, size, mtime_ns, is_dir, md5 FROM snapshot_files WHERE root=?",
+                    (root,)):
+                entries[path] = Entry(dev, inode, size, mtime_ns, bool(is_dir), md5)
+        return entries, None if row is None else row[0]
+
+    def full_scan_due(self, last_full_scan_at, full_scan_hours=DEFAULT_FULL_SCAN_HOURS):
+        if last_full_scan_at is None:
+            return True
+        return time.time() - last_full_scan_at >= full_scan_hours * 3600
+
+    def save(self, root, entries, paths, deleted, full_scan=False):
+        """Write ``paths`` from ``entries`` and drop ``deleted`` for ``root``."""
+        now = time.time()
+        with self._connect() as conn:
+            if full_scan:
+                conn.execute("DELETE FROM snapshot_files WHERE root=?", (root,))
+            else:
+                conn.executemany(
+                    "DELETE FROM snapshot_files WHERE root=? AND path=?",
+                    ((root, path) for path in deleted),
+                )
+            conn.executemany("""
+                INSERT OR REPLACE INTO snapshot_files (
+                    root, path, dev, inode, size, mtime_ns, is_dir, md5
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, (
+                (root, path, entry.dev, entry.inode, entry.size, entry.mtime_ns, 1 if entry.is_dir else 0, entry.md5)
+                for path, entry in ((path, entries[path]) for path in paths)
+            ))
+            conn.execute("""
+                INSERT INTO snapshot_roots (root, last_full_scan_at, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT(root) DO UPDATE SET
+                    last_full_scan_at=COALESCE(excluded.last_full_scan_at, snapshot_roots.last_full_scan_at),
+                    updated_at=excluded.updated_at
+            """, (root, now if full_scan else None, now))
+
+
+class HashCache(object):
+    """Persistent md5 cache keyed by device and inode, valid while size and mtime match."""
+
+    def __init__(self, db_path=DEFAULT_DB_PATH):
+        self.db_path = os.path.abspath(os.path.expanduser(db_path))
+        db_dir = os.path.dirname(self.db_path)
+        if db_dir and not os.path.isdir(db_dir):
+            os.makedirs(db_dir, mode=0o700, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._init_db()
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _init_db(self):
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS hash_cache (
+                    dev INTEGER NOT NULL,
+                    inode INTEGER NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    md5 TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    PRIMARY KEY(dev, inode)
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_hash_cache_path ON hash_cache(path)")
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def fill(self, entries, paths, hash_files):
+        """Set the md5 of the file ``entries`` at ``paths``, hashing only cache misses.
+
+        ``hash_files`` takes a list of paths and yields ``(path, md5)`` pairs.
+        """
+        missing = []
+        moved = []
+        with self._connect() as conn:
+            for path in paths:
+                entry = entries[path]
+                row = conn.execute(
+                    "SELECT size, mtime_ns, md5, path FROM hash_cache WHERE dev=? AND inode=?",
+                    (entry.dev, entry.inode),
+                ).fetchone()
+                if row is not None and (row[0], row[1]) == (entry.size, entry.mtime_ns):
+                    entries[path] = entry._replace(md5=row[2])
+                    self.hits += 1
+                    if row[3] != os.path.abspath(path):
+                        moved.append((os.path.abspath(path), entry.dev, entry.inode))
+                else:
+                    missing.append(path)
+            # Renames keep the inode; remember the new path so eviction keeps the hash.
+            conn.executemany("UPDATE hash_cache SET path=? WHERE dev=? AND inode=?", moved)
+        hashed = []
+        for path, md5 in hash_files(missing):
+            self.misses += 1
+            if md5 is None:
+                continue
+            entries[path] = entries[path]._replace(md5=md5)
+            hashed.append(path)
+        if not hashed:
+            return
+        with self._connect() as conn:
+            conn.executemany("""
+                INSERT OR REPLACE INTO hash_cache (dev, inode, size, mtime_ns, md5, path)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (
+                (entry.dev, entry.inode, entry.size, entry.mtime_ns, entry.md5, os.path.abspath(path))
+                for path, entry in ((path, entries[path]) for path in hashed)
+            ))
+
+    def evict(self, local_dir, entries):
+        """Drop cached hashes of files below ``local_dir`` that are not in ``entries`` anymore."""
+        root = os.path.abspath(local_dir).rstrip(os.sep)
+        present = set(os.path.abspath(path) for path in entries)
+        with self._connect() as conn:
+            stale = [
+                (path,) for (path,) in conn.execute(
+                    "SELECT path FROM hash_cache WHERE path >= ? AND path < ?",
+                    (root + os.sep, root + chr(ord(os.sep) + 1)),
+                )
+                if path not in present
+            ]
+            conn.executemany("DELETE FROM hash_cache WHERE path=?", stale)
+        if stale:
+            logging.debug('evicted ' + str(len(stale)) + ' md5 cache entries below ' + root)
+        return len(stale)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+up-front placement of new files on remotes by bin packing
+"""
+__author__ = "Michael Montuori [michael.montuori@gmail.com]"
+__copyright__ = "Copyright 2017 Michael Montuori. All rights reserved."
+__credits__ = ["Warren Crigger"]
+__license__ = "GPLv3"
+__version__ = "1.2"
+__revision__ = "0"
+
+import bisect
+import collections
+
+STRATEGIES = ('mas', 'pack')
+DEFAULT_STRATEGY = 'mas'
+# Operation.dst of a new file that fits on no remote.
+UNPLACED = 'unplaced'
+
+Plan = collections.namedtuple("Plan", "assignments unplaced packed_bytes")
+Move = collections.namedtuple("Move", "path size src dst")
+
+
+def pack(sizes, free, required_free=None):
+    """Assign items to remotes with best-fit decreasing.
+
+    ``sizes`` maps item keys to sizes in bytes and ``free`` maps remotes to
+    their known free bytes. An item fits a remote whose remaining space is at
+    least ``required_free(size)`` (the size itself by default) and uses
+    ``size`` bytes of it. Items are placed largest first on the fitting
+    remote with the least remaining space, which keeps the large gaps open
+    for the large items that follow.
+
+    Returns a ``Plan`` with ``assignments`` (item key to remote), the
+    ``unplaced`` item keys, largest first, and the ``packed_bytes`` total.
+    """
+    if required_free is None:
+        required_free = int
+    # Sorted (remaining, remote) pairs; bisect finds the tightest fit.
+    remaining = sorted((int(size), remote) for remote, size in free.items() if size is not None)
+    assignments = {}
+    unplaced = []
+    packed_bytes = 0
+    for key in sorted(sizes, key=lambda key: (-int(sizes[key]), key)):
+        size = int(sizes[key])
+        index = bisect.bisect_left(remaining, (required_free(size), ''))
+        if index == len(remaining):
+            unplaced.append(key)
+            continue
+        space, remote = remaining.pop(index)
+        assignments[key] = remote
+        packed_bytes += size
+        bisect.insort(remaining, (space - size, remote))
+    return Plan(assignments, unplaced, packed_bytes)
+
+
+def rebalance(free, files, min_free, max_bytes=0):
+    """Plan file moves that bring every remote back to ``min_free`` free bytes.
+
+    ``free`` maps remotes to their known free bytes and ``files`` maps
+    remotes to ``(path, size)`` pairs stored on them. Remotes below
+    ``min_free`` give files, fullest remote first, to remotes that stay at or
+    above ``min_free`` after receiving them. Each donor gives the smallest
+    file that covers what it still lacks, or its largest file when none
+    does, so few bytes move. Moves stop at ``max_bytes`` in total (0 for
+    no limit).
+
+    Returns a list of ``Move(path, size, src, dst)``.
+    """
+    spare = sorted((int(size) - min_free, remote) for remote, size in free.items()
+                   if size is not None and size > min_free)
+    donors = sorted((int(size), remote) for remote, size in free.items()
+                    if size is not None and size < min_free)
+    moves = []
+    moved = 0
+    for space, donor in donors:
+        need = min_free - space
+        candidates = sorted((int(size), path) for path, size in files.get(donor, ()) if int(size) > 0)
+        while need > 0 and candidates:
+            index = bisect.bisect_left(candidates, (need, ''))
+            # Covering files from the smallest up, then smaller ones from the largest down.
+            order = list(range(index, len(candidates))) + list(range(index - 1, -1, -1))
+            chosen = None
+            for position in order:
+                size = candidates[position][0]
+                if max_bytes and moved + size > max_bytes:
+                    continue
+                receiver = bisect.bisect_left(spare, (size, ''))
+                if receiver < len(spare):
+                    chosen = position, receiver
+                    break
+            if chosen is None:
+                break
+            size, path = candidates.pop(chosen[0])
+            room, remote = spare.pop(chosen[1])
+            bisect.insort(spare, (room - size, remote))
+            moves.append(Move(path, size, donor, remote))
+            moved += size
+            need -= size
+    return moves
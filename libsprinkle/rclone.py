@@ -13,6 +13,7 @@ import logging
 import json
 import os
 import random
+import tempfile
 from libsprinkle import common
 from libsprinkle import exceptions
 
@@ -40,6 +41,76 @@ def extract_json_output(text):
     return text
 
 
+def lsjson_row(line):
+    """Parse one line of ``rclone lsjson`` output; None for brackets and log noise."""
+    line = line.strip()
+    if not line.startswith('{'):
+        return None
+    if line.endswith(','):
+        line = line[:-1]
+    try:
+        row = json.loads(line)
+    except ValueError:
+        return None
+    return row if isinstance(row, dict) else None
+
+
+# Messages of the files a batched transfer or delete returned without an error or a -v log line.
+NOT_TRANSFERRED = 'not transferred by rclone'
+NOT_DELETED = 'not deleted by rclone'
+
+
+def failed_files_from_output(text, files):
+    """Map rclone ``ERROR : <path>: <message>`` log lines back to ``files``.
+
+    Lines that do not name one of ``files`` (for example the final
+    ``Attempt 1/1 failed`` summary) are ignored.
+    """
+    failed = {}
+    if text in (None, ''):
+        return failed
+    wanted = set(files)
+    for line in str(text).splitlines():
+        marker = line.find('ERROR : ')
+        if marker == -1:
+            continue
+        rest = line[marker + len('ERROR : '):]
+        index = rest.find(': ')
+        while index != -1:
+            name = rest[:index]
+            if name in wanted:
+                failed[name] = rest[index + 2:].strip()
+                break
+            index = rest.find(': ', index + 2)
+    return failed
+
+
+def transferred_files_from_output(text, files):
+    """Return the ``files`` that rclone ``-v`` logs as ``INFO  : <path>: Copied``/``Moved``."""
+    return logged_files_from_output(text, files, ('Copied', 'Moved'))
+
+
+def logged_files_from_output(text, files, messages):
+    """Return the ``files`` that rclone ``-v`` logs as ``INFO  : <path>: <message>`` for one of ``messages``."""
+    logged = set()
+    if text in (None, ''):
+        return logged
+    wanted = set(files)
+    for line in str(text).splitlines():
+        marker = line.find('INFO  : ')
+        if marker == -1:
+            continue
+        rest = line[marker + len('INFO  : '):]
+        index = rest.find(': ')
+        while index != -1:
+            name = rest[:index]
+            if name in wanted and rest[index + 2:].startswith(messages):
+                logged.add(name)
+                break
+            index = rest.find(': ', index + 2)
+    return logged
+
+
 def generate_rclone_config(
         json_dir,
         output_file,
@@ -217,6 +288,39 @@ class RClone:
 
     def lsjson(self, remote, directory, extra_args=[], no_error=False):
         logging.debug('running lsjson for ' + remote + directory)
+        result = common.execute(self._lsjson_command(remote, directory, extra_args), no_error)
+        logging.debug('result: ' + str(result)[0:128])
+        if self._check_lsjson_error(result, no_error) is False:
+            return '[]'
+        lsjson = extract_json_output(result.get('out'))
+        logging.debug('returning ' + str(lsjson)[0:128])
+        return lsjson
+
+    def lsjson_rows(self, remote, directory, extra_args=[], no_error=False):
+        """Yield lsjson rows as rclone prints them, one object per line.
+
+        Unlike ``lsjson`` the output is never held as a whole, so large
+        listings cost only the rows the caller keeps. A failed run raises
+        once the output is exhausted; ``no_error`` only forgives a missing
+        directory, as the rows of any other failure are not a listing.
+        """
+        logging.debug('streaming lsjson for ' + remote + directory)
+        result = {}
+        count = 0
+        for line in common.execute_lines(self._lsjson_command(remote, directory, extra_args), result, no_error):
+            row = lsjson_row(line)
+            if row is not None:
+                count += 1
+                yield row
+        if result.get('code', 0) != 0:
+            error = str(result.get('error') or '') or 'rclone exited with code ' + str(result.get('code'))
+            if error.find("directory not found") == -1:
+                raise Exception('error getting remote object. ' + error)
+            if no_error is False:
+                raise exceptions.FileNotFoundException(error)
+        logging.debug('streamed ' + str(count) + ' lsjson rows')
+
+    def _lsjson_command(self, remote, directory, extra_args):
         command_with_args = []
         command_with_args.append(self._rclone_exe)
         command_with_args.append("lsjson")
@@ -228,18 +332,25 @@ class RClone:
         command_with_args.append("--retries")
         command_with_args.append(self._rclone_retries)
         command_with_args.append(remote + directory)
-        result = common.execute(command_with_args, no_error)
-        logging.debug('result: ' + str(result)[0:128])
-        if result['error'] != '':
+        return command_with_args
+
+    def _check_lsjson_error(self, result, no_error):
+        """Raise for a failed lsjson run; False for a missing directory under ``no_error``.
+
+        ``no_error`` only forgives a missing directory: any other failure
+        would pass for an empty listing.
+        """
+        if result.get('code', 0) == 0 and result['error'] == '':
+            return True
+        error = str(result['error'])
+        if error.find("directory not found") != -1:
             if no_error is False:
-                # logging.error('error getting remotes objects')
-                if result['error'].find("directory not found") != -1:
-                    raise exceptions.FileNotFoundException(result['error'])
-                else:
-                    raise Exception('error getting remote object. ' + result['error'])
-        lsjson = extract_json_output(result.get('out'))
-        logging.debug('returning ' + str(lsjson)[0:128])
-        return lsjson
+                raise exceptions.FileNotFoundException(error)
+            return False
+        if result.get('code', 0) != 0 or no_error is False:
+            # logging.error('error getting remotes objects')
+            raise Exception('error getting remote object. ' + error)
+        return True
 
     def md5sum(self, remote, directory, extra_args=[], no_error=False):
         logging.debug('running lsjson for ' + remote + directory)
@@ -426,6 +537,86 @@ class RClone:
         logging.debug('returning ' + str(out))
         return out
 
+    def delete_files(self, remote, root, files, extra_args=[]):
+        """Delete ``files`` (paths relative to ``root``) with one ``--files-from-raw`` run.
+
+        Returns ``(failed, error)`` like ``copy_files``: files rclone did not
+        log as deleted map to ``NOT_DELETED``.
+        """
+        logging.debug('running batched delete of ' + str(len(files)) + ' files in ' + remote + root)
+        fd, manifest = tempfile.mkstemp(prefix="sprinkle-files-from-", suffix=".txt")
+        try:
+            with os.fdopen(fd, "w") as manifest_fp:
+                for name in files:
+                    manifest_fp.write(name + "\n")
+            command_with_args = []
+            command_with_args.append(self._rclone_exe)
+            command_with_args.append("delete")
+            for extra_arg in extra_args:
+                command_with_args.append(extra_arg)
+            # --files-from would strip blanks and drop names starting with '#' or ';'.
+            command_with_args.append("--files-from-raw")
+            command_with_args.append(manifest)
+            # -v logs every deleted file, so names rclone skipped can be told apart.
+            command_with_args.append("-v")
+            if self._config_file is not None:
+                command_with_args.append("--config")
+                command_with_args.append(self._config_file)
+            command_with_args.append("--auto-confirm")
+            command_with_args.append("--retries")
+            command_with_args.append(self._rclone_retries)
+            command_with_args.append(remote + root)
+            result = common.execute(command_with_args, True)
+        finally:
+            try:
+                os.unlink(manifest)
+            except OSError:
+                pass
+        logging.debug('result: ' + str(result)[0:256])
+        error_text = str(result.get('error') or '')
+        failed = failed_files_from_output(error_text, files)
+        if result.get('code', 0) != 0 and not failed:
+            return failed, error_text or 'rclone exited with code ' + str(result.get('code'))
+        deleted = logged_files_from_output(error_text, files, ('Deleted',))
+        for name in files:
+            if name not in deleted and name not in failed:
+                failed[name] = NOT_DELETED
+        return failed, None
+
+    def rmdirs(self, remote, directory, leave_root=False):
+        """Remove ``directory`` and every empty directory below it; non-empty ones are kept.
+
+        Returns the paths, relative to ``directory``, of the directories below
+        it that rclone logs as removed. The root is never among them.
+        """
+        logging.debug('running rmdirs for ' + remote + ":" + directory)
+        command_with_args = []
+        command_with_args.append(self._rclone_exe)
+        command_with_args.append("rmdirs")
+        if leave_root:
+            command_with_args.append("--leave-root")
+        # rmdirs skips non-empty directories silently; -v logs the ones it removes.
+        command_with_args.append("-v")
+        if self._config_file is not None:
+            command_with_args.append("--config")
+            command_with_args.append(self._config_file)
+        command_with_args.append("--auto-confirm")
+        command_with_args.append("--retries")
+        command_with_args.append(self._rclone_retries)
+        command_with_args.append(remote + directory)
+        result = common.execute(command_with_args, True)
+        logging.debug('result: ' + str(result))
+        if result['code'] != 0:
+            logging.error('error removing empty directories')
+            raise Exception('error removing empty directories. ' + str(result['error']))
+        removed = []
+        for line in str(result['error']).splitlines():
+            marker = line.find('INFO  : ')
+            if marker != -1 and line.endswith(': Removing directory'):
+                removed.append(line[marker + len('INFO  : '):-len(': Removing directory')])
+        logging.debug('returning ' + str(removed))
+        return removed
+
     def copy(self, src, dst, extra_args=[], no_error=False):
         logging.debug('running copy from ' + src + " to " + dst)
         command_with_args = []
@@ -455,6 +646,63 @@ class RClone:
         logging.debug('returning ' + str(out))
         return out
 
+    def copy_files(self, src, dst, files, extra_args=[], move=False, min_age="6h"):
+        """Transfer ``files`` (paths relative to ``src``) with one ``--files-from-raw`` run.
+
+        Returns ``(failed, error)`` where ``failed`` maps each file rclone
+        reported an error for to its message, and each file rclone did not
+        log as copied or moved to ``NOT_TRANSFERRED``: those were skipped by
+        ``min_age``, already identical at ``dst``, or never read. ``error``
+        carries the rclone output when the run failed without naming any
+        file. Restores pass ``min_age=None``: the age filter only guards
+        local files that may still be written.
+        """
+        logging.debug('running batched ' + ('move' if move else 'copy') + ' of ' + str(len(files)) +
+                      ' files from ' + src + " to " + dst)
+        fd, manifest = tempfile.mkstemp(prefix="sprinkle-files-from-", suffix=".txt")
+        try:
+            with os.fdopen(fd, "w") as manifest_fp:
+                for name in files:
+                    manifest_fp.write(name + "\n")
+            command_with_args = []
+            command_with_args.append(self._rclone_exe)
+            command_with_args.append("move" if move else "copy")
+            for extra_arg in extra_args:
+                command_with_args.append(extra_arg)
+            # --files-from would strip blanks and drop names starting with '#' or ';'.
+            command_with_args.append("--files-from-raw")
+            command_with_args.append(manifest)
+            # -v logs every transferred file, so names rclone skipped can be told apart.
+            command_with_args.append("-v")
+            if self._config_file is not None:
+                command_with_args.append("--config")
+                command_with_args.append(self._config_file)
+            command_with_args.append("--auto-confirm")
+            command_with_args.append("--local-no-check-updated")
+            if min_age is not None:
+                command_with_args.append("--min-age")
+                command_with_args.append(min_age)
+            command_with_args.append("--retries")
+            command_with_args.append(self._rclone_retries)
+            command_with_args.append(src)
+            command_with_args.append(dst)
+            result = common.execute(command_with_args, True)
+        finally:
+            try:
+                os.unlink(manifest)
+            except OSError:
+                pass
+        logging.debug('result: ' + str(result)[0:256])
+        error_text = str(result.get('error') or '')
+        failed = failed_files_from_output(error_text, files)
+        if result.get('code', 0) != 0 and not failed:
+            return failed, error_text or 'rclone exited with code ' + str(result.get('code'))
+        transferred = transferred_files_from_output(error_text, files)
+        for name in files:
+            if name not in failed and name not in transferred:
+                failed[name] = NOT_TRANSFERRED
+        return failed, None
+
     def move(self, src, dst, extra_args=[]):
         logging.debug('running move from ' + src + " to " + dst)
         command_with_args = []
@@ -482,6 +730,31 @@ class RClone:
         logging.debug('returning ' + str(out))
         return out
 
+    def moveto(self, src, dst, extra_args=[]):
+        """Move the single remote file ``src`` to ``dst``; unlike ``move`` there is no --min-age."""
+        logging.debug('running moveto from ' + src + " to " + dst)
+        command_with_args = []
+        command_with_args.append(self._rclone_exe)
+        command_with_args.append("moveto")
+        for extra_arg in extra_args:
+            command_with_args.append(extra_arg)
+        if self._config_file is not None:
+            command_with_args.append("--config")
+            command_with_args.append(self._config_file)
+        command_with_args.append("--auto-confirm")
+        command_with_args.append("--retries")
+        command_with_args.append(self._rclone_retries)
+        command_with_args.append(src)
+        command_with_args.append(dst)
+        result = common.execute(command_with_args)
+        logging.debug('result: ' + str(result))
+        if result['error'] != '':
+            logging.error('error moving ' + src + ' to ' + dst)
+            raise Exception('error moving remote object. ' + result['error'])
+        out = result['out'].splitlines()
+        logging.debug('returning ' + str(out))
+        return out
+
     def get_free(self, remote):
         json_obj = self.get_about_json(remote, True)
         if json_obj is not None and "free" in json_obj:
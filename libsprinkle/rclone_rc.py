@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""
+rclone remote control (rcd) backend
+"""
+__author__ = "Michael Montuori [michael.montuori@gmail.com]"
+__copyright__ = "Copyright 2017 Michael Montuori. All rights reserved."
+__credits__ = ["Warren Crigger"]
+__license__ = "GPLv3"
+__version__ = "1.2"
+__revision__ = "0"
+
+import atexit
+import base64
+import json
+import logging
+import os
+import secrets
+import socket
+import subprocess
+import time
+import urllib.error
+import urllib.request
+from libsprinkle import exceptions
+from libsprinkle import local_index
+from libsprinkle import rclone
+
+DEFAULT_START_TIMEOUT_SECONDS = 15
+DEFAULT_JOB_POLL_SECONDS = 0.2
+# A synchronous operations/list of a large remote takes minutes; transfers run as polled jobs.
+DEFAULT_REQUEST_TIMEOUT_SECONDS = 1800
+
+
+def connect(config_file=None, rclone_exe="rclone", rclone_retries="1", url=None,
+            timeout=DEFAULT_REQUEST_TIMEOUT_SECONDS):
+    """Return an ``RCloneRC`` backend, or the subprocess ``RClone`` if rcd is unavailable."""
+    try:
+        rc = RCloneRC(config_file, rclone_exe, rclone_retries, url, timeout)
+        rc.start()
+        return rc
+    except Exception as e:
+        logging.warning('rclone rcd backend unavailable, using rclone subprocesses: ' + str(e))
+        return rclone.RClone(config_file, rclone_exe, rclone_retries)
+
+
+class RCloneRC(rclone.RClone):
+    """RClone driving one long-lived ``rclone rcd`` over its JSON remote-control API.
+
+    Listings, quota, single-file transfers and deletions go through rcd.
+    Operations that have no equivalent rc call, or need rclone's log output
+    (``copy_files`` error attribution), use the subprocess implementation.
+    """
+
+    def __init__(self, config_file=None, rclone_exe="rclone", rclone_retries="1", url=None,
+                 timeout=DEFAULT_REQUEST_TIMEOUT_SECONDS):
+        rclone.RClone.__init__(self, config_file, rclone_exe, rclone_retries)
+        self._url = url.rstrip('/') if url else None
+        self._timeout = timeout
+        self._auth = None
+        self._process = None
+
+    def start(self, timeout=DEFAULT_START_TIMEOUT_SECONDS):
+        if self._url is not None:
+            self.call("rc/noop")
+            return
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        user = secrets.token_hex(8)
+        password = secrets.token_hex(16)
+        command_with_args = [
+            self._rclone_exe,
+            "rcd",
+            "--rc-addr", "127.0.0.1:" + str(port),
+        ]
+        if self._config_file is not None:
+            command_with_args.append("--config")
+            command_with_args.append(self._config_file)
+        command_with_args.append("--retries")
+        command_with_args.append(self._rclone_retries)
+        child_env = os.environ.copy()
+        child_env.pop("RCLONE_CONFIG", None)
+        # Credentials go through the environment; command lines are visible in ps.
+        child_env["RCLONE_RC_USER"] = user
+        child_env["RCLONE_RC_PASS"] = password
+        logging.debug('starting rclone rcd on 127.0.0.1:' + str(port))
+        self._process = subprocess.Popen(
+            command_with_args,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            env=child_env,
+        )
+        atexit.register(self.close)
+        self._url = "http://127.0.0.1:" + str(port)
+        self._auth = "Basic " + base64.b64encode((user + ":" + password).encode("utf-8")).decode("ascii")
+        deadline = time.monotonic() + timeout
+        while True:
+            if self._process.poll() is not None:
+                raise Exception('rclone rcd exited with code ' + str(self._process.returncode))
+            try:
+                self.call("rc/noop")
+                return
+            except Exception:
+                if time.monotonic() > deadline:
+                    self.close()
+                    raise Exception('rclone rcd did not answer within ' + str(timeout) + 's')
+                time.sleep(0.1)
+
+    def close(self):
+        if self._process is None:
+            return
+        if self._process.poll() is None:
+            self._process.terminate()
+            try:
+                self._process.wait(5)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+        self._process = None
+
+    def call(self, method, params=None):
+        request = urllib.request.Request(
+            self._url + "/" + method,
+            data=json.dumps(params or {}).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+            method="POST",
+        )
+        if self._auth is not None:
+            request.add_header("Authorization", self._auth)
+        try:
+            # A wedged rcd must not hold a worker forever.
+            with urllib.request.urlopen(request, timeout=self._timeout) as response:
+                return json.loads(response.read().decode("utf-8") or "{}")
+        except urllib.error.HTTPError as e:
+            body = e.read().decode("utf-8", "replace")
+            try:
+                error = json.loads(body).get("error") or body
+            except ValueError:
+                error = body
+            raise Exception(str(error) or 'rclone rc ' + method + ' failed with HTTP ' + str(e.code))
+        except (socket.timeout, urllib.error.URLError) as e:
+            raise Exception('rclone rc ' + method + ' failed: ' + str(getattr(e, 'reason', e)))
+
+    def _call_job(self, method, params):
+        params = dict(params)
+        params["_async"] = True
+        job_id = self.call(method, params)["jobid"]
+        while True:
+            status = self.call("job/status", {"jobid": job_id})
+            if status.get("finished"):
+                if not status.get("success"):
+                    raise Exception(status.get("error") or method + ' job ' + str(job_id) + ' failed')
+                return status.get("output") or {}
+            time.sleep(DEFAULT_JOB_POLL_SECONDS)
+
+    def _remote_error(self, e):
+        if str(e).find("directory not found") != -1:
+            return exceptions.FileNotFoundException(str(e))
+        return Exception('error getting remote object. ' + str(e))
+
+    def get_remotes(self, extra_args=[]):
+        logging.debug('listing remotes over rc')
+        try:
+            remotes = self.call("config/listremotes").get("remotes") or []
+        except Exception as e:
+            raise self._remote_error(e)
+        return [remote + ':' for remote in remotes]
+
+    def lsjson(self, remote, directory, extra_args=[], no_error=False):
+        logging.debug('running operations/list for ' + remote + directory)
+        opt = {"recurse": "--recursive" in extra_args or "-R" in extra_args}
+        params = {"fs": remote + directory, "remote": "", "opt": opt}
+        if "--max-age" in extra_args:
+            params["_filter"] = {"MaxAge": extra_args[extra_args.index("--max-age") + 1]}
+        try:
+            rows = self.call("operations/list", params)
+        except Exception as e:
+            error = self._remote_error(e)
+            # Only a missing directory is an empty listing; any other failure is not.
+            if no_error and isinstance(error, exceptions.FileNotFoundException):
+                return '[]'
+            raise error
+        return json.dumps(rows.get("list") or [])
+
+    def lsjson_rows(self, remote, directory, extra_args=[], no_error=False):
+        return json.loads(self.lsjson(remote, directory, extra_args, no_error))
+
+    def md5sum(self, remote, directory, extra_args=[], no_error=False):
+        logging.debug('running operations/hashsum for ' + remote + directory)
+        try:
+            out = self.call("operations/hashsum", {"fs": remote + directory, "hashType": "md5"})
+        except Exception as e:
+            error = self._remote_error(e)
+            if no_error and isinstance(error, exceptions.FileNotFoundException):
+                return ''
+            raise error
+        lines = out.get("hashsum") or []
+        return "\n".join(lines) + ("\n" if lines else "")
+
+    def get_about_json_with_error(self, remote):
+        logging.debug('running operations/about for ' + remote)
+        try:
+            return self.call("operations/about", {"fs": remote}), None
+        except Exception as e:
+            return None, str(e)
+
+    def mkdir(self, remote, directory):
+        try:
+            self.call("operations/mkdir", {"fs": remote + directory, "remote": ""})
+        except Exception as e:
+            raise self._remote_error(e)
+        return []
+
+    def rmdir(self, remote, directory):
+        try:
+            self.call("operations/rmdir", {"fs": remote + directory, "remote": ""})
+        except Exception as e:
+            raise self._remote_error(e)
+        return []
+
+    def delete_file(self, remote, file):
+        parent, name = _split_path(remote + file)
+        try:
+            self.call("operations/deletefile", {"fs": parent, "remote": name})
+        except Exception as e:
+            raise self._remote_error(e)
+        return []
+
+    def delete(self, remote, file):
+        try:
+            self._call_job("operations/delete", {"fs": remote + file})
+        except Exception as e:
+            raise self._remote_error(e)
+        return []
+
+    def copy(self, src, dst, extra_args=[], no_error=False):
+        if extra_args or not os.path.isfile(src):
+            return rclone.RClone.copy(self, src, dst, extra_args, no_error)
+        return self._transfer_local_file("operations/copyfile", src, dst, no_error)
+
+    def move(self, src, dst, extra_args=[]):
+        if extra_args or not os.path.isfile(src):
+            return rclone.RClone.move(self, src, dst, extra_args)
+        return self._transfer_local_file("operations/movefile", src, dst, False)
+
+    def _transfer_local_file(self, method, src, dst, no_error):
+        # Same effect as --min-age 6h for a single file: leave files still being written.
+        if os.path.getmtime(src) > time.time() - local_index.MIN_AGE_SECONDS:
+            logging.debug('skipping ' + src + ': modified less than 6h ago')
+            return []
+        logging.debug('running ' + method + ' from ' + src + ' to ' + dst)
+        parent, name = os.path.split(os.path.abspath(src))
+        try:
+            self._call_job(method, {
+                "srcFs": parent,
+                "srcRemote": name,
+                "dstFs": dst,
+                "dstRemote": name,
+            })
+        except Exception as e:
+            if no_error is False:
+                logging.error('error getting remotes objects')
+                raise Exception('error getting remote object. ' + str(e))
+        return []
+
+
+def _split_path(path):
+    if '/' in path:
+        return tuple(path.rsplit('/', 1))
+    remote, sep, name = path.partition(':')
+    return remote + sep, name
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+literal prefilters for regular expression searches over indexed paths
+"""
+__author__ = "Michael Montuori [michael.montuori@gmail.com]"
+__copyright__ = "Copyright 2017 Michael Montuori. All rights reserved."
+__credits__ = ["Warren Crigger"]
+__license__ = "GPLv3"
+__version__ = "1.2"
+__revision__ = "0"
+
+import re
+
+# The trigram index can only look up substrings of at least three characters.
+MIN_LITERAL_LENGTH = 3
+
+_QUANTIFIER = re.compile(r'\{(\d*)(,?)(\d*)\}')
+
+
+def regex_literals(pattern):
+    """Return substrings that every string matched by ``pattern`` contains.
+
+    Only the top level of the pattern is read: groups, character classes,
+    escapes such as ``\\d`` and ``.`` end a literal run, and a character
+    made optional by ``?``, ``*`` or ``{0,n}`` is dropped from it. A
+    top-level ``|`` or the verbose flag make every literal uncertain and
+    return an empty list. Literals shorter than ``MIN_LITERAL_LENGTH`` are
+    left out; the regular expression still has to be applied to every
+    candidate.
+    """
+    try:
+        if re.compile(pattern).flags & re.VERBOSE:
+            return []
+    except re.error:
+        return []
+    literals = []
+    current = []
+
+    def flush():
+        if len(current) >= MIN_LITERAL_LENGTH:
+            literals.append(''.join(current))
+        del current[:]
+
+    index = 0
+    while index < len(pattern):
+        char = pattern[index]
+        literal = None
+        if char == '|':
+            return []
+        if char == '\\' and index + 1 < len(pattern):
+            escaped = pattern[index + 1]
+            index += 2
+            if escaped.isalnum():
+                flush()
+                index = _skip_quantifier(pattern, index)[0]
+                continue
+            literal = escaped
+        elif char in '[(.^$':
+            if char == '[':
+                index = _skip_class(pattern, index)
+            elif char == '(':
+                index = _skip_group(pattern, index)
+            else:
+                index += 1
+            flush()
+            index = _skip_quantifier(pattern, index)[0]
+            continue
+        else:
+            literal = char
+            index += 1
+        index, minimum = _skip_quantifier(pattern, index)
+        if minimum is None:
+            current.append(literal)
+            continue
+        if minimum > 0:
+            current.append(literal)
+        flush()
+    flush()
+    return literals
+
+
+def _skip_class(pattern, index):
+    """Return the index after the character class starting at ``index``."""
+    index += 1
+    if index < len(pattern) and pattern[index] == '^':
+        index += 1
+    if index < len(pattern) and pattern[index] == ']':
+        index += 1
+    while index < len(pattern) and pattern[index] != ']':
+        index += 2 if pattern[index] == '\\' else 1
+    return index + 1
+
+
+def _skip_group(pattern, index):
+    """Return the index after the group starting at ``index``."""
+    depth = 0
+    while index < len(pattern):
+        char = pattern[index]
+        if char == '\\':
+            index += 2
+            continue
+        if char == '[':
+            index = _skip_class(pattern, index)
+            continue
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+            if depth == 0:
+                return index + 1
+        index += 1
+    return index
+
+
+def _skip_quantifier(pattern, index):
+    """Return ``(index after a quantifier, its minimum)``, or ``(index, None)`` without one."""
+    if index >= len(pattern):
+        return index, None
+    char = pattern[index]
+    if char in '*?+':
+        minimum = 1 if char == '+' else 0
+        index += 1
+    else:
+        match = _QUANTIFIER.match(pattern, index)
+        if match is None or (match.group(1) == '' and match.group(3) == ''):
+            return index, None
+        minimum = int(match.group(1) or 0)
+        index = match.end()
+    if index < len(pattern) and pattern[index] in '?+':
+        # Lazy or possessive form of the same quantifier.
+        index += 1
+    return index, minimum
@@ -11,6 +11,7 @@ import os
 import shutil
 import sqlite3
 import stat
+import threading
 from contextlib import contextmanager
 
 
@@ -20,6 +21,27 @@ DEFAULT_CACHE_TTL_HOURS = 72
 DEFAULT_CLEAN_INVALID = "quarantine"
 DEFAULT_REFRESH_MODE = "stale"
 
+# Applied to every registry connection; journal_mode=WAL is persistent and set once in _init_db.
+CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=10000",
+    "PRAGMA cache_size=-16384",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA temp_store=MEMORY",
+)
+LS_FILES_COLUMNS = "account_id, path, parent, name, size, mod_time, is_dir, mime_type, file_id, md5"
+CACHED_STATEMENTS = 256
+
+_REMOTE_QUOTA_SELECT = """
+    SELECT
+        a.id AS account_id,
+        a.remote_name,
+        q.total, q.used, q.free, q.trashed, q.other, q.objects,
+        q.last_about_at, q.last_error
+    FROM accounts a
+    LEFT JOIN quota_cache q ON q.account_id = a.id
+"""
+
 REQUIRED_FIELDS = [
     "type",
     "project_id",
@@ -46,11 +68,16 @@ class ImportResult(object):
 
 
 class ServiceAccountRegistry(object):
-    def __init__(self, db_path=None, store_dir=None, cache_ttl_hours=DEFAULT_CACHE_TTL_HOURS):
+    def __init__(self, db_path=None, store_dir=None, cache_ttl_hours=DEFAULT_CACHE_TTL_HOURS, search_index=False):
         self.db_path = os.path.abspath(os.path.expanduser(db_path or DEFAULT_DB_PATH))
         self.store_dir = os.path.abspath(os.path.expanduser(store_dir or DEFAULT_STORE_DIR))
         self.quarantine_dir = os.path.join(self.store_dir, "quarantine")
         self.cache_ttl_hours = int(cache_ttl_hours)
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._remote_index = None
+        self._search_index = search_index is True
         self._ensure_dirs()
         self._init_db()
 
@@ -65,18 +92,81 @@ class ServiceAccountRegistry(object):
         os.chmod(self.store_dir, 0o700)
         os.chmod(self.quarantine_dir, 0o700)
 
+    def _connection(self):
+        """Return this thread's registry connection, opening it on first use.
+
+        Connections stay open while their thread lives so SQLite's page
+        cache and prepared statements survive between queries. Worker pools
+        come and go with every concurrent listing, so opening a connection
+        first closes those of threads that have exited. A forked child opens
+        its own instead of sharing the parent's.
+        """
+        local = self._local
+        conn = getattr(local, 'conn', None)
+        if conn is not None and local.pid == os.getpid():
+            return conn
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, cached_statements=CACHED_STATEMENTS)
+        conn.row_factory = sqlite3.Row
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        local.conn = conn
+        local.pid = os.getpid()
+        local.depth = 0
+        with self._connections_lock:
+            finished = [item for item in self._connections if not item[0].is_alive()]
+            self._connections = [item for item in self._connections if item[0].is_alive()]
+            self._connections.append((threading.current_thread(), conn))
+        for _thread, finished_conn in finished:
+            self._close_connection(finished_conn)
+        return conn
+
+    @staticmethod
+    def _close_connection(conn):
+        try:
+            conn.close()
+        except sqlite3.Error as e:
+            logging.debug('cannot close registry connection: ' + str(e))
+
     @contextmanager
     def _connect(self):
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
+        """Yield this thread's connection inside a transaction.
+
+        Nested calls, including those inside ``batch``, join the outermost
+        transaction, which commits once on exit or rolls back on error.
+        """
+        conn = self._connection()
+        local = self._local
+        if local.depth > 0:
+            local.depth += 1
+            try:
+                yield conn
+            finally:
+                local.depth -= 1
+            return
+        local.depth = 1
         try:
             with conn:
                 yield conn
         finally:
-            conn.close()
+            local.depth = 0
+
+    @contextmanager
+    def batch(self):
+        """Run every registry write of the block in a single transaction."""
+        with self._connect():
+            yield self
+
+    def close(self):
+        """Close the connections of every thread."""
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for _thread, conn in connections:
+            self._close_connection(conn)
+        self._local = threading.local()
 
     def _init_db(self):
         with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
             conn.execute("""
                 CREATE TABLE IF NOT EXISTS accounts (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -115,11 +205,13 @@ class ServiceAccountRegistry(object):
                 CREATE TABLE IF NOT EXISTS ls_cache (
                     account_id INTEGER NOT NULL,
                     path TEXT NOT NULL,
-                    json_text TEXT NOT NULL,
+                    json_text TEXT NOT NULL DEFAULT '',
                     object_count INTEGER,
                     dir_count INTEGER,
                     file_count INTEGER,
                     last_lsjson_at TEXT,
+                    last_full_lsjson_at TEXT,
+                    expired INTEGER NOT NULL DEFAULT 0,
                     last_error TEXT,
                     updated_at TEXT NOT NULL,
                     PRIMARY KEY(account_id, path),
@@ -133,6 +225,106 @@ class ServiceAccountRegistry(object):
             conn.execute("CREATE INDEX IF NOT EXISTS idx_accounts_source ON accounts(source_path)")
             conn.execute("CREATE INDEX IF NOT EXISTS idx_accounts_remote ON accounts(remote_name)")
             conn.execute("CREATE INDEX IF NOT EXISTS idx_ls_cache_path ON ls_cache(path)")
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(ls_files)")]
+            keyed_by_path = bool(columns) and "id" not in columns
+            if keyed_by_path:
+                # Older versions kept one row per path, which cannot hold Drive duplicates.
+                self._drop_search_index(conn)
+                conn.execute("DROP INDEX IF EXISTS idx_ls_files_parent")
+                conn.execute("ALTER TABLE ls_files RENAME TO ls_files_by_path")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS ls_files (
+                    id INTEGER PRIMARY KEY,
+                    account_id INTEGER NOT NULL,
+                    path TEXT NOT NULL,
+                    parent TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    size INTEGER,
+                    mod_time TEXT,
+                    is_dir INTEGER NOT NULL,
+                    mime_type TEXT,
+                    file_id TEXT,
+                    md5 TEXT,
+                    FOREIGN KEY(account_id) REFERENCES accounts(id)
+                )
+            """)
+            if keyed_by_path:
+                conn.execute(
+                    "INSERT INTO ls_files (" + LS_FILES_COLUMNS + ") SELECT " + LS_FILES_COLUMNS +
+                    " FROM ls_files_by_path"
+                )
+                conn.execute("DROP TABLE ls_files_by_path")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_ls_files_path ON ls_files(account_id, path)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_ls_files_parent ON ls_files(account_id, parent)")
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(ls_cache)")]
+            if "last_full_lsjson_at" not in columns:
+                # Older listings have no known full listing time; the first delta refresh lists fully.
+                conn.execute("ALTER TABLE ls_cache ADD COLUMN last_full_lsjson_at TEXT")
+                conn.execute("ALTER TABLE ls_cache ADD COLUMN expired INTEGER NOT NULL DEFAULT 0")
+            self._migrate_ls_cache_json(conn)
+            if self._search_index:
+                self._search_index = self._init_search_index(conn)
+            else:
+                self._drop_search_index(conn)
+
+    def _init_search_index(self, conn):
+        """Keep a trigram full-text index of the ls_files paths; False when SQLite lacks FTS5 trigrams."""
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='ls_files_search'"
+        ).fetchone() is not None
+        if not exists:
+            try:
+                conn.execute("""
+                    CREATE VIRTUAL TABLE ls_files_search USING fts5(
+                        path, content='ls_files', content_rowid='rowid', tokenize='trigram'
+                    )
+                """)
+            except sqlite3.OperationalError as e:
+                logging.debug('no trigram search index for cached listings: ' + str(e))
+                return False
+            conn.execute("INSERT INTO ls_files_search(ls_files_search) VALUES ('rebuild')")
+        conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS ls_files_search_insert AFTER INSERT ON ls_files BEGIN
+                INSERT INTO ls_files_search(rowid, path) VALUES (new.rowid, new.path);
+            END
+        """)
+        conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS ls_files_search_delete AFTER DELETE ON ls_files BEGIN
+                INSERT INTO ls_files_search(ls_files_search, rowid, path) VALUES ('delete', old.rowid, old.path);
+            END
+        """)
+        conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS ls_files_search_update AFTER UPDATE OF path ON ls_files BEGIN
+                INSERT INTO ls_files_search(ls_files_search, rowid, path) VALUES ('delete', old.rowid, old.path);
+                INSERT INTO ls_files_search(rowid, path) VALUES (new.rowid, new.path);
+            END
+        """)
+        return True
+
+    def _drop_search_index(self, conn):
+        """Remove the trigram index and its triggers, so ls_files writes no longer pay for it."""
+        for trigger in ("ls_files_search_insert", "ls_files_search_delete", "ls_files_search_update"):
+            conn.execute("DROP TRIGGER IF EXISTS " + trigger)
+        try:
+            conn.execute("DROP TABLE IF EXISTS ls_files_search")
+        except sqlite3.OperationalError as e:
+            logging.debug('could not drop the trigram search index: ' + str(e))
+
+    def _migrate_ls_cache_json(self, conn):
+        """Move listings stored as JSON blobs by older versions into ls_files."""
+        rows = conn.execute(
+            "SELECT account_id, path, json_text FROM ls_cache WHERE json_text != ''"
+        ).fetchall()
+        for row in rows:
+            try:
+                listing = json.loads(row["json_text"])
+            except Exception:
+                listing = []
+            self._write_ls_files(conn, row["account_id"], row["path"], listing)
+            conn.execute(
+                "UPDATE ls_cache SET json_text='' WHERE account_id=? AND path=?",
+                (row["account_id"], row["path"]),
+            )
 
     def import_paths(
             self,
@@ -492,22 +684,57 @@ class ServiceAccountRegistry(object):
                     """,
                     (remote, now, managed_path),
                 )
+        self._remote_index = None
+
+    def account_id_for_remote(self, remote):
+        """Return the active account id behind ``remote`` (``dst101:`` or ``dst101``), or None.
+
+        The remote-name index is read once and rebuilt after this registry
+        assigns remote names or disables accounts.
+        """
+        index = self._remote_index
+        if index is None:
+            with self._connect() as conn:
+                rows = conn.execute(
+                    "SELECT id, remote_name FROM accounts "
+                    "WHERE status='active' AND remote_name IS NOT NULL ORDER BY id"
+                ).fetchall()
+            index = {}
+            for row in rows:
+                index.setdefault(row["remote_name"], row["id"])
+            self._remote_index = index
+        return index.get(remote.rstrip(":"))
 
     def quota_by_remote(self, remote):
-        remote_name = remote.rstrip(":")
+        account_id = self.account_id_for_remote(remote)
+        if account_id is None:
+            return None
         with self._connect() as conn:
-            return conn.execute("""
-                SELECT
-                    a.id AS account_id,
-                    a.remote_name,
-                    q.total, q.used, q.free, q.trashed, q.other, q.objects,
-                    q.last_about_at, q.last_error
-                FROM accounts a
-                LEFT JOIN quota_cache q ON q.account_id = a.id
-                WHERE a.status='active' AND a.remote_name=?
-                ORDER BY a.id
-                LIMIT 1
-            """, (remote_name,)).fetchone()
+            return conn.execute(
+                _REMOTE_QUOTA_SELECT + " WHERE a.status='active' AND a.id=?",
+                (account_id,),
+            ).fetchone()
+
+    def quotas_by_remote(self, remotes):
+        """Return ``{remote: quota row}`` for every remote of ``remotes`` backed by an account.
+
+        One query answers all remotes; the rows look like ``quota_by_remote``'s.
+        """
+        wanted = dict((remote.rstrip(":"), remote) for remote in remotes)
+        with self._connect() as conn:
+            rows = conn.execute(
+                _REMOTE_QUOTA_SELECT + " WHERE a.status='active' AND a.remote_name IS NOT NULL ORDER BY a.id"
+            ).fetchall()
+        index = {}
+        quotas = {}
+        for row in rows:
+            if row["remote_name"] in index:
+                continue
+            index[row["remote_name"]] = row["account_id"]
+            if row["remote_name"] in wanted:
+                quotas[wanted[row["remote_name"]]] = row
+        self._remote_index = index
+        return quotas
 
     def quota_by_account_id(self, account_id):
         with self._connect() as conn:
@@ -516,6 +743,13 @@ class ServiceAccountRegistry(object):
                 (account_id,),
             ).fetchone()
 
+    def quotas_by_account_id(self, account_ids):
+        """Return ``{account_id: quota_cache row}`` for ``account_ids`` in one query."""
+        wanted = set(account_ids)
+        with self._connect() as conn:
+            rows = conn.execute("SELECT * FROM quota_cache").fetchall()
+        return dict((row["account_id"], row) for row in rows if row["account_id"] in wanted)
+
     def should_refresh(self, quota_row, mode):
         if mode == "none":
             return False
@@ -538,10 +772,10 @@ class ServiceAccountRegistry(object):
         return age.total_seconds() > self.cache_ttl_hours * 3600
 
     def ls_cache_by_remote(self, remote, path):
-        account = self.quota_by_remote(remote)
-        if account is None:
+        account_id = self.account_id_for_remote(remote)
+        if account_id is None:
             return None
-        return self.ls_cache_by_account_id(account["account_id"], path)
+        return self.ls_cache_by_account_id(account_id, path)
 
     def ls_cache_by_account_id(self, account_id, path):
         with self._connect() as conn:
@@ -557,19 +791,26 @@ class ServiceAccountRegistry(object):
             return True
         if cache_row is None or cache_row["last_lsjson_at"] is None:
             return mode in ("missing", "stale")
+        if cache_row["expired"]:
+            return True
         if mode == "missing":
             return False
         if mode == "stale":
             return self.is_stale(cache_row["last_lsjson_at"])
         return False
 
-    def update_ls_cache_for_remote(self, remote, path, json_text, error=None):
-        account = self.quota_by_remote(remote)
-        if account is None:
+    def update_ls_cache_for_remote(self, remote, path, listing, error=None):
+        account_id = self.account_id_for_remote(remote)
+        if account_id is None:
             return
-        self.update_ls_cache(account["account_id"], path, json_text, error)
+        self.update_ls_cache(account_id, path, listing, error)
 
-    def update_ls_cache(self, account_id, path, json_text=None, error=None):
+    def update_ls_cache(self, account_id, path, listing=None, error=None):
+        """Store a recursive listing of ``path`` (lsjson rows or their JSON text).
+
+        The rows replace everything previously indexed below ``path``; the
+        ``ls_cache`` row keeps the listing's counts, timestamp and last error.
+        """
         now = self._utcnow()
         path = self._normalize_cache_path(path)
         if error is not None:
@@ -583,7 +824,7 @@ class ServiceAccountRegistry(object):
                         INSERT INTO ls_cache (
                             account_id, path, json_text, last_lsjson_at, last_error, updated_at
                         ) VALUES (?, ?, ?, ?, ?, ?)
-                    """, (account_id, path, "[]", None, error, now))
+                    """, (account_id, path, "", None, error, now))
                 else:
                     conn.execute("""
                         UPDATE ls_cache
@@ -592,34 +833,304 @@ class ServiceAccountRegistry(object):
                     """, (error, now, account_id, path))
             return
 
-        json_text = json_text or "[]"
-        object_count, dir_count, file_count = self._lsjson_counts(json_text)
+        if isinstance(listing, str) or listing is None:
+            try:
+                listing = json.loads(listing or "[]")
+            except Exception:
+                listing = []
+        if not isinstance(listing, list):
+            listing = []
+        object_count, dir_count, file_count = self._lsjson_counts(listing)
         with self._connect() as conn:
+            self._write_ls_files(conn, account_id, path, listing)
             conn.execute("""
                 INSERT INTO ls_cache (
                     account_id, path, json_text, object_count, dir_count, file_count,
-                    last_lsjson_at, last_error, updated_at
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    last_lsjson_at, last_full_lsjson_at, expired, last_error, updated_at
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0, ?, ?)
                 ON CONFLICT(account_id, path) DO UPDATE SET
                     json_text=excluded.json_text,
                     object_count=excluded.object_count,
                     dir_count=excluded.dir_count,
                     file_count=excluded.file_count,
                     last_lsjson_at=excluded.last_lsjson_at,
+                    last_full_lsjson_at=excluded.last_full_lsjson_at,
+                    expired=0,
                     last_error=excluded.last_error,
                     updated_at=excluded.updated_at
             """, (
                 account_id,
                 path,
-                json_text,
+                "",
                 object_count,
                 dir_count,
                 file_count,
                 now,
+                now,
                 None,
                 now,
             ))
 
+    def ls_delta_age_for_remote(self, remote, path, full_refresh_hours):
+        """Seconds since the last listing of ``remote`` + ``path`` if a delta listing may refresh it.
+
+        A delta needs a listing of ``path`` itself whose last full listing
+        is less than ``full_refresh_hours`` old and that was not expired
+        because the remote's used bytes changed; otherwise None is returned
+        and the path has to be listed fully.
+        """
+        cache_row = self.ls_cache_by_remote(remote, path)
+        if cache_row is None or cache_row["last_full_lsjson_at"] is None or cache_row["expired"]:
+            return None
+        now = datetime.datetime.now(datetime.timezone.utc)
+
+        def age(value):
+            value = datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%SZ")
+            return (now - value.replace(tzinfo=datetime.timezone.utc)).total_seconds()
+
+        if age(cache_row["last_full_lsjson_at"]) > int(full_refresh_hours) * 3600:
+            return None
+        return max(0, age(cache_row["last_lsjson_at"]))
+
+    def merge_ls_cache_for_remote(self, remote, path, listing):
+        """Merge the rows of a delta listing of ``remote`` + ``path`` into its cached listing.
+
+        Rows replace the cached entries of the same objects and nothing is
+        removed. The listing time moves forward, the full listing time stays.
+        """
+        account_id = self.account_id_for_remote(remote)
+        if account_id is None:
+            return
+        now = self._utcnow()
+        path = self._normalize_cache_path(path)
+        prefix = '' if path == '/' else path
+        records = []
+        for row in listing:
+            if not isinstance(row, dict) or not row.get("Path"):
+                continue
+            file_path = self._normalize_cache_path(prefix + '/' + row["Path"])
+            records.append(self._ls_file_record(account_id, file_path, row))
+        low, high = self._subtree_range(path)
+        with self._connect() as conn:
+            self._replace_ls_files(conn, records)
+            counts = conn.execute("""
+                SELECT COUNT(*), COALESCE(SUM(is_dir), 0)
+                FROM ls_files WHERE account_id=? AND path>=? AND path<?
+            """, (account_id, low, high)).fetchone()
+            conn.execute("""
+                UPDATE ls_cache
+                SET object_count=?, dir_count=?, file_count=?, last_lsjson_at=?, expired=0,
+                    last_error=NULL, updated_at=?
+                WHERE account_id=? AND path=?
+            """, (counts[0], counts[1], counts[0] - counts[1], now, now, account_id, path))
+
+    def _write_ls_files(self, conn, account_id, path, listing):
+        low, high = self._subtree_range(path)
+        conn.execute(
+            "DELETE FROM ls_files WHERE account_id=? AND path>=? AND path<?",
+            (account_id, low, high),
+        )
+        prefix = '' if path == '/' else path
+        records = []
+        for row in listing:
+            if not isinstance(row, dict) or not row.get("Path"):
+                continue
+            file_path = self._normalize_cache_path(prefix + '/' + row["Path"])
+            records.append(self._ls_file_record(account_id, file_path, row))
+        # Drive can hold several objects under one path: every row is kept.
+        conn.executemany(
+            "INSERT INTO ls_files (" + LS_FILES_COLUMNS + ") VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            records,
+        )
+
+    def _replace_ls_files(self, conn, records):
+        """Insert ``records``, each replacing the cached row of the object it describes.
+
+        That is the row with the record's file id, or a row of the same path
+        without one. A record without a file id replaces the only row of its
+        path; when the path has several rows (Drive duplicates) it is not
+        known which object changed, and the rows are left as they are.
+        """
+        for record in records:
+            account_id, file_path, file_id = record[0], record[1], record[8]
+            rows = conn.execute(
+                "SELECT id, file_id FROM ls_files WHERE account_id=? AND path=?",
+                (account_id, file_path),
+            ).fetchall()
+            stale = [row[0] for row in rows if row[1] is None or (file_id is not None and row[1] == file_id)]
+            if file_id is None and not stale:
+                if len(rows) > 1:
+                    continue
+                stale = [row[0] for row in rows]
+                if rows:
+                    # Uploads overwrite the object in place, which keeps its id.
+                    record = record[:8] + (rows[0][1],) + record[9:]
+            conn.executemany("DELETE FROM ls_files WHERE id=?", [(row_id,) for row_id in stale])
+            conn.execute(
+                "INSERT INTO ls_files (" + LS_FILES_COLUMNS + ") VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                record,
+            )
+
+    def _ls_file_record(self, account_id, file_path, row):
+        parent, name = file_path.rsplit('/', 1)
+        hashes = row.get("Hashes") or {}
+        return (
+            account_id,
+            file_path,
+            parent or '/',
+            row.get("Name") or name,
+            row.get("Size"),
+            row.get("ModTime"),
+            1 if row.get("IsDir") else 0,
+            row.get("MimeType"),
+            row.get("ID"),
+            hashes.get("md5") or hashes.get("MD5"),
+        )
+
+    def patch_ls_cache_for_remote(self, remote, added=(), removed=()):
+        """Apply uploads and deletions made by Sprinkle to the cached listings of ``remote``.
+
+        ``added`` are lsjson rows whose ``Path`` is the full remote path; the
+        directories between a cached listing and the file are added with
+        them. ``removed`` are paths dropped together with everything below
+        them; when a removed path has Drive duplicates, only one of which
+        Sprinkle deleted, the remote's listings are expired instead. Paths
+        outside every cached listing are left alone, and listing counts and
+        timestamps keep the values of the last real listing.
+        """
+        account_id = self.account_id_for_remote(remote)
+        if account_id is None:
+            return
+        with self._connect() as conn:
+            roots = set(row[0] for row in conn.execute(
+                "SELECT path FROM ls_cache WHERE account_id=? AND last_lsjson_at IS NOT NULL",
+                (account_id,),
+            ))
+            if not roots:
+                return
+            for path in removed:
+                path = self._normalize_cache_path(path)
+                duplicates = conn.execute(
+                    "SELECT COUNT(*) FROM ls_files WHERE account_id=? AND path=? AND is_dir=0",
+                    (account_id, path),
+                ).fetchone()[0]
+                if duplicates > 1:
+                    conn.execute("UPDATE ls_cache SET expired=1 WHERE account_id=?", (account_id,))
+                    continue
+                low, high = self._subtree_range(path)
+                conn.execute(
+                    "DELETE FROM ls_files WHERE account_id=? AND (path=? OR (path>=? AND path<?))",
+                    (account_id, path, low, high),
+                )
+            files = []
+            directories = []
+            for row in added:
+                file_path = self._normalize_cache_path(row["Path"])
+                ancestors = self._path_ancestors(file_path)[1:]
+                covering = [index for index, ancestor in enumerate(ancestors) if ancestor in roots]
+                if not covering:
+                    continue
+                files.append(self._ls_file_record(account_id, file_path, row))
+                for directory in ancestors[:covering[0]]:
+                    directories.append(self._ls_file_record(account_id, directory, {
+                        "Size": -1, "ModTime": row.get("ModTime"), "IsDir": True,
+                        "MimeType": "inode/directory",
+                    }))
+            conn.executemany(
+                "INSERT INTO ls_files (" + LS_FILES_COLUMNS + ") SELECT ?, ?, ?, ?, ?, ?, ?, ?, ?, ? "
+                "WHERE NOT EXISTS (SELECT 1 FROM ls_files WHERE account_id=? AND path=?)",
+                [record + (record[0], record[1]) for record in directories],
+            )
+            self._replace_ls_files(conn, files)
+
+    def cached_listing_for_remote(self, remote, path, recursive=True, mode=DEFAULT_REFRESH_MODE):
+        """Return lsjson rows for ``remote`` + ``path`` from the file index, or None.
+
+        The nearest cached listing of ``path`` or one of its ancestors that
+        does not need a refresh under ``mode`` answers the request.
+        """
+        account_id = self.account_id_for_remote(remote)
+        if account_id is None:
+            return None
+        path = self._normalize_cache_path(path)
+        ancestors = self._path_ancestors(path)
+        with self._connect() as conn:
+            cached = conn.execute(
+                "SELECT * FROM ls_cache WHERE account_id=? AND path IN (" +
+                ",".join("?" for _ in ancestors) + ")",
+                [account_id] + ancestors,
+            ).fetchall()
+            cached = dict((row["path"], row) for row in cached)
+            for ancestor in ancestors:
+                row = cached.get(ancestor)
+                if row is not None and not self.should_refresh_ls_cache(row, mode):
+                    return self._ls_files(conn, account_id, path, recursive)
+        return None
+
+    def _ls_files(self, conn, account_id, path, recursive=True):
+        if recursive:
+            low, high = self._subtree_range(path)
+            rows = conn.execute(
+                "SELECT * FROM ls_files WHERE account_id=? AND path>=? AND path<? ORDER BY path, id",
+                (account_id, low, high),
+            )
+        else:
+            rows = conn.execute(
+                "SELECT * FROM ls_files WHERE account_id=? AND parent=? ORDER BY path, id",
+                (account_id, path),
+            )
+        offset = 1 if path == '/' else len(path) + 1
+        return [self._ls_item(row, offset) for row in rows]
+
+    @staticmethod
+    def _ls_item(row, offset):
+        item = {
+            "Path": row["path"][offset:],
+            "Name": row["name"],
+            "Size": row["size"],
+            "MimeType": row["mime_type"],
+            "ModTime": row["mod_time"],
+            "IsDir": bool(row["is_dir"]),
+        }
+        if row["file_id"] is not None:
+            item["ID"] = row["file_id"]
+        if row["md5"] is not None:
+            item["Hashes"] = {"md5": row["md5"]}
+        return item
+
+    def ls_cache_is_fresh_for_remote(self, remote, path, mode=DEFAULT_REFRESH_MODE):
+        """True when ``remote`` + ``path`` itself has a cached listing that ``mode`` does not refresh."""
+        cache_row = self.ls_cache_by_remote(remote, path)
+        return cache_row is not None and not self.should_refresh_ls_cache(cache_row, mode)
+
+    def search_ls_files_for_remote(self, remote, literals=()):
+        """Return the cached lsjson rows of ``remote`` whose paths contain every string of ``literals``.
+
+        ``Path`` is relative to the root, as in a listing of '/'. Literals of
+        three characters or more are looked up in the trigram index, case
+        insensitively; the caller still filters the rows. Without the index,
+        or without such literals, every cached row of the remote is returned.
+        """
+        account_id = self.account_id_for_remote(remote)
+        if account_id is None:
+            return []
+        literals = [literal for literal in literals if len(literal) >= 3]
+        with self._connect() as conn:
+            if self._search_index and literals:
+                rows = conn.execute("""
+                    SELECT f.* FROM ls_files_search s JOIN ls_files f ON f.rowid = s.rowid
+                    WHERE ls_files_search MATCH ? AND f.account_id=?
+                    ORDER BY f.path, f.id
+                """, (
+                    ' AND '.join('"' + literal.replace('"', '""') + '"' for literal in literals),
+                    account_id,
+                ))
+            else:
+                rows = conn.execute(
+                    "SELECT * FROM ls_files WHERE account_id=? ORDER BY path, id", (account_id,)
+                )
+            return [self._ls_item(row, 1) for row in rows]
+
     def ls_cache_summary(self):
         with self._connect() as conn:
             row = conn.execute("""
@@ -633,70 +1144,87 @@ class ServiceAccountRegistry(object):
             """).fetchone()
         return row
 
+    def expire_ls_cache_for_remote(self, remote):
+        """Mark the cached listings of ``remote`` for a full listing, keeping their rows until it replaces them."""
+        account_id = self.account_id_for_remote(remote)
+        if account_id is None:
+            return
+        with self._connect() as conn:
+            conn.execute("UPDATE ls_cache SET expired=1 WHERE account_id=?", (account_id,))
+
     def invalidate_ls_cache_for_remote(self, remote):
-        account = self.quota_by_remote(remote)
-        if account is None:
+        account_id = self.account_id_for_remote(remote)
+        if account_id is None:
             return
         with self._connect() as conn:
-            conn.execute("DELETE FROM ls_cache WHERE account_id=?", (account["account_id"],))
+            conn.execute("DELETE FROM ls_cache WHERE account_id=?", (account_id,))
+            conn.execute("DELETE FROM ls_files WHERE account_id=?", (account_id,))
 
     def update_quota_for_remote(self, remote, quota, error=None):
-        row = self.quota_by_remote(remote)
-        if row is None:
+        account_id = self.account_id_for_remote(remote)
+        if account_id is None:
             return
-        self.update_quota(row["account_id"], quota, error)
+        self.update_quota(account_id, quota, error)
 
     def update_quota(self, account_id, quota, error=None):
+        with self._connect() as conn:
+            self._write_quota(conn, account_id, quota, error, self._utcnow())
+
+    def update_quotas(self, results):
+        """Store many ``(account_id, quota, error)`` refresh results in one transaction."""
         now = self._utcnow()
+        with self._connect() as conn:
+            for account_id, quota, error in results:
+                self._write_quota(conn, account_id, quota, error, now)
+
+    def _write_quota(self, conn, account_id, quota, error, now):
         if error is not None:
-            with self._connect() as conn:
-                existing = conn.execute(
-                    "SELECT account_id FROM quota_cache WHERE account_id=?",
-                    (account_id,),
-                ).fetchone()
-                if existing is None:
-                    conn.execute("""
-                        INSERT INTO quota_cache (
-                            account_id, last_about_at, last_error, updated_at
-                        ) VALUES (?, ?, ?, ?)
-                    """, (account_id, None, error, now))
-                else:
-                    conn.execute("""
-                        UPDATE quota_cache
-                        SET last_error=?, updated_at=?
-                        WHERE account_id=?
-                    """, (error, now, account_id))
+            existing = conn.execute(
+                "SELECT account_id FROM quota_cache WHERE account_id=?",
+                (account_id,),
+            ).fetchone()
+            if existing is None:
+                conn.execute("""
+                    INSERT INTO quota_cache (
+                        account_id, last_about_at, last_error, updated_at
+                    ) VALUES (?, ?, ?, ?)
+                """, (account_id, None, error, now))
+            else:
+                conn.execute("""
+                    UPDATE quota_cache
+                    SET last_error=?, updated_at=?
+                    WHERE account_id=?
+                """, (error, now, account_id))
             return
         quota = quota or {}
         last_about_at = now if error is None else None
-        with self._connect() as conn:
-            conn.execute("""
-                INSERT INTO quota_cache (
-                    account_id, total, used, free, trashed, other, objects,
-                    last_about_at, last_error, updated_at
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ON CONFLICT(account_id) DO UPDATE SET
-                    total=excluded.total,
-                    used=excluded.used,
-                    free=excluded.free,
-                    trashed=excluded.trashed,
-                    other=excluded.other,
-                    objects=excluded.objects,
-                    last_about_at=excluded.last_about_at,
-                    last_error=excluded.last_error,
-                    updated_at=excluded.updated_at
-            """, (
-                account_id,
-                quota.get("total"),
-                quota.get("used"),
-                quota.get("free"),
-                quota.get("trashed"),
-                quota.get("other"),
-                quota.get("objects"),
-                last_about_at,
-                error,
-                now,
-            ))
+        conn.execute("""
+            INSERT INTO quota_cache (
+                account_id, total, used, free, trashed, other, objects,
+                last_about_at, last_error, updated_at
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(account_id) DO UPDATE SET
+                total=excluded.total,
+                used=excluded.used,
+                free=excluded.free,
+                trashed=excluded.trashed,
+                other=excluded.other,
+                objects=excluded.objects,
+                last_about_at=excluded.last_about_at,
+                last_error=excluded.last_error,
+                updated_at=excluded.updated_at
+        """, (
+            account_id,
+            quota.get("total"),
+            quota.get("used"),
+            quota.get("free"),
+            quota.get("trashed"),
+            quota.get("other"),
+            quota.get("objects"),
+            last_about_at,
+            error,
+            now,
+        ))
 
     def delete_active_account(self, account_id, reason):
         """Disable an active account and remove its managed and source JSON files."""
@@ -714,6 +1242,8 @@ class ServiceAccountRegistry(object):
             )
             conn.execute("DELETE FROM quota_cache WHERE account_id=?", (account_id,))
             conn.execute("DELETE FROM ls_cache WHERE account_id=?", (account_id,))
+            conn.execute("DELETE FROM ls_files WHERE account_id=?", (account_id,))
+        self._remote_index = None
         for path in sorted(set(path for path in (account['managed_path'], account['source_path']) if path)):
             try:
                 os.remove(path)
@@ -737,11 +1267,12 @@ class ServiceAccountRegistry(object):
                 """,
                 (reason, now, account_id),
             )
-            return cursor.rowcount > 0
+        self._remote_index = None
+        return cursor.rowcount > 0
 
     def mark_remote_quota_exhausted(self, remote):
-        account = self.quota_by_remote(remote)
-        if account is None:
+        account_id = self.account_id_for_remote(remote)
+        if account_id is None:
             return
         now = self._utcnow()
         with self._connect() as conn:
@@ -754,25 +1285,20 @@ class ServiceAccountRegistry(object):
                     last_about_at=excluded.last_about_at,
                     last_error=NULL,
                     updated_at=excluded.updated_at
-            """, (account["account_id"], now, now))
+            """, (account_id, now, now))
 
     def adjust_quota_for_remote(self, remote, byte_delta):
-        row = self.quota_by_remote(remote)
-        if row is None:
+        account_id = self.account_id_for_remote(remote)
+        if account_id is None:
             return
-        now = self._utcnow()
-        free = row["free"]
-        used = row["used"]
-        if free is not None:
-            free = max(0, free - int(byte_delta))
-        if used is not None:
-            used = used + int(byte_delta)
+        byte_delta = int(byte_delta)
+        # MAX() and + keep unknown (NULL) values unknown.
         with self._connect() as conn:
             conn.execute("""
                 UPDATE quota_cache
-                SET free=?, used=?, updated_at=?
+                SET free=MAX(0, free - ?), used=used + ?, updated_at=?
                 WHERE account_id=?
-            """, (free, used, now, row["account_id"]))
+            """, (byte_delta, byte_delta, self._utcnow(), account_id))
 
     def _normalize_cache_path(self, path):
         path = path or "/"
@@ -785,11 +1311,19 @@ class ServiceAccountRegistry(object):
             path = path[:-1]
         return path
 
-    def _lsjson_counts(self, json_text):
-        try:
-            rows = json.loads(json_text)
-        except Exception:
-            rows = []
+    def _subtree_range(self, path):
+        # Every path below ``path`` sorts between "path/" and "path0" ('0' follows '/').
+        prefix = '' if path == '/' else path
+        return prefix + '/', prefix + '0'
+
+    def _path_ancestors(self, path):
+        ancestors = [path]
+        while path != '/':
+            path = path.rsplit('/', 1)[0] or '/'
+            ancestors.append(path)
+        return ancestors
+
+    def _lsjson_counts(self, rows):
         object_count = len(rows) if isinstance(rows, list) else 0
         dir_count = 0
         file_count = 0
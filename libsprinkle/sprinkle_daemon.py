@@ -14,6 +14,8 @@ import time
 import os
 from libsprinkle import common
 from libsprinkle import clsync
+from libsprinkle import inotify
+from libsprinkle import local_index
 try:
     from daemons.prefab import run
 except:
@@ -21,11 +23,13 @@ except:
     quit()
 import logging
 
+DEFAULT_DEBOUNCE_SECONDS = 30
+
 class SprinkleDaemon(run.RunDaemon):
 
     def __init__(self, config, local_dir):
         logging.info('initializing daemon mode on ' + os.name + '...')
-        if config['daemon_type'] != 'interval':
+        if config['daemon_type'] not in ('interval', 'ondemand'):
             raise Exception('daemon type "' + config['daemon_type'] + '" is not supported')
         if os.name == 'nt':
             raise Exception('daemon cannot run on Windows')
@@ -36,12 +40,85 @@ class SprinkleDaemon(run.RunDaemon):
         super(run.RunDaemon, self).__init__(pidfile=config['daemon_pidfile'])
 
     def run(self):
+        if self.__config['daemon_type'] == 'ondemand':
+            return self.run_ondemand()
         logging.info('starting daemom to backup path: ' + self.__local_dir)
         sleep_interval = self.__config['daemon_interval'] * 60
+        # One engine for the daemon's lifetime keeps listings, quotas and hash state warm.
+        __cl_sync = clsync.ClSync(self.__config)
         while True:
-            __cl_sync = clsync.ClSync(self.__config)
+            __cl_sync.refresh_remote_state()
             local_dir = common.remove_ending_slash(self.__local_dir)
             common.print_line('backing up ' + local_dir + '...')
             __cl_sync.backup(local_dir, self.__config['delete_files'], self.__config['dry_run'])
             logging.info('sleeping for ' + str(sleep_interval) + ' seconds...')
             time.sleep(sleep_interval)
+
+    def run_ondemand(self):
+        """Back up the subtrees that inotify reports as changed.
+
+        Changed directories are backed up once they have been quiet for
+        ``daemon_debounce_seconds``, and once more when their new files are
+        old enough for rclone's ``--min-age``. A full backup runs at start
+        and whenever the inotify queue overflowed.
+        """
+        local_dir = common.remove_ending_slash(self.__local_dir)
+        logging.info('starting on-demand daemon to backup path: ' + local_dir)
+        cl_sync = clsync.ClSync(self.__config)
+        debounce = self.__config.get('daemon_debounce_seconds', DEFAULT_DEBOUNCE_SECONDS)
+        dirty = inotify.DirtySet(debounce)
+        aging = inotify.DirtySet(local_index.MIN_AGE_SECONDS + debounce)
+        # Watch before the first backup so that nothing changed during it is missed.
+        with inotify.Watcher(local_dir) as watcher:
+            logging.info('watching ' + str(watcher.watch_count()) + ' directories')
+            remote_root = cl_sync.get_backup_remote_root(local_dir)
+            full_backup = True
+            while True:
+                if full_backup:
+                    dirty.clear()
+                    aging.clear()
+                    cl_sync.refresh_remote_state()
+                    self._backup_subtrees(cl_sync, local_dir, remote_root, [local_dir])
+                    full_backup = False
+                now = time.monotonic()
+                due = [when for when in (dirty.next_due(), aging.next_due()) if when is not None]
+                timeout = max(0, min(due) - now) if due else None
+                for event in watcher.read(timeout):
+                    if event.directory is None:
+                        full_backup = True
+                        continue
+                    directory = self._clamp_to_root(local_dir, event.directory)
+                    dirty.add(directory)
+                    aging.add(directory)
+                if full_backup:
+                    watcher.watch_tree(local_dir)
+                    continue
+                now = time.monotonic()
+                ready = inotify.collapse(dirty.pop_ready(now) + aging.pop_ready(now))
+                if ready:
+                    cl_sync.refresh_remote_state()
+                    self._backup_subtrees(cl_sync, local_dir, remote_root, ready)
+
+    def _clamp_to_root(self, local_dir, directory):
+        root = os.path.abspath(local_dir)
+        directory = os.path.abspath(directory)
+        if directory != root and not directory.startswith(root.rstrip(os.sep) + os.sep):
+            return root
+        return directory
+
+    def _backup_subtrees(self, cl_sync, local_dir, remote_root, directories):
+        root = os.path.abspath(local_dir)
+        for directory in directories:
+            # A deleted directory is backed up through its closest remaining parent.
+            while directory != root and not os.path.isdir(directory):
+                directory = os.path.dirname(directory)
+            if directory == root:
+                source, target = local_dir, None
+            else:
+                rel_path = os.path.relpath(directory, root).replace('\\', '/')
+                source, target = directory, remote_root.rstrip('/') + '/' + rel_path
+            common.print_line('backing up ' + source + '...')
+            try:
+                cl_sync.backup(source, self.__config['delete_files'], self.__config['dry_run'], target)
+            except Exception as e:
+                logging.error('backup of ' + source + ' failed: ' + str(e))
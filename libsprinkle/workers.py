@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+bounded worker pools used to run rclone operations concurrently
+"""
+__author__ = "Michael Montuori [michael.montuori@gmail.com]"
+__copyright__ = "Copyright 2017 Michael Montuori. All rights reserved."
+__credits__ = ["Warren Crigger"]
+__license__ = "GPLv3"
+__version__ = "1.2"
+__revision__ = "0"
+
+import collections
+import itertools
+import logging
+import threading
+import time
+from concurrent import futures
+from contextlib import contextmanager
+
+
+def run_jobs(jobs, workers=1):
+    """Run ``jobs`` (callables) on at most ``workers`` threads.
+
+    Returns the job results in submission order once every job has finished.
+    Jobs are expected to handle their own errors; an exception escaping a
+    job is logged and re-raised after the remaining jobs have completed.
+    """
+    jobs = list(jobs)
+    if workers <= 1 or len(jobs) < 2:
+        return [job() for job in jobs]
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = [executor.submit(job) for job in jobs]
+        futures.wait(pending)
+    first_error = None
+    for future in pending:
+        error = future.exception()
+        if error is not None:
+            logging.error('worker job failed: ' + str(error))
+            if first_error is None:
+                first_error = error
+    if first_error is not None:
+        raise first_error
+    return [future.result() for future in pending]
+
+
+def ordered_map(func, items, workers=1):
+    """Yield ``(item, func(item))`` in the order of ``items``.
+
+    At most ``workers`` calls are in flight. Closing the generator early
+    cancels the calls that have not started yet and returns without
+    waiting for the running ones: they finish on their worker threads and
+    their results are dropped. An exception raised by ``func`` is re-raised
+    when its item is reached.
+    """
+    items = list(items)
+    if workers <= 1 or len(items) < 2:
+        for item in items:
+            yield item, func(item)
+        return
+    executor = futures.ThreadPoolExecutor(max_workers=workers)
+    pending = collections.deque()
+    iterator = iter(items)
+    try:
+        for item in itertools.islice(iterator, workers):
+            pending.append((item, executor.submit(func, item)))
+        while pending:
+            item, future = pending.popleft()
+            result = future.result()
+            for next_item in itertools.islice(iterator, 1):
+                pending.append((next_item, executor.submit(func, next_item)))
+            yield item, result
+    finally:
+        for _item, future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+class RemoteSlots(object):
+    """Limit the number of concurrent operations per rclone remote."""
+
+    def __init__(self, per_remote=1):
+        self._per_remote = max(1, int(per_remote))
+        self._lock = threading.Lock()
+        self._semaphores = {}
+
+    @contextmanager
+    def slot(self, remote):
+        with self._lock:
+            semaphore = self._semaphores.get(remote)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(self._per_remote)
+                self._semaphores[remote] = semaphore
+        with semaphore:
+            yield
+
+
+class CapacityReservations(object):
+    """Bytes promised to in-flight uploads, per remote.
+
+    Free space checks subtract the reserved bytes so that concurrent
+    placements cannot hand the same headroom to two files.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._reserved = {}
+
+    def reserved(self, remote):
+        with self.lock:
+            return self._reserved.get(remote, 0)
+
+    def add(self, remote, size):
+        with self.lock:
+            self._reserved[remote] = self._reserved.get(remote, 0) + int(size)
+
+    def release(self, remote, size):
+        with self.lock:
+            remaining = self._reserved.get(remote, 0) - int(size)
+            if remaining > 0:
+                self._reserved[remote] = remaining
+            else:
+                self._reserved.pop(remote, None)
+
+
+class RateLimiter(object):
+    """Space calls so that at most ``rate`` of them start per second.
+
+    A rate of 0 (or None) disables limiting.
+    """
+
+    def __init__(self, rate=0, clock=time.monotonic, sleep=time.sleep):
+        self._interval = 1.0 / rate if rate else 0
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._next_start = 0
+
+    def wait(self):
+        if not self._interval:
+            return
+        with self._lock:
+            now = self._clock()
+            start = max(now, self._next_start)
+            self._next_start = start + self._interval
+        if start > now:
+            self._sleep(start - now)
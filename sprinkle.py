@@ -12,11 +12,15 @@ __docformat__ = "reStructuredText"
 
 from libsprinkle import clsync
 from libsprinkle import rclone
+from libsprinkle import rclone_rc
 from libsprinkle import config
 from libsprinkle import common
+from libsprinkle import local_index
+from libsprinkle import placement
 from libsprinkle import service_accounts
 from libsprinkle import smtp_email
 from libsprinkle import sprinkle_daemon
+from libsprinkle import workers
 import logging
 import getopt
 import sys
@@ -44,6 +48,10 @@ DEFAULT_RCLONE_ENV_VALUES = (
 
 RESERVED_RCLONE_ENV_KEYS = ("RCLONE_CONFIG",)
 
+DEFAULT_SA_REFRESH_WORKERS = 8
+DEFAULT_SA_REFRESH_RATE = 10
+SA_QUOTA_WRITE_BATCH = 100
+
 
 def default_config_path():
     return os.path.join(os.path.expanduser("~"), ".sprinkle", "sprinkle.conf")
@@ -170,8 +178,10 @@ OPTIONS:
     -h, --help                   help
     -v, --verbose                set RCLONE_VERBOSE=1 for rclone
     --version                    print version
+    --batch-transfers            upload files of one directory with a single rclone --files-from run
     --check-prereq               chech prerequisites
     --comp-method {size|md5}     compare method [size|md5] (default:size)
+    --daemon-debounce-seconds {num} seconds a changed directory must be quiet before an ondemand backup (default:30)
     --daemon-interval            interval for the daemon to execute in minutes (default:60)
     --daemon-mode                start sprinkle in daemon mode
     --daemon-pidfile             daemon pidfile (default:/var/run/sprinkle.pid or /tmp/sprinkle.pid)
@@ -179,11 +189,20 @@ OPTIONS:
     --delete-files               do not delete files on remote end (default:false)
     --display-unit {G|M|K|B}     display unit (G)igabytes, (M)egabytes, (K)ilobytes, or (B)ites
     --dist-type {mas}            distribution type (default:mas)
+    --placement-strategy {mas|pack} place new files on the most free remote or bin-pack them up front (default:mas)
     --dry-run                    perform a dry run without actually backing up
+    --rebalance-min-free {bytes} free bytes rebalance restores on every remote (default:large-file headroom)
+    --rebalance-max-bytes {bytes} stop rebalancing after moving this many bytes, 0 = unlimited (default:0)
     --exclude-file {file}        file containing the backup exclude paths
     --exclude-regex {regex}      regular expression to match for file backup exclusion
     --log-file {file}            logs output to the specified file
     --no-cache                   turn off caching
+    --ls-cache-ttl-minutes {num} minutes a remote listing is kept in memory (default:720)
+    --ls-delta                   refresh cached remote listings with files modified since the last listing (default:false)
+    --ls-full-refresh-hours {hours} hours between full listings with --ls-delta (default:168)
+    --ls-search-index            keep a trigram index of cached listings for find (default:false)
+    --no-hash-cache              hash every file again with compare_method=md5 (default:false)
+    --hash-workers {num}         number of local files hashed concurrently (default:1)
     --rclone-conf {config file}  rclone configuration (default:None)
     --rclone-env-file {file}     file with environment variables for rclone
     --rclone-sa-dir {dir}        build rclone config from service accounts
@@ -193,16 +212,29 @@ OPTIONS:
     --sa-store {dir}             managed service account store
     --sa-cache-ttl-hours {num}   hours before cached SA quota is stale (default:72)
     --sa-refresh {mode}          SA quota refresh [missing|stale|all|none] (default:stale)
+    --sa-refresh-workers {num}   concurrent SA quota refreshes (default:8)
+    --sa-refresh-rate {num}      max SA quota refreshes started per second, 0 = unlimited (default:10)
     --sa-clean-invalid {mode}    invalid SA cleanup [none|quarantine|delete] (default:quarantine)
     --sa-delete-account-not-found delete SA JSON files after a confirmed account-not-found error
     --sa-group-size {num}        preferred SA grouping size for generated operator configs
     --rclone-exe {rclone_exe}    rclone executable (default:rclone)
+    --rclone-backend {mode}      run rclone as [subprocess|rcd] (default:subprocess)
+    --rclone-rc-url {url}        use an already running rclone rcd instead of starting one
+    --rclone-rc-timeout-seconds {num} seconds to wait for one rclone rcd request (default:1800)
     --rclone-move                use 'rclone move' instead of 'rclone copy' (default:false)
     --restore-duplicates         restore files if duplicates are found (default:false)
+    --resume                     continue the interrupted backup recorded in the backup journal,
+                                 or skip files a restore already pulled and verified
     --retries {num_retries}      number of retries (default:1)
+    --transfer-workers {num}     number of concurrent backup transfers (default:1)
+    --transfer-workers-per-remote {num} concurrent transfers per remote (default:2)
     --progress                   show progress
     --single-instance            make sure only 1 concurrent instance of sprinkle is running (default:False)
     --ls-stop-first              stop listing after first remote with files (default:true)
+    --ls-workers {num}           number of remotes listed concurrently (default:4)
+    --local-snapshot             index local sources incrementally from a snapshot (default:false)
+    --local-index-db {path}      local snapshot database (default:~/.sprinkle/local-index.sqlite3)
+    --local-snapshot-full-scan-hours {hours} hours between full local scans (default:24)
     """
     return
 
@@ -220,6 +252,7 @@ COMMANDS:
     sa-stats                     display imported service account statistics
     restore                      restore files from clustered drives
     removedups                   removes duplicate files
+    rebalance                    move files server-side from full to empty remotes
     """
     return
 
@@ -364,6 +397,7 @@ EXAMPLES:
     sprinkle.py --drive-id XXXXX backup hidrive:public/Manga
     sprinkle.py --drive-id XXXXX --rclone-sa-dir /etc/rclone/sa backup /backup
     sprinkle.py backup hidrive:public/Manga backup:mirror/Manga
+    sprinkle.py --drive-id XXXXX --resume backup /backup
     """
     print(usage_backup.__doc__)
     print(usage_options.__doc__)
@@ -381,6 +415,9 @@ SYNOPSIS:
 
 DESCRIPTION:
     Restores the remote directories from the rclone drives to the local directory specified.
+    Each remote that holds files below the remote directory transfers exactly those files with
+    one rclone --files-from run, --transfer-workers remotes at a time. Restored files are checked
+    by size, or by md5 with compare_method=md5. --resume skips files that are already restored.
 
 ARGUMENTS:
     remote dir
@@ -391,6 +428,7 @@ ARGUMENTS:
 
 EXAMPLES:
     sprinkle.py restore /backup c:/backup
+    sprinkle.py --resume --transfer-workers 4 restore /backup /mnt/restore
     """
     print(usage_restore.__doc__)
     print(usage_options.__doc__)
@@ -522,6 +560,35 @@ EXAMPLES:
     print(credits.__doc__)
 
 
+def usage_rebalance():
+    """
+NAME:
+    sprinkle rebalance - move files server-side from full to empty remote volumes
+
+SYNOPSIS:
+    sprinkle.py [options] rebalance [path]
+
+DESCRIPTION:
+    Plans moves of files below path from remotes with less than --rebalance-min-free bytes free to
+    remotes with spare space, so that large files fit again. Moves are server-side Drive copies
+    (rclone moveto --drive-server-side-across-configs) and run on --transfer-workers threads, at most
+    --transfer-workers-per-remote per remote. --rebalance-max-bytes limits the bytes moved in one run.
+    Use --dry-run to print the plan only.
+
+ARGUMENTS:
+    path
+        the remote path to rebalance (default:/)
+
+EXAMPLES:
+    sprinkle.py --dry-run rebalance /backup
+    sprinkle.py --rebalance-max-bytes 500000000000 rebalance /backup
+    """
+    print(usage_rebalance.__doc__)
+    print(usage_options.__doc__)
+    print(copyrights.__doc__)
+    print(credits.__doc__)
+
+
 def usage_find():
     """
     NAME:
@@ -532,6 +599,8 @@ def usage_find():
 
     DESCRIPTION:
         Finds files on all configured remote volumes specified with the regular expression.
+        With service accounts, the search runs on the registry's index of the cached listings;
+        remotes without a current listing of / are listed first.
 
     ARGUMENTS:
         regexp
@@ -571,6 +640,7 @@ def read_args(argv):
     global __rclone_move
     global __restore_duplicates
     global __dry_run
+    global __resume
     global __smtp_enable
     global __smtp_from
     global __smtp_to
@@ -579,6 +649,12 @@ def read_args(argv):
     global __smtp_user
     global __smtp_password
     global __no_cache
+    global __ls_cache_ttl_minutes
+    global __ls_delta
+    global __ls_full_refresh_hours
+    global __ls_search_index
+    global __hash_cache
+    global __hash_workers
     global __cl_sync
     global __exclude_file
     global __exclude_regex
@@ -588,17 +664,33 @@ def read_args(argv):
     global __daemon_type
     global __daemon_mode
     global __daemon_interval
+    global __daemon_debounce_seconds
     global __daemon_pidfile
     global __ls_stop_first
     global __sa_db
     global __sa_store
     global __sa_cache_ttl_hours
+    global __sa_refresh_workers
+    global __sa_refresh_rate
     global __sa_refresh
     global __sa_clean_invalid
     global __sa_delete_account_not_found
     global __sa_group_size
     global __rclone_sa_dir
     global __rclone_sa_count
+    global __batch_transfers
+    global __placement_strategy
+    global __rebalance_min_free
+    global __rebalance_max_bytes
+    global __transfer_workers
+    global __transfer_workers_per_remote
+    global __ls_workers
+    global __rclone_backend
+    global __rclone_rc_url
+    global __rclone_rc_timeout_seconds
+    global __local_snapshot
+    global __local_index_db
+    global __local_snapshot_full_scan_hours
 
     __configfile = None
     __cmd_debug = None
@@ -616,6 +708,7 @@ def read_args(argv):
     __rclone_move = None
     __restore_duplicates = False
     __dry_run = None
+    __resume = None
     __smtp_enable = None
     __smtp_from = None
     __smtp_to = None
@@ -624,6 +717,12 @@ def read_args(argv):
     __smtp_user = None
     __smtp_password = None
     __no_cache = None
+    __ls_cache_ttl_minutes = None
+    __ls_delta = None
+    __ls_full_refresh_hours = None
+    __ls_search_index = None
+    __hash_cache = None
+    __hash_workers = None
     __cl_sync = None
     __exclude_file = None
     __exclude_regex = None
@@ -633,17 +732,33 @@ def read_args(argv):
     __daemon_type = None
     __daemon_mode = False
     __daemon_interval = None
+    __daemon_debounce_seconds = None
     __daemon_pidfile = None
     __ls_stop_first = None
     __sa_db = None
     __sa_store = None
     __sa_cache_ttl_hours = None
+    __sa_refresh_workers = None
+    __sa_refresh_rate = None
     __sa_refresh = None
     __sa_clean_invalid = None
     __sa_delete_account_not_found = None
     __sa_group_size = None
     __rclone_sa_dir = None
     __rclone_sa_count = None
+    __batch_transfers = None
+    __placement_strategy = None
+    __rebalance_min_free = None
+    __rebalance_max_bytes = None
+    __transfer_workers = None
+    __transfer_workers_per_remote = None
+    __ls_workers = None
+    __rclone_backend = None
+    __rclone_rc_url = None
+    __rclone_rc_timeout_seconds = None
+    __local_snapshot = None
+    __local_index_db = None
+    __local_snapshot_full_scan_hours = None
 
     try:
         opts, args = getopt.getopt(argv, "dvhc:s:",
@@ -653,6 +768,7 @@ def read_args(argv):
                                     "verbose",
                                     "version",
                                     "dist-type=",
+                                    "placement-strategy=",
                                     "comp-method=",
                                     "rclone-exe=",
                                     "rclone-conf=",
@@ -663,6 +779,8 @@ def read_args(argv):
                                     "sa-db=",
                                     "sa-store=",
                                     "sa-cache-ttl-hours=",
+                                    "sa-refresh-workers=",
+                                    "sa-refresh-rate=",
                                     "sa-refresh=",
                                     "sa-clean-invalid=",
                                     "sa-delete-account-not-found",
@@ -671,11 +789,17 @@ def read_args(argv):
                                     "display-unit=",
                                     "rclone-retries=",
                                     "rclone-move",
+                                    "batch-transfers",
+                                    "transfer-workers=",
+                                    "transfer-workers-per-remote=",
                                     "show-progress",
                                     "progress",
                                     "dry-run",
+                                    "rebalance-min-free=",
+                                    "rebalance-max-bytes=",
                                     "delete-files",
                                     "restore-duplicates",
+                                    "resume",
                                     "smtp-enable",
                                     "smtp-from=",
                                     "smtp-to=",
@@ -684,15 +808,29 @@ def read_args(argv):
                                     "smtp-user=",
                                     "smtp-password=",
                                     "no-cache",
+                                    "ls-cache-ttl-minutes=",
+                                    "ls-delta",
+                                    "ls-full-refresh-hours=",
+                                    "ls-search-index",
+                                    "no-hash-cache",
+                                    "hash-workers=",
                                     "exclude-file=",
                                     "exclude-regex=",
                                     "log-file=",
                                     "single-instance",
                                     "ls-stop-first",
+                                    "ls-workers=",
+                                    "rclone-backend=",
+                                    "rclone-rc-url=",
+                                    "rclone-rc-timeout-seconds=",
+                                    "local-snapshot",
+                                    "local-index-db=",
+                                    "local-snapshot-full-scan-hours=",
                                     "check-prereq",
                                     "daemon-type=",
                                     "daemon-mode",
                                     "daemon-interval=",
+                                    "daemon-debounce-seconds=",
                                     "daemon-pidfile="
                                     ])
     except getopt.GetoptError:
@@ -714,6 +852,8 @@ def read_args(argv):
             __cmd_debug = True
         elif opt in ("--dist-type"):
             __dist_type = arg
+        elif opt in ("--placement-strategy"):
+            __placement_strategy = arg
         elif opt in ("--comp-method"):
             __comp_method = arg
         elif opt in ("--rclone-exe"):
@@ -739,6 +879,10 @@ def read_args(argv):
             if arg not in ("missing", "stale", "all", "none"):
                 raise Exception("--sa-refresh must be one of missing, stale, all, none")
             __sa_refresh = arg
+        elif opt in ("--sa-refresh-workers"):
+            __sa_refresh_workers = int(arg)
+        elif opt in ("--sa-refresh-rate"):
+            __sa_refresh_rate = float(arg)
         elif opt in ("--sa-clean-invalid"):
             if arg not in ("none", "quarantine", "delete"):
                 raise Exception("--sa-clean-invalid must be one of none, quarantine, delete")
@@ -759,10 +903,22 @@ def read_args(argv):
             __delete_files = True
         elif opt in ("--rclone-move"):
             __rclone_move = True
+        elif opt in ("--batch-transfers"):
+            __batch_transfers = True
+        elif opt in ("--transfer-workers"):
+            __transfer_workers = int(arg)
+        elif opt in ("--transfer-workers-per-remote"):
+            __transfer_workers_per_remote = int(arg)
         elif opt in ("--restore-duplicates"):
             __restore_duplicates = True
+        elif opt in ("--resume"):
+            __resume = True
         elif opt in ("--dry-run"):
             __dry_run = True
+        elif opt in ("--rebalance-min-free"):
+            __rebalance_min_free = int(arg)
+        elif opt in ("--rebalance-max-bytes"):
+            __rebalance_max_bytes = int(arg)
         elif opt in ("--smtp-enable"):
             __smtp_enable = True
         elif opt in ("--smtp-from"):
@@ -779,6 +935,18 @@ def read_args(argv):
             __smtp_password = arg
         elif opt in ("--no-cache"):
             __no_cache = True
+        elif opt in ("--ls-cache-ttl-minutes"):
+            __ls_cache_ttl_minutes = int(arg)
+        elif opt in ("--ls-delta"):
+            __ls_delta = True
+        elif opt in ("--ls-full-refresh-hours"):
+            __ls_full_refresh_hours = int(arg)
+        elif opt in ("--ls-search-index"):
+            __ls_search_index = True
+        elif opt in ("--no-hash-cache"):
+            __hash_cache = False
+        elif opt in ("--hash-workers"):
+            __hash_workers = int(arg)
         elif opt in ("--exclude-file"):
             __exclude_file = arg
         elif opt in ("--exclude-regex"):
@@ -789,6 +957,22 @@ def read_args(argv):
             __single_instance = True
         elif opt in ("--ls-stop-first"):
             __ls_stop_first = True
+        elif opt in ("--ls-workers"):
+            __ls_workers = int(arg)
+        elif opt in ("--rclone-backend"):
+            if arg not in ("subprocess", "rcd"):
+                raise Exception("--rclone-backend must be one of subprocess, rcd")
+            __rclone_backend = arg
+        elif opt in ("--rclone-rc-url"):
+            __rclone_rc_url = arg
+        elif opt in ("--rclone-rc-timeout-seconds"):
+            __rclone_rc_timeout_seconds = int(arg)
+        elif opt in ("--local-snapshot"):
+            __local_snapshot = True
+        elif opt in ("--local-index-db"):
+            __local_index_db = arg
+        elif opt in ("--local-snapshot-full-scan-hours"):
+            __local_snapshot_full_scan_hours = int(arg)
         elif opt in ("--check-prereq"):
             __check_prereq = True
         elif opt in ("--daemon-type"):
@@ -798,6 +982,8 @@ def read_args(argv):
             __daemon_mode = True
         elif opt in ("--daemon-interval"):
             __daemon_interval = int(arg)
+        elif opt in ("--daemon-debounce-seconds"):
+            __daemon_debounce_seconds = int(arg)
         elif opt in ("--daemon-pidfile"):
             __daemon_pidfile = arg
 
@@ -821,13 +1007,27 @@ def configure(config_file):
     _default_values = {
         "debug": True,
         "dry_run": False,
+        "resume": False,
         "show_progress": False,
         "delete_files": False,
         "rclone_move": True,
+        "batch_transfers": False,
+        "transfer_workers": 1,
+        "transfer_workers_per_remote": 2,
         "restore_duplicates": False,
         "smtp_enable": False,
         "no_cache": False,
+        "ls_cache_ttl_minutes": 720,
+        "ls_delta": False,
+        "ls_full_refresh_hours": 168,
+        "ls_search_index": False,
+        "hash_cache": True,
+        "hash_workers": 1,
+        "hash_fadvise": True,
         "distribution_type": "mas",
+        "placement_strategy": placement.DEFAULT_STRATEGY,
+        "rebalance_min_free_bytes": None,
+        "rebalance_max_bytes": 0,
         "compare_method": "size",
         "display_unit": "G",
         "rclone_retries": '1',
@@ -838,14 +1038,24 @@ def configure(config_file):
         "log_file": None,
         "single_instance": False,
         "ls_stop_first": True,
+        "ls_workers": clsync.DEFAULT_LS_WORKERS,
+        "rclone_backend": "subprocess",
+        "rclone_rc_url": None,
+        "rclone_rc_timeout_seconds": rclone_rc.DEFAULT_REQUEST_TIMEOUT_SECONDS,
+        "local_snapshot": False,
+        "local_index_db": local_index.DEFAULT_DB_PATH,
+        "local_snapshot_full_scan_hours": local_index.DEFAULT_FULL_SCAN_HOURS,
         "check_prereq": False,
         "daemon_type": 'interval',
         "daemon_mode": False,
         "daemon_interval": 60,
+        "daemon_debounce_seconds": sprinkle_daemon.DEFAULT_DEBOUNCE_SECONDS,
         "daemon_pidfile": '/var/run/sprinkle.pid',
         "sa_db": service_accounts.DEFAULT_DB_PATH,
         "sa_store": service_accounts.DEFAULT_STORE_DIR,
         "sa_cache_ttl_hours": service_accounts.DEFAULT_CACHE_TTL_HOURS,
+        "sa_refresh_workers": DEFAULT_SA_REFRESH_WORKERS,
+        "sa_refresh_rate": DEFAULT_SA_REFRESH_RATE,
         "sa_refresh": service_accounts.DEFAULT_REFRESH_MODE,
         "sa_clean_invalid": service_accounts.DEFAULT_CLEAN_INVALID,
         "sa_delete_account_not_found": False,
@@ -876,6 +1086,15 @@ def configure(config_file):
     if __dist_type is not None:
         __config['distribution_type'] = __dist_type
 
+    if __placement_strategy is not None:
+        __config['placement_strategy'] = __placement_strategy
+
+    if __rebalance_min_free is not None:
+        __config['rebalance_min_free_bytes'] = __rebalance_min_free
+
+    if __rebalance_max_bytes is not None:
+        __config['rebalance_max_bytes'] = __rebalance_max_bytes
+
     if __comp_method is not None:
         __config['compare_method'] = __comp_method
 
@@ -909,9 +1128,21 @@ def configure(config_file):
     if __rclone_move is not None:
         __config['rclone_move'] = __rclone_move
 
+    if __batch_transfers is not None:
+        __config['batch_transfers'] = __batch_transfers
+
+    if __transfer_workers is not None:
+        __config['transfer_workers'] = __transfer_workers
+
+    if __transfer_workers_per_remote is not None:
+        __config['transfer_workers_per_remote'] = __transfer_workers_per_remote
+
     if __dry_run is not None:
         __config['dry_run'] = __dry_run
 
+    if __resume is not None:
+        __config['resume'] = __resume
+
     if __smtp_enable is not None:
         __config['smtp_enable'] = __smtp_enable
 
@@ -939,6 +1170,24 @@ def configure(config_file):
     if __no_cache is not None:
         __config['no_cache'] = __no_cache
 
+    if __ls_cache_ttl_minutes is not None:
+        __config['ls_cache_ttl_minutes'] = __ls_cache_ttl_minutes
+
+    if __ls_delta is not None:
+        __config['ls_delta'] = __ls_delta
+
+    if __ls_full_refresh_hours is not None:
+        __config['ls_full_refresh_hours'] = __ls_full_refresh_hours
+
+    if __ls_search_index is not None:
+        __config['ls_search_index'] = __ls_search_index
+
+    if __hash_cache is not None:
+        __config['hash_cache'] = __hash_cache
+
+    if __hash_workers is not None:
+        __config['hash_workers'] = __hash_workers
+
     if __exclude_file is not None:
         __config['exclude_file'] = __exclude_file
 
@@ -954,6 +1203,27 @@ def configure(config_file):
     if __ls_stop_first is not None:
         __config['ls_stop_first'] = __ls_stop_first
 
+    if __ls_workers is not None:
+        __config['ls_workers'] = __ls_workers
+
+    if __rclone_backend is not None:
+        __config['rclone_backend'] = __rclone_backend
+
+    if __rclone_rc_url is not None:
+        __config['rclone_rc_url'] = __rclone_rc_url
+
+    if __rclone_rc_timeout_seconds is not None:
+        __config['rclone_rc_timeout_seconds'] = __rclone_rc_timeout_seconds
+
+    if __local_snapshot is not None:
+        __config['local_snapshot'] = __local_snapshot
+
+    if __local_index_db is not None:
+        __config['local_index_db'] = __local_index_db
+
+    if __local_snapshot_full_scan_hours is not None:
+        __config['local_snapshot_full_scan_hours'] = __local_snapshot_full_scan_hours
+
     if __check_prereq is not None:
         __config['check_prereq'] = __check_prereq
 
@@ -962,11 +1232,13 @@ def configure(config_file):
 
     if __daemon_mode is not None:
         __config['daemon_mode'] = __daemon_mode
-        __config['no_cache'] = True
 
     if __daemon_interval is not None:
         __config['daemon_interval'] = __daemon_interval
 
+    if __daemon_debounce_seconds is not None:
+        __config['daemon_debounce_seconds'] = __daemon_debounce_seconds
+
     if __daemon_pidfile is not None:
         __config['daemon_pidfile'] = __daemon_pidfile
 
@@ -979,6 +1251,12 @@ def configure(config_file):
     if __sa_cache_ttl_hours is not None:
         __config['sa_cache_ttl_hours'] = __sa_cache_ttl_hours
 
+    if __sa_refresh_workers is not None:
+        __config['sa_refresh_workers'] = __sa_refresh_workers
+
+    if __sa_refresh_rate is not None:
+        __config['sa_refresh_rate'] = __sa_refresh_rate
+
     if __sa_refresh is not None:
         __config['sa_refresh'] = __sa_refresh
 
@@ -1000,26 +1278,48 @@ def normalize_config_types(config_values):
     bool_fields = (
         'debug',
         'dry_run',
+        'resume',
         'show_progress',
         'delete_files',
         'rclone_move',
+        'batch_transfers',
         'restore_duplicates',
         'smtp_enable',
         'no_cache',
+        'hash_cache',
+        'hash_fadvise',
         'single_instance',
         'ls_stop_first',
         'check_prereq',
         'daemon_mode',
         'sa_delete_account_not_found',
+        'local_snapshot',
+        'ls_delta',
+        'ls_search_index',
     )
     int_fields = (
         'daemon_interval',
+        'daemon_debounce_seconds',
+        'ls_cache_ttl_minutes',
+        'ls_full_refresh_hours',
         'sa_cache_ttl_hours',
         'sa_group_size',
         'rclone_sa_count',
         'large_file_threshold_bytes',
         'large_file_min_free_bytes',
         'large_file_min_free_percent',
+        'transfer_workers',
+        'transfer_workers_per_remote',
+        'ls_workers',
+        'rclone_rc_timeout_seconds',
+        'sa_refresh_workers',
+        'local_snapshot_full_scan_hours',
+        'hash_workers',
+        'rebalance_min_free_bytes',
+        'rebalance_max_bytes',
+    )
+    float_fields = (
+        'sa_refresh_rate',
     )
     for field in bool_fields:
         if field in config_values:
@@ -1027,6 +1327,9 @@ def normalize_config_types(config_values):
     for field in int_fields:
         if field in config_values and config_values[field] not in (None, ''):
             config_values[field] = int(config_values[field])
+    for field in float_fields:
+        if field in config_values and config_values[field] not in (None, ''):
+            config_values[field] = float(config_values[field])
 
 
 def _parse_bool(value):
@@ -1047,6 +1350,9 @@ def verify_configuration():
         if 'smtp_port' not in __config:
             raise Exception('smtp_port value is None')
 
+    if __config.get('placement_strategy', placement.DEFAULT_STRATEGY) not in placement.STRATEGIES:
+        raise Exception('placement_strategy must be one of ' + '|'.join(placement.STRATEGIES))
+
     if 'exclude_file' in __config and __config['exclude_file'] is not None:
         if not os.path.isfile(__config['exclude_file']):
             raise Exception('exclude_file ' + __config['exclude_file'] + ' not found!')
@@ -1094,6 +1400,7 @@ def prepare_rclone_sa_config():
         __config.get('sa_db'),
         __config.get('sa_store'),
         __config.get('sa_cache_ttl_hours', service_accounts.DEFAULT_CACHE_TTL_HOURS),
+        __config.get('ls_search_index', False) is True,
     )
     source_dir = os.path.abspath(os.path.expanduser(rclone_sa_dir))
     managed_store_dir = os.path.abspath(os.path.expanduser(__config.get('sa_store')))
@@ -1139,7 +1446,7 @@ def command_needs_rclone_config():
         return True
     if len(__args) < 1:
         return False
-    return __args[0] in ('ls', 'lsmd5', 'backup', 'restore', 'stats', 'removedups', 'find')
+    return __args[0] in ('ls', 'lsmd5', 'backup', 'restore', 'stats', 'removedups', 'find', 'rebalance')
 
 
 def _optional_int(value):
@@ -1441,7 +1748,7 @@ def backup():
         common.print_line('backing up ' + local_dir + '...')
     else:
         common.print_line('backing up ' + local_dir + ' to ' + target + '...')
-    __cl_sync.backup(local_dir, __config['delete_files'], __config['dry_run'], target)
+    __cl_sync.backup(local_dir, __config['delete_files'], __config['dry_run'], target, __config['resume'])
 
 
 def restore():
@@ -1464,7 +1771,7 @@ def restore():
             common.print_line('restore cannot proceed! Use remove duplicates function before continuing')
             return
     common.print_line('restoring ' + remote_path + ' from ' + local_dir)
-    __cl_sync.restore(local_dir, remote_path, __config['dry_run'])
+    __cl_sync.restore(local_dir, remote_path, __config['dry_run'], __config['resume'])
 
 
 def stats():
@@ -1516,6 +1823,7 @@ def _service_account_registry():
         __config['sa_db'],
         __config['sa_store'],
         __config['sa_cache_ttl_hours'],
+        __config['ls_search_index'],
     )
 
 
@@ -1659,14 +1967,11 @@ def sa_stats():
     refresh_mode = __config['sa_refresh']
     if globals().get('__sa_refresh') is None and refresh_mode == service_accounts.DEFAULT_REFRESH_MODE:
         refresh_mode = 'stale'
-    refreshed = 0
-    for account in registry.active_accounts():
-        quota_row = registry.quota_by_account_id(account['id'])
-        if registry.should_refresh(quota_row, refresh_mode):
-            quota, error = _refresh_service_account_quota(account)
-            registry.update_quota(account['id'], quota, error)
-            refreshed += 1
-            quota_row = registry.quota_by_account_id(account['id'])
+    accounts = registry.active_accounts()
+    refreshed = _refresh_service_account_quotas(registry, accounts, refresh_mode)
+    quota_rows = registry.quotas_by_account_id(account['id'] for account in accounts)
+    for account in accounts:
+        quota_row = quota_rows.get(account['id'])
         quota_error = None if quota_row is None else quota_row['last_error']
         if _handle_account_not_found(registry, account, quota_error):
             continue
@@ -1746,6 +2051,40 @@ def sa_stats():
                       _format_percent(free, total).rjust(8))
 
 
+def _refresh_service_account_quotas(registry, accounts, refresh_mode):
+    """Refresh the quota of every account due for it and return how many were refreshed.
+
+    ``rclone about`` runs on ``sa_refresh_workers`` threads, started no faster
+    than ``sa_refresh_rate`` calls per second, and the results are written to
+    the registry in batches.
+    """
+    quota_rows = registry.quotas_by_account_id(account['id'] for account in accounts)
+    due = [
+        account for account in accounts
+        if registry.should_refresh(quota_rows.get(account['id']), refresh_mode)
+    ]
+    limiter = workers.RateLimiter(__config.get('sa_refresh_rate', DEFAULT_SA_REFRESH_RATE))
+
+    def refresh(account):
+        limiter.wait()
+        return _refresh_service_account_quota(account)
+
+    results = []
+    refreshed = workers.ordered_map(
+        refresh,
+        due,
+        __config.get('sa_refresh_workers', DEFAULT_SA_REFRESH_WORKERS),
+    )
+    for account, (quota, error) in refreshed:
+        results.append((account['id'], quota, error))
+        if len(results) >= SA_QUOTA_WRITE_BATCH:
+            registry.update_quotas(results)
+            results = []
+    if results:
+        registry.update_quotas(results)
+    return len(due)
+
+
 def _refresh_service_account_quota(account):
     if account['managed_path'] is None:
         return None, 'missing managed service account file'
@@ -1781,13 +2120,10 @@ def _refresh_service_account_quota(account):
 def _backup_accounts_with_free_space(registry, accounts):
     """Return active accounts whose current quota can safely receive an upload."""
     eligible = []
-    refresh_mode = __config['sa_refresh']
+    _refresh_service_account_quotas(registry, accounts, __config['sa_refresh'])
+    quota_rows = registry.quotas_by_account_id(account['id'] for account in accounts)
     for account in accounts:
-        quota_row = registry.quota_by_account_id(account['id'])
-        if registry.should_refresh(quota_row, refresh_mode):
-            quota, error = _refresh_service_account_quota(account)
-            registry.update_quota(account['id'], quota, error)
-            quota_row = registry.quota_by_account_id(account['id'])
+        quota_row = quota_rows.get(account['id'])
         quota_error = None if quota_row is None else quota_row['last_error']
         if _handle_account_not_found(registry, account, quota_error):
             continue
@@ -1853,7 +2189,7 @@ def _refresh_service_account_file_cache(account):
         rclone_exe = __config.get('rclone_exe', 'rclone')
         rclone_retries = __config.get('rclone_retries', '1')
         rc = rclone.RClone(tmp_conf, rclone_exe, rclone_retries)
-        return rc.lsjson("sa_files1:", "/", ['--recursive', '--fast-list'], True), None
+        return list(rc.lsjson_rows("sa_files1:", "/", ['--recursive', '--fast-list'], True)), None
     except Exception as e:
         return None, _friendly_rclone_error(e, account)
     finally:
@@ -1875,6 +2211,21 @@ def remove_duplicates():
     __cl_sync.remove_duplicates(common.remove_ending_slash(__args[1]))
 
 
+def rebalance():
+    global __cl_sync
+    if __cl_sync is None:
+        __cl_sync = clsync.ClSync(__config)
+    path = '/'
+    if len(__args) > 1:
+        path = common.remove_ending_slash(__args[1]) or '/'
+    __cl_sync.rebalance(
+        path,
+        __config['dry_run'],
+        __config.get('rebalance_min_free_bytes'),
+        __config.get('rebalance_max_bytes', 0),
+    )
+
+
 def find():
     global __cl_sync
     if __cl_sync is None:
@@ -2005,6 +2356,8 @@ def main(argv):
             remove_duplicates()
         elif __args[0] == 'find':
             find()
+        elif __args[0] == 'rebalance':
+            rebalance()
         elif __args[0] == 'help':
             if len(__args) < 2:
                 usage_help()
@@ -2029,6 +2382,8 @@ def main(argv):
                     usage_config()
                 elif __args[1] == 'find':
                     usage_find()
+                elif __args[1] == 'rebalance':
+                    usage_rebalance()
                 else:
                     print('')
                     print('invalid command. Use help [command]')
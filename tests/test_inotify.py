@@ -0,0 +1,81 @@
+import test_import_stubs
+import os
+
+import pytest
+
+from libsprinkle import inotify
+from libsprinkle import sprinkle_daemon
+
+
+def _watcher(root):
+    try:
+        return inotify.Watcher(str(root))
+    except OSError as e:
+        pytest.skip("inotify unavailable: " + str(e))
+
+
+def _read_all(watcher):
+    events = []
+    batch = watcher.read(1)
+    while batch:
+        events.extend(batch)
+        batch = watcher.read(0.1)
+    return events
+
+
+def test_watcher_reports_changed_directories_and_watches_new_ones(tmp_path):
+    (tmp_path / "Movies").mkdir()
+    with _watcher(tmp_path) as watcher:
+        assert watcher.watch_count() == 2
+        (tmp_path / "Movies" / "a.mkv").write_bytes(b"a")
+        (tmp_path / "Series").mkdir()
+        events = _read_all(watcher)
+        assert str(tmp_path / "Movies") in [event.directory for event in events]
+        assert (str(tmp_path), str(tmp_path / "Series")) in [(event.directory, event.path) for event in events]
+        assert watcher.watch_count() == 3
+
+        (tmp_path / "Series" / "b.mkv").write_bytes(b"b")
+        events = _read_all(watcher)
+        assert str(tmp_path / "Series") in [event.directory for event in events]
+
+
+def test_dirty_set_debounces_and_collapses_subtrees():
+    dirty = inotify.DirtySet(30)
+    dirty.add("/src/Movies/a", now=10)
+    dirty.add("/src/Movies", now=10)
+    dirty.add("/src/Movies-old", now=10)
+    dirty.add("/src/Series", now=20)
+
+    assert dirty.pop_ready(now=39) == []
+    assert dirty.pop_ready(now=40) == ["/src/Movies", "/src/Movies-old"]
+    dirty.add("/src/Series", now=45)
+    assert dirty.pop_ready(now=60) == []
+    assert dirty.next_due() == 75
+    assert dirty.pop_ready(now=75) == ["/src/Series"]
+    assert len(dirty) == 0
+
+
+def test_ondemand_backup_targets_the_remote_subtree(tmp_path):
+    (tmp_path / "Movies" / "2024").mkdir(parents=True)
+    daemon = sprinkle_daemon.SprinkleDaemon.__new__(sprinkle_daemon.SprinkleDaemon)
+    daemon._SprinkleDaemon__config = {"delete_files": True, "dry_run": False}
+    calls = []
+
+    class Sync(object):
+        def backup(self, local_dir, delete_files, dry_run, target):
+            calls.append((local_dir, target))
+            if local_dir == str(tmp_path):
+                raise Exception("remote failed")
+
+    daemon._backup_subtrees(Sync(), str(tmp_path), "/backup", [
+        str(tmp_path / "Movies" / "2024"),
+        str(tmp_path / "Movies" / "gone" / "deeper"),
+        str(tmp_path),
+    ])
+
+    assert calls == [
+        (str(tmp_path / "Movies" / "2024"), "/backup/Movies/2024"),
+        (str(tmp_path / "Movies"), "/backup/Movies"),
+        (str(tmp_path), None),
+    ]
+    assert daemon._clamp_to_root(str(tmp_path), os.path.dirname(str(tmp_path))) == str(tmp_path)
@@ -0,0 +1,209 @@
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from libsprinkle import exceptions
+from libsprinkle import local_index
+from libsprinkle import rclone
+from libsprinkle import rclone_rc
+
+
+class StubRcd(object):
+    """Minimal stand-in for ``rclone rcd`` answering canned JSON per method."""
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.calls = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                params = json.loads(self.rfile.read(length) or b"{}")
+                method = self.path.lstrip("/")
+                stub.calls.append((method, params))
+                status, body = stub.responses.get(method, (404, {"error": "couldn't find method"}))
+                if callable(body):
+                    body = body(params)
+                payload = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *_args):
+                return None
+
+        self.server = HTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:" + str(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def rcd():
+    stubs = []
+
+    def start(responses):
+        responses.setdefault("rc/noop", (200, {}))
+        stub = StubRcd(responses)
+        stubs.append(stub)
+        client = rclone_rc.connect(url=stub.url)
+        assert isinstance(client, rclone_rc.RCloneRC)
+        return stub, client
+
+    yield start
+    for stub in stubs:
+        stub.close()
+
+
+def test_lsjson_uses_operations_list(rcd):
+    rows = [{"Path": "a/movie.mkv", "Name": "movie.mkv", "Size": 10, "IsDir": False}]
+    stub, client = rcd({"operations/list": (200, {"list": rows})})
+
+    out = client.lsjson("dst101:", "/Movies", ["--recursive", "--fast-list"])
+
+    assert json.loads(out) == rows
+    assert stub.calls[-1] == (
+        "operations/list",
+        {"fs": "dst101:/Movies", "remote": "", "opt": {"recurse": True}},
+    )
+
+
+def test_lsjson_maps_missing_directory_to_file_not_found(rcd):
+    _stub, client = rcd({"operations/list": (500, {"error": "directory not found"})})
+
+    with pytest.raises(exceptions.FileNotFoundException):
+        client.lsjson("dst101:", "/Missing")
+    assert client.lsjson("dst101:", "/Missing", [], True) == "[]"
+
+
+def test_listing_errors_other_than_missing_directory_raise_with_no_error(rcd):
+    _stub, client = rcd({
+        "operations/list": (500, {"error": "googleapi: Error 403: rateLimitExceeded"}),
+        "operations/hashsum": (500, {"error": "googleapi: Error 403: rateLimitExceeded"}),
+    })
+
+    with pytest.raises(Exception) as error:
+        client.lsjson("dst101:", "/Movies", [], True)
+    assert not isinstance(error.value, exceptions.FileNotFoundException)
+    with pytest.raises(Exception):
+        client.md5sum("dst101:", "/Movies", [], True)
+
+
+def test_started_rcd_gets_credentials_through_the_environment(monkeypatch):
+    started = []
+
+    class ExitedProcess(object):
+        returncode = 1
+
+        def poll(self):
+            return self.returncode
+
+    def popen(command, **kwargs):
+        started.append((command, kwargs["env"]))
+        return ExitedProcess()
+
+    monkeypatch.setattr(rclone_rc.subprocess, "Popen", popen)
+    monkeypatch.setattr(rclone_rc.atexit, "register", lambda _func: None)
+
+    with pytest.raises(Exception):
+        rclone_rc.RCloneRC().start()
+
+    command, env = started[0]
+    assert env["RCLONE_RC_USER"] and env["RCLONE_RC_PASS"]
+    assert env["RCLONE_RC_PASS"] not in command
+    assert "--rc-pass" not in command
+
+
+def test_unanswered_request_fails_like_the_subprocess_backend():
+    stub = StubRcd({
+        "rc/noop": (200, {}),
+        "operations/list": (200, lambda _params: time.sleep(1) or {"list": []}),
+    })
+    try:
+        client = rclone_rc.connect(url=stub.url, timeout=0.2)
+        with pytest.raises(Exception) as error:
+            client.lsjson("dst101:", "/Movies")
+    finally:
+        stub.close()
+
+    assert str(error.value).startswith("error getting remote object.")
+    assert "timed out" in str(error.value)
+
+
+def test_about_and_listremotes(rcd):
+    _stub, client = rcd({
+        "operations/about": (200, {"total": 100, "used": 30, "free": 70}),
+        "config/listremotes": (200, {"remotes": ["dst101", "dst102"]}),
+    })
+
+    assert client.get_about_json_with_error("dst101:") == ({"total": 100, "used": 30, "free": 70}, None)
+    assert client.get_free("dst101:") == 70
+    assert client.get_remotes() == ["dst101:", "dst102:"]
+
+
+def test_copy_uploads_local_file_as_async_job(rcd, tmp_path):
+    local_file = tmp_path / "movie.mkv"
+    local_file.write_text("synthetic movie")
+    old = time.time() - local_index.MIN_AGE_SECONDS - 60
+    os.utime(str(local_file), (old, old))
+    statuses = iter([{"finished": False}, {"finished": True, "success": True, "output": {}}])
+    stub, client = rcd({
+        "operations/copyfile": (200, {"jobid": 7}),
+        "job/status": (200, lambda _params: next(statuses)),
+    })
+
+    client.copy(str(local_file), "dst101:/Movies")
+
+    methods = [method for method, _params in stub.calls]
+    assert methods.count("job/status") == 2
+    copy_params = dict(stub.calls[methods.index("operations/copyfile")][1])
+    assert copy_params == {
+        "srcFs": str(tmp_path),
+        "srcRemote": "movie.mkv",
+        "dstFs": "dst101:/Movies",
+        "dstRemote": "movie.mkv",
+        "_async": True,
+    }
+
+
+def test_copy_skips_recently_modified_local_file(rcd, tmp_path):
+    local_file = tmp_path / "movie.mkv"
+    local_file.write_text("synthetic movie")
+    stub, client = rcd({})
+
+    assert client.copy(str(local_file), "dst101:/Movies") == []
+    assert [method for method, _params in stub.calls] == ["rc/noop"]
+
+
+def test_failed_job_raises_remote_error(rcd, tmp_path):
+    local_file = tmp_path / "movie.mkv"
+    local_file.write_text("synthetic movie")
+    old = time.time() - local_index.MIN_AGE_SECONDS - 60
+    os.utime(str(local_file), (old, old))
+    _stub, client = rcd({
+        "operations/copyfile": (200, {"jobid": 3}),
+        "job/status": (200, {"finished": True, "success": False, "error": "storageQuotaExceeded"}),
+    })
+
+    with pytest.raises(Exception) as error:
+        client.copy(str(local_file), "dst101:/Movies")
+    assert "storageQuotaExceeded" in str(error.value)
+
+
+def test_connect_falls_back_to_subprocess_backend():
+    client = rclone_rc.connect(url="http://127.0.0.1:9")
+
+    assert type(client) is rclone.RClone
@@ -1,9 +1,13 @@
+import functools
+import hashlib
 import json
 import os
 import shutil
+import sqlite3
 import stat
 import sys
 import tempfile
+import threading
 import time
 import types
 import unittest
@@ -44,9 +48,16 @@ sys.modules.setdefault("filelock", filelock_module)
 
 import sprinkle
 from libsprinkle import common
+from libsprinkle import exceptions
+from libsprinkle import clfile
 from libsprinkle import clsync
+from libsprinkle import local_index
+from libsprinkle import operation
+from libsprinkle import placement
 from libsprinkle import rclone
+from libsprinkle import search
 from libsprinkle import service_accounts
+from libsprinkle import workers
 
 
 def make_service_account(email, key_id="key-id", client_id="client-id"):
@@ -65,6 +76,34 @@ def make_service_account(email, key_id="key-id", client_id="client-id"):
     }
 
 
+def bare_clsync():
+    """A ClSync built without __init__, holding the state __init__ gives every instance."""
+    sync = clsync.ClSync.__new__(clsync.ClSync)
+    sync._batch_transfers = False
+    sync._placement_strategy = placement.DEFAULT_STRATEGY
+    sync._transfer_workers = clsync.DEFAULT_TRANSFER_WORKERS
+    sync._transfer_workers_per_remote = clsync.DEFAULT_TRANSFER_WORKERS_PER_REMOTE
+    sync._reservations = None
+    sync._remote_slots = None
+    sync._ls_workers = clsync.DEFAULT_LS_WORKERS
+    sync._local_snapshot = None
+    sync._local_snapshot_full_scan_hours = local_index.DEFAULT_FULL_SCAN_HOURS
+    sync._hash_cache = None
+    sync._hash_workers = clsync.DEFAULT_HASH_WORKERS
+    sync._hash_fadvise = False
+    sync._sa_registry = None
+    sync._cache = {}
+    sync._cache_lock = threading.Lock()
+    sync._duplicate_paths = set()
+    sync._ls_cache_ttl_seconds = clsync.DEFAULT_LS_CACHE_TTL_MINUTES * 60
+    sync._remote_state = {}
+    sync._ls_delta = False
+    sync._ls_full_refresh_hours = clsync.DEFAULT_LS_FULL_REFRESH_HOURS
+    sync._journal_db = None
+    sync._journal = None
+    return sync
+
+
 def write_json(path, payload):
     with open(path, "w") as fp:
         json.dump(payload, fp)
@@ -143,6 +182,191 @@ class ServiceAccountRegistryTest(unittest.TestCase):
             self.assertEqual(quota["free"], 0)
             self.assertIsNone(quota["last_error"])
 
+    def test_quota_refresh_runs_concurrently_and_writes_one_batch(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, "source")
+            os.mkdir(source)
+            for name in ("one", "two", "three"):
+                write_json(
+                    os.path.join(source, name + ".json"),
+                    make_service_account(name + "@example.test", name),
+                )
+            registry = service_accounts.ServiceAccountRegistry(
+                os.path.join(tmp, "sa.sqlite3"),
+                os.path.join(tmp, "store"),
+            )
+            registry.import_paths([source])
+            accounts = registry.active_accounts()
+            barrier = threading.Barrier(len(accounts), timeout=2)
+            batches = []
+            update_quotas = registry.update_quotas
+            registry.update_quotas = lambda results: batches.append(list(results)) or update_quotas(results)
+            old_config = getattr(sprinkle, "__config", None)
+            old_refresh = sprinkle._refresh_service_account_quota
+
+            def refresh(account):
+                barrier.wait()
+                return {"total": 100, "used": account["id"], "free": 100 - account["id"]}, None
+
+            try:
+                setattr(sprinkle, "__config", {"sa_refresh_workers": 3, "sa_refresh_rate": 0})
+                sprinkle._refresh_service_account_quota = refresh
+                refreshed = sprinkle._refresh_service_account_quotas(registry, accounts, "all")
+            finally:
+                setattr(sprinkle, "__config", old_config)
+                sprinkle._refresh_service_account_quota = old_refresh
+
+            self.assertEqual(refreshed, 3)
+            self.assertEqual([len(batch) for batch in batches], [3])
+            for account in accounts:
+                quota = registry.quota_by_account_id(account["id"])
+                self.assertEqual(quota["free"], 100 - account["id"])
+                self.assertIsNotNone(quota["last_about_at"])
+
+    def test_rate_limiter_spaces_call_starts(self):
+        now = [0.0]
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            now[0] += seconds
+
+        limiter = workers.RateLimiter(4, clock=lambda: now[0], sleep=sleep)
+        for _ in range(3):
+            limiter.wait()
+
+        self.assertEqual(sleeps, [0.25, 0.25])
+
+    def test_registry_batch_writes_once_while_other_connections_read(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            registry, account = self._registry_with_remote(tmp)
+            registry.update_quota(account["id"], {"total": 1000, "used": 100, "free": 900}, None)
+            conn = registry._connection()
+            seen = []
+
+            with registry.batch():
+                registry.adjust_quota_for_remote("dst101:", 10)
+                registry.adjust_quota_for_remote("dst101:", 20)
+                with sqlite3.connect(registry.db_path, timeout=0) as reader:
+                    seen.append(reader.execute("SELECT used FROM quota_cache").fetchone()[0])
+                worker = threading.Thread(
+                    target=lambda: seen.append(registry.quota_by_remote("dst101:")["used"]))
+                worker.start()
+                worker.join()
+                self.assertEqual(registry.quota_by_remote("dst101:")["used"], 130)
+
+            self.assertEqual(seen, [100, 100])
+            self.assertIs(registry._connection(), conn)
+            with sqlite3.connect(registry.db_path) as reader:
+                self.assertEqual(reader.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+                self.assertEqual(reader.execute("SELECT used, free FROM quota_cache").fetchone(), (130, 870))
+            registry.close()
+
+    def test_registry_closes_connections_of_finished_worker_threads(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            registry, _account = self._registry_with_remote(tmp)
+            lookup = lambda _index: registry.quota_by_remote("dst101:")
+            for _ in range(20):
+                workers.run_jobs([functools.partial(lookup, index) for index in range(4)], 4)
+
+            self.assertLessEqual(len(registry._connections), 5)
+            registry.close()
+
+    def test_remote_index_answers_per_remote_calls_without_join_queries(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            registry, account = self._registry_with_remote(tmp)
+            registry.update_quota(account["id"], {"total": 1000, "used": 100, "free": 900}, None)
+            self.assertEqual(registry.account_id_for_remote("dst101:"), account["id"])
+            statements = []
+            registry._connection().set_trace_callback(statements.append)
+
+            registry.adjust_quota_for_remote("dst101:", 50)
+            registry.invalidate_ls_cache_for_remote("dst101:")
+            registry.update_quota_for_remote("dst999:", None, "unknown remote")
+
+            self.assertFalse([sql for sql in statements if "JOIN" in sql or "remote_name" in sql])
+            sync = bare_clsync()
+            sync._sa_registry = registry
+            sync._sa_refresh = "none"
+            sync._rclone = types.SimpleNamespace(get_about_json=lambda _remote, _no_error: None)
+            statements[:] = []
+            quotas = sync._get_remote_quotas(["dst101:", "dst999:"])
+            self.assertEqual(len([sql for sql in statements if sql.lstrip().startswith("SELECT")]), 1)
+            self.assertEqual(quotas["dst101:"]["used"], 150)
+            self.assertEqual(quotas["dst101:"]["free"], 850)
+            self.assertEqual(registry.quotas_by_account_id([account["id"]])[account["id"]]["free"], 850)
+
+            registry.mark_active_account_invalid(account["id"], "test")
+
+            self.assertIsNone(registry.account_id_for_remote("dst101:"))
+            self.assertEqual(registry.quotas_by_remote(["dst101:"]), {})
+
+    def _registry_with_remote(self, tmp):
+        source = os.path.join(tmp, "source")
+        os.mkdir(source)
+        write_json(os.path.join(source, "one.json"), make_service_account("one@example.test"))
+        registry = service_accounts.ServiceAccountRegistry(
+            os.path.join(tmp, "sa.sqlite3"),
+            os.path.join(tmp, "store"),
+        )
+        registry.import_paths([source])
+        account = registry.active_accounts()[0]
+        registry.assign_remote_names([{"remote": "dst101", "path": account["managed_path"]}])
+        return registry, account
+
+    def _lsjson_row(self, path, is_dir=False, size=10):
+        return {
+            "Path": path,
+            "Name": path.rsplit("/", 1)[-1],
+            "Size": -1 if is_dir else size,
+            "MimeType": "inode/directory" if is_dir else "video/x-matroska",
+            "ModTime": "2024-01-01T00:00:00Z",
+            "IsDir": is_dir,
+            "ID": "id-" + path,
+        }
+
+    def test_ls_cache_rows_are_indexed_for_subtree_and_shallow_lookups(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            registry, account = self._registry_with_remote(tmp)
+            registry.update_ls_cache(account["id"], "/", [
+                self._lsjson_row("Movies", True),
+                self._lsjson_row("Movies/Aladin", True),
+                self._lsjson_row("Movies/Aladin/movie.mkv"),
+                self._lsjson_row("Movies/trailer.mkv"),
+                self._lsjson_row("Movies0.mkv"),
+            ])
+
+            deep = registry.cached_listing_for_remote("dst101:", "/Movies", True)
+            shallow = registry.cached_listing_for_remote("dst101:", "/Movies", False)
+
+            self.assertEqual([row["Path"] for row in deep], ["Aladin", "Aladin/movie.mkv", "trailer.mkv"])
+            self.assertEqual([row["Path"] for row in shallow], ["Aladin", "trailer.mkv"])
+            self.assertEqual(deep[1]["ID"], "id-Movies/Aladin/movie.mkv")
+            self.assertIs(deep[0]["IsDir"], True)
+            self.assertEqual(registry.ls_cache_summary()["files"], 3)
+
+            registry.update_ls_cache(account["id"], "/Movies/Aladin", [self._lsjson_row("other.mkv")])
+
+            deep = registry.cached_listing_for_remote("dst101:", "/Movies", True)
+            self.assertEqual([row["Path"] for row in deep], ["Aladin", "Aladin/other.mkv", "trailer.mkv"])
+            self.assertIsNone(registry.cached_listing_for_remote("dst101:", "/Movies", True, "all"))
+
+    def test_ls_cache_json_blobs_are_migrated_to_file_index(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            registry, account = self._registry_with_remote(tmp)
+            registry.update_ls_cache(account["id"], "/", [])
+            with sqlite3.connect(registry.db_path) as conn:
+                conn.execute(
+                    "UPDATE ls_cache SET json_text=? WHERE account_id=?",
+                    (json.dumps([self._lsjson_row("Movies/movie.mkv")]), account["id"]),
+                )
+
+            reopened = service_accounts.ServiceAccountRegistry(registry.db_path, registry.store_dir)
+
+            rows = reopened.cached_listing_for_remote("dst101:", "/Movies", True)
+            self.assertEqual([row["Path"] for row in rows], ["movie.mkv"])
+            self.assertEqual(reopened.ls_cache_by_account_id(account["id"], "/")["json_text"], "")
+
     def test_account_not_found_cleanup_requires_explicit_option(self):
         with tempfile.TemporaryDirectory() as tmp:
             source = os.path.join(tmp, "source")
@@ -330,6 +554,54 @@ class RCloneQuotaTest(unittest.TestCase):
 
         self.assertEqual(json.loads(out), [])
 
+    def test_lsjson_rows_streams_objects_from_rclone_output(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fake_rclone = os.path.join(tmp, "rclone")
+            with open(fake_rclone, "w") as fp:
+                fp.write("#!/bin/sh\n")
+                fp.write("echo '['\n")
+                fp.write("echo '{\"Path\":\"Aladin\",\"Name\":\"Aladin\",\"Size\":-1,\"IsDir\":true},'\n")
+                fp.write("echo '{\"Path\":\"Aladin/movie.mkv\",\"Name\":\"movie.mkv\",\"Size\":15,\"IsDir\":false}'\n")
+                fp.write("echo ']'\n")
+                fp.write("echo 'Transferred:   0 B / 0 B, -, 0 B/s, ETA -'\n")
+            os.chmod(fake_rclone, 0o755)
+            rc = rclone.RClone(rclone_exe=fake_rclone)
+
+            rows = rc.lsjson_rows("dst101:", "/Movies", ["--recursive"])
+            first = next(rows)
+            rest = list(rows)
+
+        self.assertEqual(first["Path"], "Aladin")
+        self.assertEqual([row["Name"] for row in rest], ["movie.mkv"])
+
+    def test_lsjson_rows_raises_rclone_errors_after_output(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fake_rclone = os.path.join(tmp, "rclone")
+            with open(fake_rclone, "w") as fp:
+                fp.write("#!/bin/sh\necho '[' ; echo ']'\n")
+                fp.write("echo 'ERROR : error listing: directory not found' >&2\nexit 3\n")
+            os.chmod(fake_rclone, 0o755)
+            rc = rclone.RClone(rclone_exe=fake_rclone)
+
+            with self.assertRaises(exceptions.FileNotFoundException):
+                list(rc.lsjson_rows("dst101:", "/Missing"))
+            self.assertEqual(list(rc.lsjson_rows("dst101:", "/Missing", [], True)), [])
+
+    def test_lsjson_rows_raises_failed_listings_even_with_no_error(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fake_rclone = os.path.join(tmp, "rclone")
+            with open(fake_rclone, "w") as fp:
+                fp.write("#!/bin/sh\necho 'ERROR : error reading source root directory: 403 rate limit' >&2\nexit 1\n")
+            os.chmod(fake_rclone, 0o755)
+            rc = rclone.RClone(rclone_exe=fake_rclone)
+
+            with self.assertRaises(Exception) as raised:
+                list(rc.lsjson_rows("dst101:", "/Movies", [], True))
+            with self.assertRaises(Exception):
+                rc.lsjson("dst101:", "/Movies", [], True)
+
+        self.assertNotIsInstance(raised.exception, exceptions.FileNotFoundException)
+
     def test_about_json_ignores_rclone_progress_output(self):
         old_execute = common.execute
 
@@ -350,6 +622,92 @@ class RCloneQuotaTest(unittest.TestCase):
         self.assertIsNone(error)
         self.assertEqual(quota["free"], 75)
 
+    def test_copy_files_attributes_rclone_errors_to_manifest_entries(self):
+        old_execute = common.execute
+        calls = []
+
+        def fake_execute(command, no_error=False):
+            manifest = command[command.index("--files-from-raw") + 1]
+            with open(manifest) as fp:
+                calls.append((command[1], fp.read().splitlines(), command[-2:]))
+            return {
+                "code": 1,
+                "out": "",
+                "error": (
+                    "2024/01/01 00:00:00 INFO  : a.mkv: Copied (new)\n"
+                    "2024/01/01 00:00:00 ERROR : b: c.mkv: Failed to copy: googleapi: Error 403, storageQuotaExceeded\n"
+                    "2024/01/01 00:00:00 ERROR : Attempt 1/1 failed with 1 errors and: storageQuotaExceeded\n"
+                ),
+            }
+
+        try:
+            common.execute = fake_execute
+            rc = rclone.RClone()
+            failed, error = rc.copy_files("/data/Movies", "dst101:/Movies", ["a.mkv", "b: c.mkv"])
+        finally:
+            common.execute = old_execute
+
+        self.assertIsNone(error)
+        self.assertEqual(list(failed), ["b: c.mkv"])
+        self.assertIn("storageQuotaExceeded", failed["b: c.mkv"])
+        self.assertEqual(calls, [("copy", ["a.mkv", "b: c.mkv"], ["/data/Movies", "dst101:/Movies"])])
+
+    def test_copy_files_reports_files_rclone_did_not_transfer(self):
+        old_execute = common.execute
+        manifests = []
+
+        def fake_execute(command, no_error=False):
+            with open(command[command.index("--files-from-raw") + 1]) as fp:
+                manifests.append(fp.read().split("\n"))
+            return {
+                "code": 0,
+                "out": "",
+                "error": "2024/01/01 00:00:00 INFO  : # notes.txt: Copied (new)\n",
+            }
+
+        try:
+            common.execute = fake_execute
+            rc = rclone.RClone()
+            failed, error = rc.copy_files("/data/Movies", "dst101:/Movies", ["# notes.txt", " young.mkv"])
+        finally:
+            common.execute = old_execute
+
+        self.assertIsNone(error)
+        self.assertEqual(failed, {" young.mkv": rclone.NOT_TRANSFERRED})
+        self.assertEqual(manifests, [["# notes.txt", " young.mkv", ""]])
+
+    def test_delete_files_and_rmdirs_report_only_what_rclone_logged(self):
+        old_execute = common.execute
+        commands = []
+
+        def fake_execute(command, no_error=False):
+            commands.append(command)
+            if command[1] == "delete":
+                return {
+                    "code": 0,
+                    "out": "",
+                    "error": "2024/01/01 00:00:00 INFO  : old/a.mkv: Deleted\n",
+                }
+            return {
+                "code": 0,
+                "out": "",
+                "error": "2024/01/01 00:00:00 INFO  : sub/empty: Removing directory\n",
+            }
+
+        try:
+            common.execute = fake_execute
+            rc = rclone.RClone()
+            failed, error = rc.delete_files("dst101:", "/b", ["old/a.mkv", "old/b.mkv"])
+            removed = rc.rmdirs("dst101:", "/b/old", True)
+        finally:
+            common.execute = old_execute
+
+        self.assertIsNone(error)
+        self.assertEqual(failed, {"old/b.mkv": rclone.NOT_DELETED})
+        self.assertEqual(removed, ["sub/empty"])
+        self.assertIn("-v", commands[0])
+        self.assertIn("--leave-root", commands[1])
+
     def test_unknown_quota_reason_requires_total_and_free(self):
         self.assertIn("missing total,free", sprinkle._quota_unknown_reason({"used": 1}))
         self.assertIsNone(sprinkle._quota_unknown_reason({"total": 100, "free": 0}))
@@ -432,7 +790,7 @@ class RCloneQuotaTest(unittest.TestCase):
 
 class ClSyncPlacementTest(unittest.TestCase):
     def test_missing_file_comparison_uses_single_debug_line(self):
-        sync = clsync.ClSync.__new__(clsync.ClSync)
+        sync = bare_clsync()
         sync._compare_method = "size"
         local_file = types.SimpleNamespace(
             path="./roms/SPC",
@@ -456,6 +814,48 @@ class ClSyncPlacementTest(unittest.TestCase):
         self.assertIn("result=add", compare_logs[0])
         self.assertFalse(any("remote name:" in line for line in logs.output))
 
+    def test_compare_merges_sorted_sides_into_add_update_and_remove(self):
+        sync = bare_clsync()
+        sync._compare_method = "size"
+
+        def entry(path, name, size, is_dir=False, remote=None):
+            tmp_file = clfile.ClFile()
+            tmp_file.path, tmp_file.name, tmp_file.size, tmp_file.is_dir = path, name, size, is_dir
+            tmp_file.remote = remote
+            return tmp_file
+
+        local_clfiles = {
+            "./roms/b": entry("./roms", "b", "-1", True),
+            "./roms/z.spc": entry("./roms", "z.spc", 5),
+            "./roms/b/new.spc": entry("./roms/b", "new.spc", 1),
+            "./roms/b/same.spc": entry("./roms/b", "same.spc", 2),
+            "./roms/b/changed.spc": entry("./roms/b", "changed.spc", 3),
+        }
+        remote_clfiles = clfile.FileTable({
+            "/roms/a": entry("/roms/a", "a", -1, True, "dst101:"),
+            "/roms/a/old.spc": entry("/roms/a/old.spc", "old.spc", 4, False, "dst101:"),
+            "/roms/b": entry("/roms/b", "b", -1, True, "dst101:"),
+            "/roms/b/same.spc": entry("/roms/b/same.spc", "same.spc", 2, False, "dst101:"),
+            "/roms/b/changed.spc": entry("/roms/b/changed.spc", "changed.spc", 9, False, "dst102:"),
+            "/roms/c.spc": entry("/roms/c.spc", "c.spc", 6, False, "dst102:"),
+        })
+
+        with mock.patch.object(clsync.os.path, "realpath", side_effect=AssertionError("realpath")):
+            operations = sync.compare_clfiles_for_remote_root(
+                "./roms", local_clfiles, remote_clfiles, delete_file=True, remote_root="/roms")
+
+        self.assertEqual(
+            [(op.operation, op.src.name, op.src.remote_path, op.src.remote) for op in operations],
+            [
+                ("update", "changed.spc", "/roms/b", "dst102:"),
+                ("add", "new.spc", "/roms/b", None),
+                ("add", "z.spc", "/roms", None),
+                ("remove", "c.spc", "/roms", "dst102:"),
+                ("remove", "old.spc", "/roms/a", "dst101:"),
+                ("remove", "a", "/roms", "dst101:"),
+            ],
+        )
+
     def test_lsjson_results_are_cached_by_service_account_remote(self):
         with tempfile.TemporaryDirectory() as tmp:
             source = os.path.join(tmp, "source")
@@ -479,7 +879,7 @@ class ClSyncPlacementTest(unittest.TestCase):
             }])
 
             def make_sync():
-                sync = clsync.ClSync.__new__(clsync.ClSync)
+                sync = bare_clsync()
                 sync._config = {
                     "no_cache": False,
                     "ls_stop_first": False,
@@ -523,7 +923,7 @@ class ClSyncPlacementTest(unittest.TestCase):
                 "ID": "file-id",
             }]))
             calls = []
-            sync = clsync.ClSync.__new__(clsync.ClSync)
+            sync = bare_clsync()
             sync._config = {
                 "no_cache": False,
                 "ls_stop_first": False,
@@ -544,8 +944,283 @@ class ClSyncPlacementTest(unittest.TestCase):
             self.assertIn("/Movies/Aladin/movie.mkv", files)
             self.assertEqual(calls, [])
 
+    def test_uploads_and_deletes_patch_cached_listings_in_place(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, "source")
+            store = os.path.join(tmp, "store")
+            db_path = os.path.join(tmp, "sa.sqlite3")
+            os.mkdir(source)
+            write_json(os.path.join(source, "one.json"), make_service_account("one@example.test"))
+            registry = service_accounts.ServiceAccountRegistry(db_path, store)
+            registry.import_paths([source])
+            account = registry.active_accounts()[0]
+            registry.assign_remote_names([{"remote": "dst101", "path": account["managed_path"]}])
+            registry.update_ls_cache(account["id"], "/", json.dumps([
+                {"Path": "Movies", "Name": "Movies", "Size": -1, "MimeType": "inode/directory",
+                 "ModTime": "2024-01-01T00:00:00Z", "IsDir": True, "ID": "dir-id"},
+                {"Path": "Movies/old.mkv", "Name": "old.mkv", "Size": 10, "MimeType": "video/x-matroska",
+                 "ModTime": "2024-01-01T00:00:00Z", "IsDir": False, "ID": "file-id"},
+            ]))
+            calls = []
+
+            def make_sync():
+                sync = bare_clsync()
+                sync._config = {
+                    "no_cache": False,
+                    "ls_stop_first": False,
+                }
+                sync._sa_registry = service_accounts.ServiceAccountRegistry(db_path, store)
+                sync._sa_refresh = "stale"
+                sync._compare_method = "size"
+                sync._show_progress = False
+                sync._cache = {}
+                sync.get_remotes = lambda: ["dst101:"]
+                sync._rclone = types.SimpleNamespace(
+                    lsjson=lambda remote, path, _args, _no_error: calls.append(("lsjson", path)) or "[]",
+                    delete_file=lambda remote, path: calls.append(("deletefile", path)),
+                )
+                sync.copy = lambda src, dst, remote: calls.append(("copy", dst))
+                return sync
+
+            sync = make_sync()
+            self.assertIn("/Movies/old.mkv", sync.ls("/Movies"))
+            src = clfile.ClFile()
+            src.path = source
+            src.name = "new.mkv"
+            src.size = 20
+            src.mod_time = 1700000000.0
+            src.remote_path = "/Movies/New"
+            sync._backup_add(operation.Operation(operation.Operation.ADD, src, None), False, "dst101:",
+                             lambda op, error, _remotes: self.fail(str(error)))
+            sync.delete_file("/Movies/old.mkv", "dst101:")
+
+            for files in (sync.ls("/Movies"), make_sync().ls("/Movies")):
+                self.assertEqual(sorted(files), ["/Movies/New", "/Movies/New/new.mkv"])
+                self.assertTrue(files["/Movies/New"].is_dir)
+                self.assertEqual(files["/Movies/New/new.mkv"].size, 20)
+                self.assertEqual(files["/Movies/New/new.mkv"].mod_time, "2023-11-14T22:13:20.000000Z")
+            self.assertEqual(calls, [("copy", "/Movies/New"), ("deletefile", "/Movies/old.mkv")])
+
+    def test_files_rclone_may_have_skipped_by_min_age_stay_out_of_cached_listings(self):
+        sync = bare_clsync()
+        sync._rclone_move = False
+        sync._show_progress = False
+        sync._cache = {("dst101:", "/Movies", True): (time.monotonic(), clfile.FileTable())}
+        old = time.time() - local_index.MIN_AGE_SECONDS - 60
+        young = time.time() - 60
+        group = []
+        for name, mod_time in (("old.mkv", old), ("young.mkv", young), ("lost.mkv", old)):
+            src = clfile.ClFile()
+            src.path = "/data/Movies"
+            src.remote = "dst101:"
+            src.name = name
+            src.size = 10
+            src.mod_time = mod_time
+            src.remote_path = "/Movies"
+            group.append(operation.Operation(operation.Operation.UPDATE, src, None))
+        sync._rclone = types.SimpleNamespace(copy_files=lambda *_args, **_kwargs: ({
+            "young.mkv": rclone.NOT_TRANSFERRED,
+            "lost.mkv": rclone.NOT_TRANSFERRED,
+        }, None))
+
+        failed_ops, _count = sync._run_batch(("dst101:", "/data/Movies", "/Movies"), group, "dst101:")
+        sync.copy = lambda *_args: None
+        sync._backup_update(group[1], False, "dst101:", lambda op, error, _remotes: self.fail(str(error)))
+
+        self.assertEqual([op.src.name for op in failed_ops], ["lost.mkv"])
+        self.assertEqual(sorted(sync._cache[("dst101:", "/Movies", True)][1]), ["/Movies/old.mkv"])
+        self.assertFalse(clsync.ClSync._modified_recently(types.SimpleNamespace(
+            mod_time="2024-01-01T00:00:00.123456789+01:00")))
+        self.assertTrue(clsync.ClSync._modified_recently(types.SimpleNamespace(mod_time="yesterday")))
+
+    def test_ls_delta_merges_files_modified_since_the_last_listing(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, "source")
+            store = os.path.join(tmp, "store")
+            db_path = os.path.join(tmp, "sa.sqlite3")
+            os.mkdir(source)
+            write_json(os.path.join(source, "one.json"), make_service_account("one@example.test"))
+            registry = service_accounts.ServiceAccountRegistry(db_path, store)
+            registry.import_paths([source])
+            account = registry.active_accounts()[0]
+            registry.assign_remote_names([{"remote": "dst101", "path": account["managed_path"]}])
+            registry.update_ls_cache(account["id"], "/Movies", json.dumps([{
+                "Path": "old.mkv", "Name": "old.mkv", "Size": 10, "MimeType": "video/x-matroska",
+                "ModTime": "2024-01-01T00:00:00Z", "IsDir": False, "ID": "old-id",
+            }]))
+
+            def age_listing(hours):
+                stamp = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() - hours * 3600))
+                with sqlite3.connect(db_path) as conn:
+                    conn.execute("UPDATE ls_cache SET last_lsjson_at=?, last_full_lsjson_at=?", (stamp, stamp))
+
+            calls = []
+
+            def lsjson(remote, path, args, _no_error):
+                calls.append(list(args))
+                return json.dumps([{
+                    "Path": "new.mkv", "Name": "new.mkv", "Size": 20, "MimeType": "video/x-matroska",
+                    "ModTime": "2024-01-02T00:00:00Z", "IsDir": False, "ID": "new-id",
+                }])
+
+            sync = bare_clsync()
+            sync._config = {
+                "no_cache": False,
+                "ls_stop_first": False,
+            }
+            sync._sa_registry = service_accounts.ServiceAccountRegistry(db_path, store)
+            sync._sa_refresh = "stale"
+            sync._compare_method = "size"
+            sync._ls_delta = True
+            sync.get_remotes = lambda: ["dst101:"]
+            sync._rclone = types.SimpleNamespace(lsjson=lsjson)
+
+            age_listing(80)
+            sync._cache = {}
+            self.assertEqual(sorted(sync.ls("/Movies")), ["/Movies/new.mkv", "/Movies/old.mkv"])
+            self.assertEqual(calls[0][:3], ["--recursive", "--fast-list", "--max-age"])
+            self.assertAlmostEqual(int(calls[0][3][:-1]), 81 * 3600, delta=60)
+            self.assertEqual(sync._sa_registry.ls_cache_by_remote("dst101:", "/Movies")["file_count"], 2)
+
+            sync._sa_registry.expire_ls_cache_for_remote("dst101:")
+            sync._cache = {}
+            self.assertEqual(sorted(sync.ls("/Movies")), ["/Movies/new.mkv"])
+            self.assertNotIn("--max-age", calls[1])
+
+            age_listing(200)
+            sync._cache = {}
+            self.assertEqual(sorted(sync.ls("/Movies")), ["/Movies/new.mkv"])
+            self.assertNotIn("--max-age", calls[2])
+
+    def test_cached_listings_keep_drive_duplicates_of_one_path(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, "source")
+            store = os.path.join(tmp, "store")
+            db_path = os.path.join(tmp, "sa.sqlite3")
+            os.mkdir(source)
+            write_json(os.path.join(source, "one.json"), make_service_account("one@example.test"))
+            registry = service_accounts.ServiceAccountRegistry(db_path, store)
+            registry.import_paths([source])
+            account = registry.active_accounts()[0]
+            registry.assign_remote_names([{"remote": "dst101", "path": account["managed_path"]}])
+
+            def row(file_id, size):
+                return {"Path": "a.mkv", "Name": "a.mkv", "Size": size, "MimeType": "video/x-matroska",
+                        "ModTime": "2024-01-01T00:00:00Z", "IsDir": False, "ID": file_id}
+
+            registry.update_ls_cache_for_remote("dst101:", "/Movies", [row("first", 10), row("second", 20)])
+            sync = bare_clsync()
+            sync._config = {"no_cache": False}
+            sync._sa_registry = registry
+            sync._sa_refresh = "stale"
+            sync._rclone = types.SimpleNamespace(lsjson=lambda *_args: self.fail("listing must come from the cache"))
+
+            listing = sync._list_remote("/Movies", True, "dst101:")
+
+            self.assertEqual(sorted((key, listing[key].id) for key in listing), [
+                ("/Movies/a.mkv", "first"),
+                ("/Movies/a.mkv" + clsync.ClSync.duplicate_suffix, "second"),
+            ])
+            self.assertIn(("dst101:", "/Movies/a.mkv"), sync._duplicate_paths)
+
+            # A delta row replaces the object with its id; the duplicate stays.
+            registry.merge_ls_cache_for_remote("dst101:", "/Movies", [row("second", 30)])
+            rows = registry.cached_listing_for_remote("dst101:", "/Movies", True, "none")
+            self.assertEqual(sorted((item["ID"], item["Size"]) for item in rows), [("first", 10), ("second", 30)])
+
+            # Deleting one of them cannot be patched by path: the listings are listed again.
+            registry.patch_ls_cache_for_remote("dst101:", removed=["/Movies/a.mkv"])
+            self.assertIsNone(registry.cached_listing_for_remote("dst101:", "/Movies", True, "stale"))
+
+    def test_ls_files_keyed_by_path_are_migrated_to_row_ids(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = os.path.join(tmp, "store")
+            db_path = os.path.join(tmp, "sa.sqlite3")
+            with sqlite3.connect(db_path) as conn:
+                conn.execute("""
+                    CREATE TABLE ls_files (
+                        account_id INTEGER NOT NULL, path TEXT NOT NULL, parent TEXT NOT NULL,
+                        name TEXT NOT NULL, size INTEGER, mod_time TEXT, is_dir INTEGER NOT NULL,
+                        mime_type TEXT, file_id TEXT, md5 TEXT, PRIMARY KEY(account_id, path)
+                    )
+                """)
+                conn.execute("INSERT INTO ls_files VALUES (1, '/a.mkv', '/', 'a.mkv', 10, NULL, 0, NULL, 'a', NULL)")
+
+            service_accounts.ServiceAccountRegistry(db_path, store, search_index=True)
+
+            with sqlite3.connect(db_path) as conn:
+                self.assertIn("id", [column[1] for column in conn.execute("PRAGMA table_info(ls_files)")])
+                conn.execute("INSERT INTO ls_files (account_id, path, parent, name, is_dir) "
+                             "VALUES (1, '/a.mkv', '/', 'a.mkv', 0)")
+                self.assertEqual(conn.execute("SELECT COUNT(*) FROM ls_files").fetchone()[0], 2)
+
+    def test_regex_literals_keep_only_required_substrings(self):
+        self.assertEqual(search.regex_literals(r"/backup/....sh"), ["/backup/"])
+        self.assertEqual(search.regex_literals(r"(?i)Aladin.*2019\.mkv$"), ["Aladin", "2019.mkv"])
+        self.assertEqual(search.regex_literals(r"fooo?bar[a-z]+_season\d{2}"), ["foo", "bar", "_season"])
+        self.assertEqual(search.regex_literals(r"report(s)?final"), ["report", "final"])
+        self.assertEqual(search.regex_literals(r"movie|series"), [])
+
+    def test_find_is_served_from_the_search_index_and_lists_only_stale_remotes(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, "source")
+            store = os.path.join(tmp, "store")
+            db_path = os.path.join(tmp, "sa.sqlite3")
+            os.mkdir(source)
+            write_json(os.path.join(source, "one.json"), make_service_account("one@example.test"))
+            write_json(os.path.join(source, "two.json"), make_service_account("two@example.test", "key-two", "client-two"))
+            registry = service_accounts.ServiceAccountRegistry(db_path, store)
+            registry.import_paths([source])
+            accounts = registry.active_accounts()
+            registry.assign_remote_names([
+                {"remote": "dst101", "path": accounts[0]["managed_path"]},
+                {"remote": "dst102", "path": accounts[1]["managed_path"]},
+            ])
+
+            def row(path, size):
+                return {"Path": path, "Name": path.rsplit("/", 1)[-1], "Size": size, "MimeType": "video/x-matroska",
+                        "ModTime": "2024-01-01T00:00:00Z", "IsDir": False, "ID": path}
+
+            registry.update_ls_cache_for_remote("dst101:", "/", [
+                row("Movies/Aladin (1992)/Aladin.mkv", 10),
+                row("Movies/Aladin (1992)/Aladin.srt", 1),
+                row("Movies/Brave/Brave.mkv", 20),
+            ])
+            calls = []
+            sync = bare_clsync()
+            sync._config = {
+                "no_cache": False,
+                "ls_stop_first": False,
+            }
+            sync._sa_registry = service_accounts.ServiceAccountRegistry(db_path, store, search_index=True)
+            sync._sa_refresh = "stale"
+            sync._compare_method = "size"
+            sync.get_remotes = lambda: ["dst101:", "dst102:"]
+            sync._rclone = types.SimpleNamespace(
+                lsjson=lambda remote, path, _args, _no_error: calls.append((remote, path)) or json.dumps([
+                    row("Series/Aladin/S01E01.mkv", 30),
+                ])
+            )
+
+            files = sync.find(r"Aladin.*\.mkv$")
+
+            self.assertEqual(sorted(files), ["//Movies/Aladin (1992)/Aladin.mkv", "//Series/Aladin/S01E01.mkv"])
+            self.assertEqual(files["//Series/Aladin/S01E01.mkv"].remote, "dst102:")
+            self.assertEqual(calls, [("dst102:", "/")])
+            self.assertEqual(sorted(sync.find(r"^//Movies/B")), ["//Movies/Brave/Brave.mkv"])
+            self.assertEqual(calls, [("dst102:", "/")])
+
+            # Without the setting the index and its triggers are dropped and find scans the cached paths.
+            sync._sa_registry = service_accounts.ServiceAccountRegistry(db_path, store)
+            with sqlite3.connect(db_path) as conn:
+                self.assertEqual(conn.execute(
+                    "SELECT COUNT(*) FROM sqlite_master WHERE name LIKE 'ls_files_search%'"
+                ).fetchone()[0], 0)
+            files = sync.find(r"Aladin.*\.mkv$")
+            self.assertEqual(sorted(files), ["//Movies/Aladin (1992)/Aladin.mkv", "//Series/Aladin/S01E01.mkv"])
+
     def test_drive_id_ls_stop_first_stops_after_empty_listing(self):
-        sync = clsync.ClSync.__new__(clsync.ClSync)
+        sync = bare_clsync()
         sync._config = {
             "no_cache": False,
             "ls_stop_first": True,
@@ -568,8 +1243,168 @@ class ClSyncPlacementTest(unittest.TestCase):
         self.assertEqual(files, {})
         self.assertEqual(calls, [("dst101:", "/Movies/Aladin")])
 
+    def _parallel_ls_sync(self, remotes, ls_workers, ls_stop_first):
+        sync = bare_clsync()
+        sync._config = {
+            "no_cache": True,
+            "ls_stop_first": ls_stop_first,
+        }
+        sync._sa_registry = None
+        sync._sa_refresh = "stale"
+        sync._compare_method = "size"
+        sync._ls_workers = ls_workers
+        sync._cache = {}
+        sync._cache_counter = {}
+        sync._cache_invalidation_max = 10
+        sync.get_remotes = lambda: remotes
+        return sync
+
+    def _movie_payload(self):
+        return json.dumps([{
+            "Path": "movie.mkv",
+            "Name": "movie.mkv",
+            "Size": 10,
+            "MimeType": "video/x-matroska",
+            "ModTime": "2024-01-01T00:00:00Z",
+            "IsDir": False,
+        }])
+
+    def test_warm_listings_are_dropped_only_for_remotes_whose_usage_changed(self):
+        sync = bare_clsync()
+        sync._config = {
+            "no_cache": False,
+            "ls_stop_first": False,
+        }
+        sync._sa_registry = None
+        sync._sa_refresh = "stale"
+        sync._compare_method = "size"
+        sync._distribution_type = "mas"
+        sync._cached_free = {}
+        sync._cache = {}
+        sync._remote_state = {}
+        sync.get_remotes = lambda: ["dst101:", "dst102:"]
+        used = {"dst101:": 100, "dst102:": 200}
+        calls = []
+        sync._rclone = types.SimpleNamespace(
+            lsjson=lambda remote, path, _args, _no_error: calls.append(remote) or self._movie_payload(),
+            get_about_json=lambda remote, _no_error: {"used": used[remote], "free": 1000 - used[remote]},
+        )
+
+        sync.ls("/Movies")
+        self.assertEqual(sync.refresh_remote_state(), [])
+        files = sync.ls("/Movies", with_dups=True)
+
+        self.assertEqual(calls, ["dst101:", "dst102:"])
+        self.assertEqual(
+            sorted(files),
+            ["/Movies/movie.mkv", "/Movies/movie.mkv" + clsync.ClSync.duplicate_suffix],
+        )
+
+        used["dst102:"] = 250
+        self.assertEqual(sync.refresh_remote_state(), ["dst102:"])
+        sync.ls("/Movies")
+
+        self.assertEqual(calls, ["dst101:", "dst102:", "dst102:"])
+        self.assertEqual(sync._cached_free, {"dst101:": 900, "dst102:": 750})
+
+        sync._ls_cache_ttl_seconds = 0
+        sync.ls("/Movies")
+
+        self.assertEqual(calls[3:], ["dst101:", "dst102:"])
+
+    def test_refresh_remote_state_reads_live_quotas_past_fresh_registry_rows(self):
+        sync = bare_clsync()
+        sync._config = {"no_cache": False}
+        sync._sa_refresh = "stale"
+        sync._distribution_type = "size"
+        sync.get_remotes = lambda: ["dst101:"]
+        row = {"total": 1000, "used": 100, "free": 900, "trashed": 0, "other": 0, "objects": 1}
+        updates = []
+        sync._sa_registry = types.SimpleNamespace(
+            quota_by_remote=lambda _remote: row,
+            should_refresh=lambda _row, _mode: False,
+            update_quota_for_remote=lambda remote, quota, error: updates.append((remote, quota["used"])),
+            invalidate_ls_cache_for_remote=lambda _remote: None,
+        )
+        sync._rclone = types.SimpleNamespace(get_about_json=lambda _remote, _no_error: {"used": 300, "free": 700})
+        sync._remote_state = {"dst101:": 100}
+
+        self.assertEqual(sync.refresh_remote_state(), ["dst101:"])
+        self.assertEqual(updates, [("dst101:", 300)])
+        self.assertEqual(sync._get_remote_quota("dst101:")["used"], 100)
+
+    def test_parallel_ls_merges_duplicates_in_remote_order(self):
+        sync = self._parallel_ls_sync(["dst101:", "dst102:"], 2, False)
+        second_started = threading.Event()
+        overlapped = []
+
+        def lsjson(remote, _path, _args, _no_error):
+            if remote == "dst101:":
+                overlapped.append(second_started.wait(timeout=2))
+            else:
+                second_started.set()
+            return self._movie_payload()
+
+        sync._rclone = types.SimpleNamespace(lsjson=lsjson)
+
+        files = sync.ls("/Movies", with_dups=True)
+
+        self.assertEqual(overlapped, [True])
+        self.assertEqual(files["/Movies/movie.mkv"].remote, "dst101:")
+        self.assertEqual(files["/Movies/movie.mkv" + clsync.ClSync.duplicate_suffix].remote, "dst102:")
+
+    def test_parallel_ls_stop_first_cancels_pending_listings(self):
+        sync = self._parallel_ls_sync(["dst101:", "dst102:", "dst103:", "dst104:"], 2, True)
+        release = threading.Event()
+        calls = []
+
+        def lsjson(remote, _path, _args, _no_error):
+            calls.append(remote)
+            if remote == "dst101:":
+                return self._movie_payload()
+            release.wait(timeout=2)
+            return "[]"
+
+        sync._rclone = types.SimpleNamespace(lsjson=lsjson)
+
+        try:
+            files = sync.ls("/Movies")
+        finally:
+            release.set()
+
+        self.assertEqual([file.remote for file in files.values()], ["dst101:"])
+        self.assertNotIn("dst104:", calls)
+
+    def test_file_table_keeps_clfiles_and_shares_strings(self):
+        table = clfile.FileTable()
+        for index, remote in enumerate(["dst101:", "dst102:"]):
+            tmp_file = clfile.ClFile()
+            tmp_file.remote = "".join(remote)
+            tmp_file.path = "/Movies/movie" + str(index) + ".mkv"
+            tmp_file.name = "movie" + str(index) + ".mkv"
+            tmp_file.size = 10 + index
+            tmp_file.mime_type = "/".join(("video", "x-matroska"))
+            tmp_file.is_dir = False
+            table[tmp_file.path] = tmp_file
+        orphan = clfile.ClFile()
+        orphan.path = "/elsewhere"
+        table["/Movies/orphan.mkv"] = orphan
+        del table["/Movies/movie0.mkv"]
+        table["/Movies/movie2.mkv"] = orphan
+
+        self.assertEqual(sorted(table), ["/Movies/movie1.mkv", "/Movies/movie2.mkv", "/Movies/orphan.mkv"])
+        movie = table["/Movies/movie1.mkv"]
+        self.assertEqual((movie.remote, movie.path, movie.size, movie.md5), ("dst102:", "/Movies/movie1.mkv", 11, None))
+        self.assertIs(movie.mime_type, table["/Movies/movie1.mkv"].mime_type)
+        self.assertEqual(table["/Movies/orphan.mkv"].path, "/elsewhere")
+        self.assertNotIn("/Movies/movie0.mkv", table)
+        with self.assertRaises(AttributeError):
+            movie.extra = True
+        movie.md5 = "0" * 32
+        self.assertEqual(table["/Movies/movie1.mkv"].md5, "0" * 32)
+
     def test_ls_shallow_omits_recursive_rclone_arg(self):
-        sync = clsync.ClSync.__new__(clsync.ClSync)
+        sync = bare_clsync()
         sync._config = {
             "no_cache": False,
             "ls_stop_first": True,
@@ -601,7 +1436,7 @@ class ClSyncPlacementTest(unittest.TestCase):
         self.assertEqual(calls, [("dst101:", "/Movies/Aladin", ["--fast-list"])])
 
     def test_lsjson_accepts_files_and_directories_without_ids(self):
-        sync = clsync.ClSync.__new__(clsync.ClSync)
+        sync = bare_clsync()
         sync._config = {
             "no_cache": False,
             "ls_stop_first": False,
@@ -658,7 +1493,7 @@ class ClSyncPlacementTest(unittest.TestCase):
             with open(keep_path, "w") as fp:
                 fp.write("keep")
 
-            sync = clsync.ClSync.__new__(clsync.ClSync)
+            sync = bare_clsync()
             sync._show_progress = False
             sync._compare_method = "size"
             sync._ClSync__exclusion_list = None
@@ -716,7 +1551,7 @@ class ClSyncPlacementTest(unittest.TestCase):
             with open(os.path.join(source, "keep.txt"), "w") as fp:
                 fp.write("keep")
 
-            sync = clsync.ClSync.__new__(clsync.ClSync)
+            sync = bare_clsync()
             sync._show_progress = False
             sync._compare_method = "size"
             sync._ClSync__exclusion_list = None
@@ -809,7 +1644,7 @@ class ClSyncPlacementTest(unittest.TestCase):
             with open(local_file, "w") as fp:
                 fp.write("synthetic movie")
 
-            sync = clsync.ClSync.__new__(clsync.ClSync)
+            sync = bare_clsync()
             sync._show_progress = False
             sync._compare_method = "size"
             sync._ClSync__exclusion_list = None
@@ -842,7 +1677,7 @@ class ClSyncPlacementTest(unittest.TestCase):
             with open(local_file, "w") as fp:
                 fp.write("synthetic manga")
 
-            sync = clsync.ClSync.__new__(clsync.ClSync)
+            sync = bare_clsync()
             sync._show_progress = False
             sync._compare_method = "size"
             sync._ClSync__exclusion_list = None
@@ -864,7 +1699,7 @@ class ClSyncPlacementTest(unittest.TestCase):
             self.assertEqual(copies, [(local_file, "public/Manga", "hidrive:")])
 
     def test_backup_from_rclone_source_to_rclone_target(self):
-        sync = clsync.ClSync.__new__(clsync.ClSync)
+        sync = bare_clsync()
         sync._show_progress = False
         sync._compare_method = "size"
         sync._ClSync__exclusion_list = None
@@ -900,7 +1735,7 @@ class ClSyncPlacementTest(unittest.TestCase):
         self.assertEqual(copies, [("hidrive:public/Manga/chapter.cbz", "mirror/Manga", "backup:")])
 
     def test_backup_from_rclone_source_to_cluster_uses_source_basename(self):
-        sync = clsync.ClSync.__new__(clsync.ClSync)
+        sync = bare_clsync()
         sync._show_progress = False
         sync._compare_method = "size"
         sync._ClSync__exclusion_list = None
@@ -936,7 +1771,7 @@ class ClSyncPlacementTest(unittest.TestCase):
         self.assertEqual(copies, [("hidrive:public/Manga/chapter.cbz", "/Manga", "dst109:")])
 
     def test_parse_backup_target_preserves_rclone_path_style(self):
-        sync = clsync.ClSync.__new__(clsync.ClSync)
+        sync = bare_clsync()
 
         self.assertEqual(
             sync.parse_backup_target("hidrive:public/Manga"),
@@ -1001,7 +1836,7 @@ class ClSyncPlacementTest(unittest.TestCase):
             with open(local_file, "w") as fp:
                 fp.write("synthetic movie")
             old_cwd = os.getcwd()
-            sync = clsync.ClSync.__new__(clsync.ClSync)
+            sync = bare_clsync()
             sync._show_progress = False
             sync._compare_method = "size"
             sync._ClSync__exclusion_list = None
@@ -1023,7 +1858,7 @@ class ClSyncPlacementTest(unittest.TestCase):
             self.assertEqual(copies, [(local_file, "/Movies/Aladin", "dst109:")])
 
     def test_large_file_selection_requires_headroom(self):
-        sync = clsync.ClSync.__new__(clsync.ClSync)
+        sync = bare_clsync()
         sync._distribution_type = "mas"
         sync._cached_free = {}
         sync._large_file_threshold_bytes = 1024
@@ -1039,7 +1874,7 @@ class ClSyncPlacementTest(unittest.TestCase):
         self.assertEqual(sync.get_best_remote(1000), "roomy:")
 
     def test_small_file_selection_keeps_existing_most_free_behavior(self):
-        sync = clsync.ClSync.__new__(clsync.ClSync)
+        sync = bare_clsync()
         sync._distribution_type = "mas"
         sync._cached_free = {}
         sync._large_file_threshold_bytes = 1024
@@ -1055,7 +1890,7 @@ class ClSyncPlacementTest(unittest.TestCase):
         self.assertEqual(sync.get_best_remote(100), "two:")
 
     def test_existing_update_remote_must_have_headroom(self):
-        sync = clsync.ClSync.__new__(clsync.ClSync)
+        sync = bare_clsync()
         sync._distribution_type = "mas"
         sync._cached_free = {}
         sync._large_file_threshold_bytes = 1024
@@ -1067,7 +1902,7 @@ class ClSyncPlacementTest(unittest.TestCase):
             sync.ensure_remote_has_enough_space("tight:", 1024)
 
     def test_unknown_quota_is_not_cached_and_is_retried(self):
-        sync = clsync.ClSync.__new__(clsync.ClSync)
+        sync = bare_clsync()
         sync._cached_free = {}
         calls = []
 
@@ -1088,7 +1923,7 @@ class ClSyncPlacementTest(unittest.TestCase):
             local_file = os.path.join(tmp, "movie.mkv")
             with open(local_file, "w") as fp:
                 fp.write("synthetic movie")
-            sync = clsync.ClSync.__new__(clsync.ClSync)
+            sync = bare_clsync()
             sync._show_progress = False
             sync._compare_method = "size"
             sync._ClSync__exclusion_list = None
@@ -1111,12 +1946,389 @@ class ClSyncPlacementTest(unittest.TestCase):
             self.assertEqual([call[2] for call in copies], ["dst102:", "dst101:"])
             self.assertEqual(marked, [("dst101:", len("synthetic movie"))])
 
+    def test_pack_placement_plans_large_files_first_and_reports_unplaceable(self):
+        plan = placement.pack({"a": 50, "b": 50, "c": 60, "d": 110}, {"dst101:": 100, "dst102:": 60, "dst103:": None})
+
+        self.assertEqual(plan.assignments, {"c": "dst102:", "a": "dst101:", "b": "dst101:"})
+        self.assertEqual(plan.unplaced, ["d"])
+        self.assertEqual(plan.packed_bytes, 160)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, size in (("a.mkv", 50), ("b.mkv", 50), ("c.mkv", 60), ("d.mkv", 110)):
+                with open(os.path.join(tmp, name), "wb") as fp:
+                    fp.write(b"x" * size)
+            sync = bare_clsync()
+            sync._show_progress = False
+            sync._compare_method = "size"
+            sync._distribution_type = "mas"
+            sync._placement_strategy = "pack"
+            sync._large_file_threshold_bytes = 1000
+            sync._ClSync__exclusion_list = None
+            sync._ClSync__exclude_regex = None
+            sync._cached_free = {"dst101:": 100, "dst102:": 60}
+            sync.get_remotes = lambda: ["dst101:", "dst102:"]
+            sync.ls_shallow = lambda _path, **_kwargs: {}
+            copies = []
+
+            def mark_remote_used(remote, size):
+                sync._cached_free[remote] -= size
+
+            sync.copy = lambda src, _dst, remote: copies.append((os.path.basename(src), remote))
+            sync.mark_remote_used = mark_remote_used
+
+            with self.assertRaises(Exception) as raised:
+                sync.backup(tmp, delete_files=False, dry_run=False)
+
+            self.assertEqual(sorted(copies), [("a.mkv", "dst101:"), ("b.mkv", "dst101:"), ("c.mkv", "dst102:")])
+            self.assertIn("d.mkv", str(raised.exception))
+            self.assertEqual(sync._cached_free, {"dst101:": 0, "dst102:": 0})
+
+    def test_rebalance_moves_the_smallest_covering_file_server_side(self):
+        moves = placement.rebalance(
+            {"dst101:": 10, "dst102:": 500, "dst103:": 200},
+            {"dst101:": [("/a.mkv", 40), ("/b.mkv", 95), ("/c.mkv", 300)]},
+            100,
+        )
+        self.assertEqual(moves, [placement.Move("/b.mkv", 95, "dst101:", "dst103:")])
+        self.assertEqual(
+            placement.rebalance({"dst101:": 10, "dst102:": 500}, {"dst101:": [("/a.mkv", 40), ("/b.mkv", 95)]}, 100, 50),
+            [placement.Move("/a.mkv", 40, "dst101:", "dst102:")],
+        )
+
+        listings = {
+            "dst101:": [("b.mkv", 95), ("shared.mkv", 120), ("a.mkv", 40)],
+            "dst102:": [],
+            "dst103:": [("shared.mkv", 120)],
+        }
+
+        def list_remote(path, _recursive, remote):
+            files = clfile.FileTable()
+            for name, size in listings[remote]:
+                tmp_file = clfile.ClFile()
+                tmp_file.remote = remote
+                tmp_file.path = path + "/" + name
+                tmp_file.name = name
+                tmp_file.size = size
+                tmp_file.is_dir = False
+                files[tmp_file.path] = tmp_file
+            return files
+
+        sync = bare_clsync()
+        sync._large_file_threshold_bytes = 1000
+        sync.get_remotes = lambda: ["dst101:", "dst102:", "dst103:"]
+        sync.get_frees = lambda: {"dst101:": 10, "dst102:": 500, "dst103:": 200}
+        sync._list_remote = list_remote
+        moved = []
+        used = []
+        sync._rclone = types.SimpleNamespace(moveto=lambda src, dst, extra_args: moved.append((src, dst, extra_args)))
+        sync.mark_remote_used = lambda remote, size: used.append((remote, size))
+
+        plan = sync.rebalance("/backup", dry_run=True, min_free=100)
+
+        self.assertEqual(plan, [placement.Move("/backup/b.mkv", 95, "dst101:", "dst103:")])
+        self.assertEqual(moved, [])
+
+        sync.rebalance("/backup", min_free=100)
+
+        self.assertEqual(moved, [("dst101:/backup/b.mkv", "dst103:/backup/b.mkv", ["--drive-server-side-across-configs"])])
+        self.assertEqual(used, [("dst103:", 95), ("dst101:", -95)])
+
+    def test_resumed_backup_runs_only_open_journal_operations_on_renamed_remotes(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, "source")
+            os.mkdir(source)
+            for name, size in (("a.mkv", 50), ("b.mkv", 60)):
+                with open(os.path.join(source, name), "wb") as fp:
+                    fp.write(b"x" * size)
+            copies = []
+
+            def make_sync(remote_names):
+                sync = bare_clsync()
+                sync._show_progress = False
+                sync._compare_method = "size"
+                sync._distribution_type = "mas"
+                sync._placement_strategy = "pack"
+                sync._large_file_threshold_bytes = 1000
+                sync._ClSync__exclusion_list = None
+                sync._ClSync__exclude_regex = None
+                sync._journal_db = os.path.join(tmp, "backup-journal.sqlite3")
+                sync._cached_free = dict((remote, 100) for remote in remote_names.values())
+                sync.get_remotes = lambda: sorted(remote_names.values())
+                sync.get_eligible_remotes = lambda _size: sorted(remote_names.values())
+                sync._sa_registry = types.SimpleNamespace(
+                    account_id_for_remote=lambda remote: dict(
+                        (name, account_id) for account_id, name in remote_names.items())[remote],
+                    patch_ls_cache_for_remote=lambda _remote, **_changes: None,
+                )
+                sync.mark_remote_used = lambda _remote, _size: None
+                return sync
+
+            def copy(src, _dst, remote):
+                copies.append((os.path.basename(src), remote))
+                if os.path.basename(src) == "b.mkv":
+                    raise Exception("interrupted")
+
+            sync = make_sync({7: "dst101:", 8: "dst102:"})
+            sync.ls_shallow = lambda _path, **_kwargs: {}
+            sync.copy = copy
+            with self.assertRaisesRegex(Exception, "1 failed operation"):
+                sync.backup(source, delete_files=False, dry_run=False)
+            self.assertEqual(copies, [("a.mkv", "dst102:"), ("b.mkv", "dst101:"), ("b.mkv", "dst102:")])
+
+            del copies[:]
+            # The accounts got new remote names; nothing may be indexed or listed again.
+            resumed = make_sync({7: "dst105:", 8: "dst104:"})
+            resumed.index_local_dir = lambda *_args: self.fail("resume indexed the source")
+            resumed.ls_shallow = lambda *_args, **_kwargs: self.fail("resume listed the remotes")
+            resumed.copy = lambda src, _dst, remote: copies.append((os.path.basename(src), remote))
+            resumed.backup(source, delete_files=False, dry_run=False, resume=True)
+
+            self.assertEqual(copies, [("b.mkv", "dst105:")])
+            self.assertIsNone(resumed._backup_journal().resume(os.path.abspath(source) + "\n"))
+
+    def test_batched_backup_uploads_directory_once_and_retries_failed_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for name in ("first.mkv", "second.mkv", "third.mkv"):
+                with open(os.path.join(tmp, name), "w") as fp:
+                    fp.write("synthetic movie")
+            sync = bare_clsync()
+            sync._show_progress = False
+            sync._compare_method = "size"
+            sync._batch_transfers = True
+            sync._rclone_move = False
+            sync._ClSync__exclusion_list = None
+            sync._ClSync__exclude_regex = None
+            sync._large_file_threshold_bytes = clsync.DEFAULT_LARGE_FILE_THRESHOLD_BYTES
+            sync._cached_free = {"dst101:": 1000, "dst102:": 10}
+            sync.ls_shallow = lambda _path, **_kwargs: {}
+            sync.get_eligible_remotes = lambda _size: ["dst101:", "dst102:"]
+            batches = []
+
+            def copy_files(src, dst, names, move=False):
+                batches.append((src, dst, sorted(names)))
+                return {"second.mkv": "Failed to copy: temporary failure"}, None
+
+            sync._rclone = types.SimpleNamespace(copy_files=copy_files)
+            copies = []
+            marked = []
+            sync.copy = lambda src, _dst, remote: copies.append((os.path.basename(src), remote))
+            sync.mark_remote_used = lambda remote, size: marked.append((remote, size))
+
+            sync.backup(tmp, delete_files=False, dry_run=False)
+
+            self.assertEqual(len(batches), 1)
+            self.assertEqual(batches[0][0], tmp)
+            self.assertEqual(batches[0][2], ["first.mkv", "second.mkv", "third.mkv"])
+            self.assertEqual(copies, [("second.mkv", "dst101:")])
+            self.assertEqual(
+                sorted(marked),
+                [("dst101:", len("synthetic movie")), ("dst101:", 2 * len("synthetic movie"))],
+            )
+
+    def test_batched_uploads_advance_the_progress_bar_only_for_finished_files(self):
+        sync = bare_clsync()
+        ops = []
+        for name in ("first.mkv", "second.mkv", "third.mkv"):
+            src = clfile.ClFile()
+            src.path = "/data/Movies"
+            src.name = name
+            src.size = 10
+            src.remote_path = "/Movies"
+            src.is_dir = False
+            ops.append(operation.Operation(operation.Operation.ADD, src, None))
+        sync._run_batch = lambda _key, group, _target_remote: (group[1:2], len(group))
+        steps = []
+        bar = types.SimpleNamespace(next=lambda: steps.append(1))
+
+        remaining = sync._backup_batches(ops, "dst101:", lambda *_args: self.fail("nothing fails here"), bar)
+
+        self.assertEqual([op.src.name for op in remaining], ["second.mkv"])
+        self.assertEqual(len(steps), 2)
+
+    def test_batched_deletes_run_once_per_remote_and_prune_emptied_directories(self):
+        def remove(remote, path, is_dir=False):
+            remote_file = clfile.ClFile()
+            remote_file.remote = remote
+            remote_file.path = path
+            remote_file.name = path.rsplit("/", 1)[-1]
+            remote_file.is_dir = is_dir
+            return operation.Operation(operation.Operation.REMOVE, remote_file, None)
+
+        sync = bare_clsync()
+        deletes = []
+        pruned = []
+
+        def delete_files(remote, root, names):
+            deletes.append((remote, root, names))
+            return {"keep/k.mkv": "Couldn't delete: permission denied"}, None
+
+        def rmdirs(remote, directory, leave_root=False):
+            pruned.append((remote, directory))
+            return ["sub"] if directory == "//b/old" else []
+
+        def rmdir(remote, directory):
+            if directory != "//b/old":
+                raise Exception("directory not empty")
+
+        sync._rclone = types.SimpleNamespace(delete_files=delete_files, rmdirs=rmdirs, rmdir=rmdir)
+        ops = [
+            remove("dst101:", "//b/old/sub/c.mkv"),
+            remove("dst101:", "//b/old/sub", True),
+            remove("dst101:", "//b/old/a.mkv"),
+            remove("dst101:", "//b/old", True),
+            remove("dst101:", "//b/keep/k.mkv"),
+            remove("dst101:", "//b/keep", True),
+            remove("dst101:", "//b/full/sub", True),
+            remove("dst101:", "//b/full", True),
+            remove("dst102:", "//b/z.mkv"),
+        ]
+
+        remaining = sync._backup_deletes(ops)
+
+        self.assertEqual(deletes, [("dst101:", "/b", ["old/sub/c.mkv", "old/a.mkv", "keep/k.mkv"])])
+        # rmdirs keeps the non-empty //b/full silently: it stays for the per-file path.
+        self.assertEqual(pruned, [("dst101:", "//b/full"), ("dst101:", "//b/old")])
+        self.assertEqual(
+            [(op.src.remote, op.src.path) for op in remaining],
+            [("dst102:", "//b/z.mkv"), ("dst101:", "//b/keep/k.mkv"), ("dst101:", "//b/keep"),
+             ("dst101:", "//b/full/sub"), ("dst101:", "//b/full")],
+        )
+
+    def test_batched_deletes_leave_drive_duplicates_to_the_per_file_path(self):
+        sync = bare_clsync()
+        sync._config = {"no_cache": True}
+        sync._rclone = types.SimpleNamespace(lsjson_rows=lambda *_args: [
+            {"Path": name, "Name": name, "Size": 10, "MimeType": "video/x-matroska",
+             "ModTime": "2024-01-01T00:00:00Z", "IsDir": False, "ID": name + "-" + str(index)}
+            for index, name in enumerate(("a.mkv", "b.mkv", "c.mkv", "b.mkv"))
+        ])
+        listing = sync._list_remote("/Movies", True, "dst101:")
+        deletes = []
+
+        def delete_files(remote, root, names):
+            deletes.append((remote, root, names))
+            return {}, None
+
+        sync._rclone = types.SimpleNamespace(delete_files=delete_files)
+        ops = [operation.Operation(operation.Operation.REMOVE, listing[key], None)
+               for key in ("/Movies/a.mkv", "/Movies/b.mkv" + clsync.ClSync.duplicate_suffix, "/Movies/c.mkv")]
+
+        remaining = sync._backup_deletes(ops)
+
+        self.assertEqual(deletes, [("dst101:", "/Movies", ["a.mkv", "c.mkv"])])
+        self.assertEqual([op.src.path for op in remaining], ["/Movies/b.mkv"])
+
+    def test_restore_pulls_each_remote_manifest_once_and_resumes_failed_files(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            listing = clfile.FileTable()
+            for remote, path, size in (
+                    ("dst101:", "/backup/a.mkv", 3),
+                    ("dst101:", "/backup/sub/b.mkv", 4),
+                    ("dst102:", "/backup/sub/c.mkv", 5)):
+                remote_file = clfile.ClFile()
+                remote_file.remote = remote
+                remote_file.path = path
+                remote_file.name = path.rsplit("/", 1)[-1]
+                remote_file.size = size
+                remote_file.is_dir = False
+                listing[path] = remote_file
+            sync = bare_clsync()
+            sync._compare_method = "size"
+            sync._rclone_move = False
+            sync.ls = lambda path: listing if path == "/backup" else self.fail(path)
+            pulls = []
+            truncated = []
+
+            def copy_files(src, dst, names, move=False, min_age="6h"):
+                pulls.append((src, sorted(names), min_age))
+                for name in names:
+                    size = listing["/backup/" + name].size
+                    if name == "sub/c.mkv" and not truncated:
+                        truncated.append(name)
+                        size = 1
+                    os.makedirs(os.path.dirname(os.path.join(dst, name)), exist_ok=True)
+                    with open(os.path.join(dst, name), "w") as fp:
+                        fp.write("x" * size)
+                return {}, None
+
+            sync._rclone = types.SimpleNamespace(copy_files=copy_files)
+
+            with self.assertRaisesRegex(Exception, "1 failed file.*sub/c.mkv: size 1 does not match"):
+                sync.restore("backup", tmp)
+            self.assertEqual(sorted(pulls), [
+                ("dst101:/backup", ["a.mkv", "sub/b.mkv"], None),
+                ("dst102:/backup", ["sub/c.mkv"], None),
+            ])
+
+            pulls = []
+            sync.restore("backup", tmp, resume=True)
+            self.assertEqual(pulls, [("dst102:/backup", ["sub/c.mkv"], None)])
+
+    def test_concurrent_backup_reserves_remote_space_and_limits_per_remote(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            names = ["a.mkv", "b.mkv", "c.mkv", "d.mkv"]
+            for name in names:
+                with open(os.path.join(tmp, name), "w") as fp:
+                    fp.write("synthetic movie")
+            size = len("synthetic movie")
+            sync = bare_clsync()
+            sync._show_progress = False
+            sync._compare_method = "size"
+            sync._distribution_type = "mas"
+            sync._transfer_workers = 4
+            sync._transfer_workers_per_remote = 1
+            sync._rclone_move = False
+            sync._ClSync__exclusion_list = None
+            sync._ClSync__exclude_regex = None
+            sync._config = {"cluster_remotes": ["dst101:", "dst102:"]}
+            sync._large_file_threshold_bytes = clsync.DEFAULT_LARGE_FILE_THRESHOLD_BYTES
+            sync._cached_free = {"dst101:": 2 * size, "dst102:": 2 * size}
+            sync._frees = None
+            sync._sa_registry = None
+            sync.ls_shallow = lambda _path, **_kwargs: {}
+            lock = threading.Lock()
+            active = {}
+            peak = {}
+            copies = []
+
+            def copy(src, _dst, remote):
+                with lock:
+                    active[remote] = active.get(remote, 0) + 1
+                    peak[remote] = max(peak.get(remote, 0), active[remote])
+                time.sleep(0.05)
+                with lock:
+                    active[remote] -= 1
+                    copies.append((os.path.basename(src), remote))
+
+            sync.copy = copy
+
+            sync.backup(tmp, delete_files=False, dry_run=False)
+
+            self.assertEqual(sorted(name for name, _remote in copies), names)
+            self.assertEqual(sorted(remote for _name, remote in copies),
+                             ["dst101:", "dst101:", "dst102:", "dst102:"])
+            self.assertEqual(peak, {"dst101:": 1, "dst102:": 1})
+            self.assertEqual(sync._cached_free, {"dst101:": 0, "dst102:": 0})
+            self.assertIsNone(sync._reservations)
+
+    def test_reserved_space_is_not_offered_to_other_uploads(self):
+        sync = bare_clsync()
+        sync._large_file_threshold_bytes = clsync.DEFAULT_LARGE_FILE_THRESHOLD_BYTES
+        sync._cached_free = {"dst101:": 100}
+        sync._reservations = workers.CapacityReservations()
+
+        self.assertTrue(sync._reserve_remote_space("dst101:", 60))
+        self.assertEqual(sync._known_free_for_remote("dst101:"), 40)
+        self.assertFalse(sync._reserve_remote_space("dst101:", 60))
+        sync._release_remote_space("dst101:", 60)
+        self.assertTrue(sync._reserve_remote_space("dst101:", 60))
+
     def test_backup_marks_storage_quota_remote_full_before_fallback(self):
         with tempfile.TemporaryDirectory() as tmp:
             local_file = os.path.join(tmp, "movie.mkv")
             with open(local_file, "w") as fp:
                 fp.write("synthetic movie")
-            sync = clsync.ClSync.__new__(clsync.ClSync)
+            sync = bare_clsync()
             sync._show_progress = False
             sync._compare_method = "size"
             sync._ClSync__exclusion_list = None
@@ -1148,7 +2360,7 @@ class ClSyncPlacementTest(unittest.TestCase):
             for path in (first, second):
                 with open(path, "w") as fp:
                     fp.write("synthetic movie")
-            sync = clsync.ClSync.__new__(clsync.ClSync)
+            sync = bare_clsync()
             sync._show_progress = False
             sync._compare_method = "size"
             sync._ClSync__exclusion_list = None
@@ -1177,7 +2389,7 @@ class ClSyncPlacementTest(unittest.TestCase):
 
     def test_backup_continues_after_update_and_delete_failures(self):
         with tempfile.TemporaryDirectory() as tmp:
-            sync = clsync.ClSync.__new__(clsync.ClSync)
+            sync = bare_clsync()
             sync._show_progress = False
             sync._compare_method = "size"
             sync._ClSync__exclusion_list = None
@@ -1211,6 +2423,160 @@ class ClSyncPlacementTest(unittest.TestCase):
 
             self.assertEqual(deleted, [("/old.mkv", "dst101:")])
 
+    def _write_old_file(self, path, text="synthetic movie"):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as fp:
+            fp.write(text)
+        old = time.time() - local_index.MIN_AGE_SECONDS - 60
+        os.utime(path, (old, old))
+
+    def test_local_scan_reads_only_changed_directories(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, "source")
+            for name in ("a/one.mkv", "a/two.mkv", "b/three.mkv", "c/four.mkv"):
+                self._write_old_file(os.path.join(source, name))
+
+            first = local_index.scan(source)
+            self.assertEqual(
+                list(first.entries),
+                [os.path.join(source, name) if name else source
+                 for name in ("", "a", "b", "c", "a/one.mkv", "a/two.mkv", "b/three.mkv", "c/four.mkv")],
+            )
+
+            self._write_old_file(os.path.join(source, "b", "five.mkv"))
+            os.remove(os.path.join(source, "a", "two.mkv"))
+            read = []
+            real_scandir = os.scandir
+
+            def scandir(path):
+                read.append(os.path.relpath(path, source))
+                return real_scandir(path)
+
+            with mock.patch.object(local_index.os, "scandir", side_effect=scandir):
+                second = local_index.scan(source, first.entries)
+
+            self.assertEqual(read, ["a", "b"])
+            self.assertEqual(second.changed, [os.path.join(source, "b", "five.mkv")])
+            self.assertEqual(second.deleted, [os.path.join(source, "a", "two.mkv")])
+            self.assertIn(os.path.join(source, "c", "four.mkv"), second.entries)
+
+    def test_local_snapshot_backup_compares_only_changed_and_deleted_files(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, "source")
+            self._write_old_file(os.path.join(source, "a", "one.mkv"))
+            self._write_old_file(os.path.join(source, "b", "keep.mkv"))
+            self._write_old_file(os.path.join(source, "b", "gone.mkv"))
+
+            sync = bare_clsync()
+            sync._show_progress = False
+            sync._compare_method = "size"
+            sync._ClSync__exclusion_list = None
+            sync._ClSync__exclude_regex = None
+            sync._local_snapshot = local_index.LocalSnapshot(os.path.join(tmp, "local-index.sqlite3"))
+            sync.ls = lambda _path, **_kwargs: {}
+            sync.get_eligible_remotes = lambda _size: ["dst101:"]
+            sync.mark_remote_used = lambda _remote, _size: None
+            listed = []
+            copied = []
+            deleted = []
+
+            def ls_shallow(path, **_kwargs):
+                listed.append(path)
+                remote_clfile = clfile.ClFile()
+                remote_clfile.remote = "dst101:"
+                remote_clfile.path = path + "/gone.mkv"
+                remote_clfile.name = "gone.mkv"
+                remote_clfile.size = 15
+                remote_clfile.is_dir = False
+                return {path + "/gone.mkv": remote_clfile}
+
+            sync.ls_shallow = ls_shallow
+            sync.copy = lambda src, _dst, _remote: copied.append(os.path.relpath(src, source))
+            sync.delete_file = lambda path, remote: deleted.append((path, remote))
+
+            sync.backup(source, delete_files=True, dry_run=False)
+            self.assertEqual(sorted(copied), ["a/one.mkv", "b/gone.mkv", "b/keep.mkv"])
+
+            del copied[:]
+            sync.backup(source, delete_files=True, dry_run=False)
+            self.assertEqual((listed, copied, deleted), ([], [], []))
+
+            self._write_old_file(os.path.join(source, "a", "new.mkv"))
+            os.remove(os.path.join(source, "b", "gone.mkv"))
+            sync.backup(source, delete_files=True, dry_run=False)
+
+            remote_b = os.path.dirname(sync.remote_key_for_source_path(
+                source, os.path.join(source, "b", "gone.mkv")))
+            self.assertEqual(copied, ["a/new.mkv"])
+            self.assertEqual(deleted, [(remote_b + "/gone.mkv", "dst101:")])
+            self.assertEqual(len(listed), 2)
+
+
+    def test_md5_hash_cache_skips_unchanged_files_and_evicts_removed_ones(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, "source")
+            for name in ("a/one.mkv", "b/two.mkv"):
+                self._write_old_file(os.path.join(source, name))
+            sync = bare_clsync()
+            sync._compare_method = "md5"
+            sync._ClSync__exclude_regex = None
+            sync._hash_cache = local_index.HashCache(os.path.join(tmp, "local-index.sqlite3"))
+
+            with mock.patch.object(clsync.common, "get_md5", wraps=common.get_md5) as get_md5:
+                first = sync.index_local_dir(source)
+                os.rename(os.path.join(source, "b", "two.mkv"), os.path.join(source, "a", "two.mkv"))
+                os.remove(os.path.join(source, "a", "one.mkv"))
+                second = sync.index_local_dir(source)
+
+            self.assertEqual(get_md5.call_count, 2)
+            self.assertEqual((sync._hash_cache.hits, sync._hash_cache.misses), (1, 2))
+            self.assertEqual(
+                second[common.normalize_path(os.path.join(source, "a", "two.mkv"))].md5,
+                first[common.normalize_path(os.path.join(source, "b", "two.mkv"))].md5,
+            )
+            with sqlite3.connect(sync._hash_cache.db_path) as conn:
+                paths = [row[0] for row in conn.execute("SELECT path FROM hash_cache")]
+            self.assertEqual(paths, [os.path.join(source, "a", "two.mkv")])
+
+    def test_md5_hashing_runs_on_hash_workers_with_readinto_buffer(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, "source")
+            for name in ("one.mkv", "two.mkv", "three.mkv"):
+                self._write_old_file(os.path.join(source, name), name * 1000)
+            sync = bare_clsync()
+            sync._compare_method = "md5"
+            sync._ClSync__exclude_regex = None
+            sync._hash_workers = 3
+            barrier = threading.Barrier(3, timeout=5)
+            real_get_md5 = common.get_md5
+
+            def get_md5(path, fadvise=False):
+                barrier.wait()
+                return real_get_md5(path, block_size=7, fadvise=True)
+
+            with mock.patch.object(clsync.common, "get_md5", side_effect=get_md5):
+                clfiles = sync.index_local_dir(source)
+
+            for name in ("one.mkv", "two.mkv", "three.mkv"):
+                self.assertEqual(
+                    clfiles[common.normalize_path(os.path.join(source, name))].md5,
+                    hashlib.md5((name * 1000).encode("utf-8")).hexdigest(),
+                )
+
+    def test_md5_ignores_a_rejected_fadvise_hint(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "movie.mkv")
+            with open(path, "w") as fp:
+                fp.write("synthetic movie")
+
+            def posix_fadvise(*_args):
+                raise OSError(22, "Invalid argument")
+
+            with mock.patch.object(common.os, "posix_fadvise", posix_fadvise, create=True), \
+                    mock.patch.object(common.os, "POSIX_FADV_SEQUENTIAL", 2, create=True):
+                md5 = common.get_md5(path, fadvise=True)
+
+            self.assertEqual(md5, hashlib.md5(b"synthetic movie").hexdigest())
 
 class ServiceAccountCliTest(unittest.TestCase):
     def test_service_account_about_uses_and_removes_generated_config(self):
@@ -1385,6 +2751,21 @@ class ServiceAccountCliTest(unittest.TestCase):
                 else:
                     os.environ["RCLONE_VERBOSE"] = old_verbose
 
+    def test_listing_cache_is_on_unless_turned_off(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            conf_path = os.path.join(tmp, "sprinkle.conf")
+            with open(conf_path, "w") as fp:
+                fp.write("no_cache=true\n")
+            for args, conf, expected in (
+                    (["backup", "/tmp/local"], None, False),
+                    (["--daemon-mode", "backup", "/tmp/local"], None, False),
+                    (["backup", "/tmp/local"], conf_path, True),
+                    (["--no-cache", "--daemon-mode", "backup", "/tmp/local"], None, True)):
+                sprinkle.read_args(["--rclone-env-file", os.path.join(tmp, "rclone.env")] + args)
+                sprinkle.configure(conf)
+
+                self.assertIs(getattr(sprinkle, "__config")["no_cache"], expected, args)
+
     def test_progress_option_sets_show_progress(self):
         with tempfile.TemporaryDirectory() as tmp:
             sprinkle.read_args([